@@ -21,7 +21,7 @@ from . import clustering
 
 
 import numpy as np
-import numpy.matlib
+import warnings
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -33,6 +33,8 @@ class VQPCA(clustering.lpca):
     computed from the training dataset, X. Warning: center = mean and scaling = auto is default.
     1. For each cluster of the training matrix, compute the Principal Components.
     2. Assign each observation y \in Y to the cluster which minimizes the local reconstruction error.
+    If a fitted lpca model is given (model setter), steps 0-1 are skipped and the centering and scaling
+    factors, the centroids and the local PCs stored in the model are used.
     '''
     def __init__(self, X, idx, Y):
         self.X = X
@@ -42,6 +44,23 @@ class VQPCA(clustering.lpca):
         super().__init__(X)
         self.k = int(max(self.idx) +1)
         self.nPCs = 2 #round(self.Y.shape[1] - 1)#(self.Y.shape[1]) /10) Use a very high number of PCs to classify,removing only the last 20% which contains noise
+        #Previously fitted model (lpca_model, or path to the .npz file where it was saved):
+        self._model = None
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, new_model):
+        if isinstance(new_model, str):
+            new_model = clustering.lpca_model.load(new_model)
+        self._model = new_model
+
+        if self._model is not None and not isinstance(self._model, clustering.lpca_model):
+            self._model = None
+            warnings.warn("An exception occured with regard to the input value for the fitted model. It must be a lpca_model, or the path to the file where it was saved.")
+            print("\tThe local models will be computed from the training data.")
 
     def check_sanity_input(self):
         if self.X.shape[0] > len(self.idx) or self.X.shape[0] < len(self.idx):
@@ -60,6 +79,9 @@ class VQPCA(clustering.lpca):
         Classify a new set of observations on the basis of a previous
         LPCA partitioning.
         '''
+        if self._model is not None:
+            return self._model.classify(self.Y)
+
         self.check_sanity_input()
         print("Classifying the new observations...")
         # Compute the centering/scaling factors of the training matrix
@@ -69,20 +91,17 @@ class VQPCA(clustering.lpca):
         # Scale the new matrix with these factors
         Y_tilde = center_scale(self.Y, mu, sigma)
         
-        # Initialize arrays
-        rows, cols = np.shape(self.Y)
-        sq_rec_oss = np.empty((rows, cols), dtype=float)
-        sq_rec_err = np.empty((rows, self.k), dtype=float)
-        
-        # Compute the reconstruction errors
+        # Compute the local PCs and the centroids
+        centroids_list = [None] *self.k
+        modes_list = [None] *self.k
         for ii in range (0, self.k):
             cluster = get_cluster(self.X, self.idx, ii)
-            centroids = get_centroids(cluster)
+            centroids_list[ii] = get_centroids(cluster)
             modes = PCA_fit(cluster, self.nPCs)
-            C_mat = np.matlib.repmat(centroids, rows, 1)
-            rec_err_os = (self.Y - C_mat) - (self.Y - C_mat) @ modes[0] @ modes[0].T
-            sq_rec_oss = np.power(rec_err_os, 2)
-            sq_rec_err[:,ii] = sq_rec_oss.sum(axis=1)
+            modes_list[ii] = modes[0]
+
+        # Compute the reconstruction errors
+        sq_rec_err = get_reconstruction_errors(self.Y, centroids_list, modes_list)
 
         # Assign the label
         idx_classification = np.argmin(sq_rec_err, axis = 1)
@@ -19,10 +19,11 @@ MODULE: clustering.py
 from .utilities import *
 from . import model_order_reduction
 import warnings
+import functools
+import time
 
 import numpy as np
 from numpy import linalg as LA
-import numpy.matlib
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -86,16 +87,47 @@ class lpca:
     initialization:         initialization method: 'random', 'kmeans', 'observations', 'pkcia' are available.
     type   _method:         string
 
-    correction:             multiplicative or additive correction factor to be used for the lpca algorithm
+    correction:             multiplicative or additive correction factor to be used for the lpca algorithm:
+                            'off', 'c_range', 'uncorrelation', 'local_variance', 'phc_multi', 'local_skewness',
+                            or any other factor added with register_correction.
     type _beta:             string
 
     eigens:                 number of Principal Components which have to be used locally for the dimensionality reduction task.
     type _nPCs:             scalar
 
+    n_jobs:                 number of threads used to fit the local PCA models and to compute the rec errors
+                            of the clusters. If n_init > 1, number of processes used to run the different
+                            initializations concurrently. If equal to -1, all the available cores are used.
+    type _n_jobs:           scalar
+
+    centroid_method:        centroid of each cluster, used as origin of the local PCA: 'mean', 'medianoid'
+                            or 'medoid'. For large clusters, medianoids and medoids are approximated.
+    type _centroid_method:  string
+
+    verbose:                print the information about the algorithm at each iteration.
+    type _verbose:          boolean
+
+    callback:               function called at the end of each iteration with a dictionary containing: the
+                            'iteration' number, the reconstruction 'error', its relative 'variation', the number
+                            of 'labels_changed' and the 'timings' of the iteration phases (in seconds).
+                            If the function returns True, the algorithm is stopped.
+    type _callback:         function
+
+    n_init:                 number of times the algorithm is run with different random seeds. The solution
+                            with the lowest final reconstruction error is kept. The callback is not called
+                            during the runs, and with the deterministic initializations ('uniform' and 'pkcia')
+                            the algorithm is run only once.
+    type _n_init:           scalar
+
+    eigen_solver:           solver used for the local PCA: 'auto', 'eigh', 'svd', 'eigsh', 'fastSVD' or 'snapshot'
+                            (see utilities.select_eigen_solver). With the clusters' means as centroids,
+                            the local PCs are computed from the covariance matrices ('eigh' or 'eigsh').
+    type _eigen_solver:     string
+
     
     '''
     def __init__(self, X, *dictionary):
-        self.X = np.array(X)
+        self.X = np.asarray(X)
         #Initialize the number of clusters:
         self._k = 2
         #Initialize the number of PCs to retain in each cluster:
@@ -107,6 +139,15 @@ class lpca:
         self.__activateCorrection = False
         #Adaptive PCs per cluster:
         self._adaptive = False                                              #Available options: True or False (boolean)
+        #Set the centroid of each cluster:
+        self._centroid_method = 'mean'                                      #Available options: 'mean', 'medianoid', 'medoid'
+        #Clusters larger than this are given approximated medianoids and medoids:
+        self.__exactCentroidSize = 10000
+        self.__medoidCandidates = 1000
+        self.__medianoidBins = 256
+        #The sufficient statistics are updated with the moved observations for this number of
+        #iterations at most, and then computed again to discard the accumulated rounding errors:
+        self.__statisticsUpdates = 10
 
         #Decide if the input matrix must be centered:
         self._center = True
@@ -118,6 +159,16 @@ class lpca:
         self._scaling = 'auto'
 
         self._writeFolder = True
+        #Number of threads to be used for the clusters' local PCA and rec error:
+        self._n_jobs = 1
+        #Number of runs with different random seeds:
+        self._n_init = 1
+        #Print the information at each iteration:
+        self._verbose = False
+        #Function called at the end of each iteration (see the callback setter):
+        self._callback = None
+        #Solver for the eigendecomposition of the local PCA:
+        self._eigen_solver = 'auto'                                         #Available options: 'auto', 'eigh', 'svd', 'eigsh', 'fastSVD', 'snapshot'
 
         if dictionary:
             settings = dictionary[0]
@@ -202,7 +253,7 @@ class lpca:
                 self._correction = settings["correction_factor"]   
                 if not isinstance(self._correction, str):
                     raise Exception
-                elif self._correction != "off" and self._correction != "phc_multi" and self._correction != "c_range" and self._correction != "uncorrelation" and self._correction != "local_variance" and self._correction !=  "local_skewness":
+                elif self._correction != "off" and self._correction not in lpca_corrections:
                     raise Exception    
             except:
                 self._correction = "off"
@@ -220,6 +271,38 @@ class lpca:
                     raise Exception
             except:
                 self._writeFolder = True
+            try:
+                self._n_jobs = settings["number_of_jobs"]
+                if not isinstance(self._n_jobs, int) or (self._n_jobs <= 0 and self._n_jobs != -1):
+                    raise Exception
+            except:
+                self._n_jobs = 1
+            try:
+                self._centroid_method = settings["centroid_method"]
+                if not isinstance(self._centroid_method, str):
+                    raise Exception
+                elif self._centroid_method.lower() != "mean" and self._centroid_method.lower() != "medianoid" and self._centroid_method.lower() != "medoid":
+                    raise Exception
+            except:
+                self._centroid_method = 'mean'
+            try:
+                self._n_init = settings["number_of_initializations"]
+                if not isinstance(self._n_init, int) or self._n_init <= 0:
+                    raise Exception
+            except:
+                self._n_init = 1
+            try:
+                self._verbose = settings["verbose"]
+                if not isinstance(self._verbose, bool):
+                    raise Exception
+            except:
+                self._verbose = False
+            try:
+                self._eigen_solver = settings["eigen_solver"]
+                if self._eigen_solver not in eigen_solvers:
+                    raise Exception
+            except:
+                self._eigen_solver = 'auto'
 
 
     @property
@@ -283,7 +366,7 @@ class lpca:
             self._correction = "off"
             warnings.warn("An exception occured with regard to the input value for the correction factor to use . It could be not acceptable, or not given to the dictionary.")
             print("\tCorrection factor automatically set equal to 'off'.")
-        elif self._correction != "off" and self._correction != "phc_multi" and self._correction != "c_range" and self._correction != "uncorrelation" and self._correction != "local_variance" and self._correction !=  "local_skewness":
+        elif self._correction != "off" and self._correction not in lpca_corrections:
             self._correction = "off" 
             warnings.warn("An exception occured with regard to the input value for the correction factor to use . It could be not acceptable, or not given to the dictionary.")
             print("\tCorrection factor automatically set equal to 'off'.")
@@ -376,6 +459,95 @@ class lpca:
         if not isinstance(self._writeFolder, bool):
             self._writeFolder = False 
 
+    @property
+    def n_jobs(self):
+        return self._n_jobs
+
+    @n_jobs.setter
+    def n_jobs(self, new_number):
+        self._n_jobs = new_number
+
+        if not isinstance(self._n_jobs, int) or (self._n_jobs <= 0 and self._n_jobs != -1):
+            self._n_jobs = 1
+            warnings.warn("An exception occured with regard to the input value for the number of jobs. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: 1.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def centroid_method(self):
+        return self._centroid_method
+
+    @centroid_method.setter
+    def centroid_method(self, new_method):
+        self._centroid_method = new_method
+
+        if not isinstance(self._centroid_method, str):
+            self._centroid_method = 'mean'
+            warnings.warn("An exception occured with regard to the input value for the centroid method. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: mean.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+        elif self._centroid_method.lower() != "mean" and self._centroid_method.lower() != "medianoid" and self._centroid_method.lower() != "medoid":
+            self._centroid_method = 'mean'
+            warnings.warn("An exception occured with regard to the input value for the centroid method. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: mean.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def verbose(self):
+        return self._verbose
+
+    @verbose.setter
+    def verbose(self, new_bool):
+        self._verbose = new_bool
+
+        if not isinstance(self._verbose, bool):
+            self._verbose = False
+            warnings.warn("An exception occured with regard to the input value for the verbose option. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: false.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def callback(self):
+        return self._callback
+
+    @callback.setter
+    def callback(self, new_function):
+        self._callback = new_function
+
+        if self._callback is not None and not callable(self._callback):
+            self._callback = None
+            warnings.warn("An exception occured with regard to the input value for the callback. It must be a function, or None.")
+            print("\tIt will be automatically set equal to: None.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def n_init(self):
+        return self._n_init
+
+    @n_init.setter
+    def n_init(self, new_number):
+        self._n_init = new_number
+
+        if not isinstance(self._n_init, int) or self._n_init <= 0:
+            self._n_init = 1
+            warnings.warn("An exception occured with regard to the input value for the number of initializations. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: 1.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def eigen_solver(self):
+        return self._eigen_solver
+
+    @eigen_solver.setter
+    def eigen_solver(self, new_solver):
+        self._eigen_solver = new_solver
+
+        if self._eigen_solver not in eigen_solvers:
+            self._eigen_solver = 'auto'
+            warnings.warn("An exception occured with regard to the input value for the eigensolver. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: auto.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
 
     @staticmethod
     def initialize_clusters(X, k, method):
@@ -409,50 +581,33 @@ class lpca:
             idx = init.fit()
 
         elif method.lower() == 'observations':
-            from scipy.spatial.distance import euclidean, cdist
             #Initialize the centroids using 'k' random observations taken from the
             #dataset.
             C_mat = np.empty((k, X.shape[1]), dtype=float)
-            idx = np.empty((X.shape[0],), dtype=int)
             for ii in range(0,k):
                 C_mat[ii,:] = X[np.random.randint(0,X.shape[0]),:]
 
-            #Compute the euclidean distances between the matrix and all the random vectors
-            #chosen as centroids. The function cdist returns a matrix 'dist' = (nObs x k)
-            dist = cdist(X, C_mat)**2
-
-            #For each observation, choose the nearest centroid (cdist --> Euclidean dist).
+            #For each observation, choose the nearest centroid (squared Euclidean distance)
             #and compute the idx for the initialization.
-            for ii in range(0, X.shape[0]):
-                idx[ii] = np.argmin(dist[ii,:])
+            idx, min_dist = get_nearest_centroids(X, C_mat)
 
         elif method.lower() == 'pkcia':
             #Initialize the centroids with the method described in:
             #Manochandar, S., M. Punniyamoorthy, and R. K. Jeyachitra. Computers & Industrial Engineering (2020): 106290.
             from numpy import linalg as LA
-            from scipy.spatial.distance import euclidean, cdist
-
-            #compute the positive definite matrix Y (n x n) from the training data matrix (n x p),
-            #with n = observations and p = variables
-            Y = X @ X.T
-
-            #compute the eigenvectors and the eigenvalues associated to the new matrix
-            evals, evecs = LA.eig(Y)
-
-            #order the eigens in descending order, as done in PCA
-            mask = np.argsort(evals)[::-1]
-            evecs = evecs[:,mask]
-            evals = evals[mask]
 
-            #consider only the eigenvector associated to the largest eigenvalue, V = (n x 1)
-            V = evecs[:,0]
+            #the eigenvector associated to the largest eigenvalue of the positive definite matrix
+            #Y = X X^T (n x n), with n = observations and p = variables, is the first left singular
+            #vector of X: it is computed from the eigenvector of the (p x p) matrix X^T X, as
+            #V = X v (up to a constant, which does not change G), so Y is never built. V = (n x 1)
+            evecs, evals = symmetric_eigens(X.T @ X, 1)
+            V = X @ evecs[:,0]
 
             #the min and the max of V squared will be useful later
             v_min = np.min(V**2)
             v_max = np.max(V**2)
 
             G = np.empty((len(V),), dtype=float)
-            idx = np.empty((X.shape[0],), dtype=int)
 
             #computation of G is the first step to initialize the centroids:
             for ii in range(0, len(G)):
@@ -482,13 +637,9 @@ class lpca:
                     left_bound = right_bound
                     counter += 1
 
-            #Compute the squared euclidean distances between the matrix and all the random vectors
-            #chosen as centroids. The function cdist returns a matrix 'dist' = (nObs x k)
-            dist = cdist(X, C_mat)**2
-
-            #For each observation, choose the nearest centroid and compute the idx for the initialization.
-            for ii in range(0, X.shape[0]):
-                idx[ii] = np.argmin(dist[ii,:])
+            #For each observation, choose the nearest centroid (squared Euclidean distance)
+            #and compute the idx for the initialization.
+            idx, min_dist = get_nearest_centroids(X, C_mat)
         
         elif method.lower() == 'uniform':
             idx = np.zeros(X.shape[0], dtype=int)
@@ -538,25 +689,32 @@ class lpca:
         idx:        vector whose dimensions are (n,) containing the cluster assignment, WITHOUT EMPTY CLASSES.
         type idx:   numpy array 
         '''
-        k = np.max(idx) +1
-        jj = 0
-        while jj < k:
-            cluster_ = get_cluster(X, idx, jj)
-            if cluster_.shape[0] < 2: #2 or cluster_.shape[1]:
-                if jj > 0:
-                    mask = np.where(idx >=jj)
-                    idx[mask] -= 1
-                else:
-                    mask = np.where(idx >jj)
-                    idx[mask] -= 1
-                print("WARNING:")
-                print("\tAn empty cluster was found:")
-                print("\tThe number of cluster was lowered to ensure statistically meaningful results.")
-                print("\tThe current number of clusters is equal to: {}".format(np.max(idx) +1))
-                k = np.max(idx) +1
-                jj = 0
+        idx = np.asarray(idx, dtype=int)
+        counts = list(np.bincount(idx))
+        #clusters with less than 2 observations (2 or X.shape[1]) are removed, one at the time and
+        #always starting again from the first cluster: a small cluster is merged with the previous
+        #one (the first cluster with the second one). Only the counts are updated at each merge,
+        #and the labels of the observations are changed all at once at the end.
+        labels = np.arange(len(counts))
+        while len(counts) > 1:
+            small = [jj for jj in range(0, len(counts)) if counts[jj] < 2]
+            if len(small) == 0:
+                break
+            jj = small[0]
+            if jj > 0:
+                labels[labels >= jj] -= 1
+                counts[jj-1] += counts.pop(jj)
             else:
-                jj += 1
+                labels[labels > jj] -= 1
+                counts[0] += counts.pop(1)
+            print("WARNING:")
+            print("\tAn empty cluster was found:")
+            print("\tThe number of cluster was lowered to ensure statistically meaningful results.")
+            print("\tThe current number of clusters is equal to: {}".format(len(counts)))
+
+        if len(counts) == len(labels):
+            return idx
+        idx = labels[idx]
 
         return idx
 
@@ -632,11 +790,15 @@ class lpca:
 
 
     @staticmethod
-    def preprocess_training(X, centering_decision, scaling_decision, centering_method, scaling_method):
+    def preprocess_training(X, centering_decision, scaling_decision, centering_method, scaling_method, return_factors=False):
         '''
         Center and scale the matrix X, depending on the bool values
-        centering_decision and scaling_decision
+        centering_decision and scaling_decision. If return_factors is True, the
+        centering and scaling factors are returned as well (zeros and ones if the
+        matrix is not centered or scaled).
         '''
+        mu = np.zeros((X.shape[1],), dtype=float)
+        sigma = np.ones((X.shape[1],), dtype=float)
         if centering_decision and scaling_decision:
             mu, X_ = center(X, centering_method, True)
             sigma, X_tilde = scale(X_, scaling_method, True)
@@ -647,22 +809,520 @@ class lpca:
         else:
             X_tilde = X
 
+        if return_factors:
+            return X_tilde, mu, sigma
+
         return X_tilde
 
 
-    def fit(self):
+    @staticmethod
+    def data_moments(X, block_size):
+        '''
+        Compute the number of observations, the mean, the sum of the squared deviations from the
+        mean, the minimum and the maximum of each variable of the matrix X, reading one block of
+        observations at the time. The moments of the blocks are merged with merge_moments.
+        '''
+        cols = X.shape[1]
+        moments = (0, np.zeros((cols,), dtype=float), np.zeros((cols,), dtype=float), np.full((cols,), np.inf), np.full((cols,), -np.inf))
+
+        for start in range(0, X.shape[0], block_size):
+            X_block = np.asarray(X[start:start+block_size], dtype=float)
+            mean_block = np.mean(X_block, axis=0)
+            M2_block = np.sum((X_block - mean_block)**2, axis=0)
+            moments = lpca.merge_moments(moments, (X_block.shape[0], mean_block, M2_block, np.min(X_block, axis=0), np.max(X_block, axis=0)))
+
+        return moments
+
+
+    @staticmethod
+    def merge_moments(first, second):
+        '''
+        Merge the moments (see data_moments) of two sets of observations with the parallel
+        algorithm by Chan et al., to avoid the loss of precision of the sum of squares.
+        '''
+        n_first, mean_first, M2_first, min_first, max_first = first
+        n_second, mean_second, M2_second, min_second, max_second = second
+        n_obs = n_first + n_second
+        if n_obs == 0:
+            return first
+
+        delta = mean_second - mean_first
+        mean = mean_first + delta * n_second / n_obs
+        M2 = M2_first + M2_second + delta**2 * n_first * n_second / n_obs
+
+        return n_obs, mean, M2, np.minimum(min_first, min_second), np.maximum(max_first, max_second)
+
+
+    @staticmethod
+    def preprocessing_factors(X, centering_decision, scaling_decision, centering_method, scaling_method, block_size, moments=None):
+        '''
+        Compute the centering and scaling factors of the matrix X reading one block of
+        observations at the time. The mean and the variance of the blocks are merged
+        with the parallel algorithm by Chan et al., to avoid the loss of precision of
+        the sum of squares. The factors are the same computed by center and scale.
+        If the moments of X (see data_moments) are given, X is not read.
+
+        
+        --- RETURNS ---
+        mu:         centering factors (zeros if the matrix must not be centered).
+        type mu:    numpy array
+
+        sigma:      scaling factors (ones if the matrix must not be scaled).
+        type sigma: numpy array
+        '''
+        if moments is None:
+            moments = lpca.data_moments(X, block_size)
+        n_obs, mean, M2, minima, maxima = moments
+        cols = len(mean)
+        variances = M2 / n_obs
+
+        mu = np.zeros((cols,), dtype=float)
+        if centering_decision:
+            if centering_method.lower() == 'mean':
+                mu = mean
+            elif centering_method.lower() == 'min':
+                mu = minima
+            else:
+                raise Exception("Unsupported centering option. Please choose: MEAN or MIN.")
+
+        #the scaling factors are computed on the centered matrix, as done by preprocess_training
+        sigma = np.ones((cols,), dtype=float)
+        if scaling_decision:
+            if scaling_method.lower() == 'auto':
+                sigma = np.sqrt(variances)
+            elif scaling_method.lower() == 'pareto':
+                sigma = np.sqrt(np.sqrt(variances))
+            elif scaling_method.lower() == 'vast':
+                sigma = variances / (mean - mu)
+            elif scaling_method.lower() == 'range':
+                sigma = maxima - minima
+            else:
+                raise Exception("Unsupported scaling option. Please choose: AUTO, PARETO, VAST or RANGE.")
+
+        return mu, sigma
+
+
+    def local_models_from_statistics(self, counts, sums, scatters, references=None):
+        '''
+        Compute the centroids and the local PCs of all the clusters from their sufficient
+        statistics, computed about the given reference points (see get_sufficient_statistics).
+        If the adaptive PCs option is active, in each cluster the number of PCs is chosen to
+        explain the 95% of the local variance (as done by PCA.set_PCs).
+
+        --- RETURNS ---
+        centroids:      list with the centroids of the clusters.
+        type centroids: list of k elements
+
+        modes:          list with the local PCs of the clusters.
+        type modes:     list of k elements
+        '''
+        cols = sums.shape[1]
+        #all the eigenvalues are needed only to choose the number of PCs of each cluster
+        n_eig = cols if self._adaptive else self._nPCs
+        centroids, modes, evals = PCA_from_statistics(counts, sums, scatters, n_eig, self.covariance_solver(), references)
+        n_PCs = self.select_PCs(evals)
+        modes_list = [modes[ii][:,:n_PCs[ii]] for ii in range(0, len(counts))]
+
+        return list(centroids), modes_list
+
+
+    def covariance_solver(self):
+        '''
+        Solver used to decompose the local covariance matrices: the solvers for the data
+        matrix ('svd', 'fastSVD' and 'snapshot') are replaced by the full decomposition ('eigh').
+        '''
+        if self._eigen_solver.lower() in ('svd', 'fastsvd', 'snapshot'):
+            return 'eigh'
+        return self._eigen_solver
+
+
+    def select_PCs(self, evals):
+        '''
+        Number of PCs to retain in each cluster: if the adaptive PCs option is active, the
+        number of PCs which explain the 95% of the local variance, otherwise the eigens setting.
+
+        --- PARAMETERS ---
+        evals:          eigenvalues of each cluster, in descending order (k x variables). 
+        type evals :    numpy array
+
+
+        --- RETURNS ---
+        n_PCs:          number of PCs to retain in each cluster.
+        type n_PCs:     numpy array
+        '''
+        cols = evals.shape[1]
+        n_PCs = np.full(evals.shape[0], self._nPCs, dtype=int)
+
+        if self._adaptive:
+            for ii in range(0, evals.shape[0]):
+                explained = np.cumsum(evals[ii]) / (np.sum(evals[ii]) + 1E-16)
+                satisfied = np.flatnonzero(explained[:cols-1] >= 0.95)
+                n_PCs[ii] = satisfied[0] +1 if len(satisfied) > 0 else cols -1
+
+        return n_PCs
+
+
+    def local_centroid(self, cluster, random_state=None):
+        '''
+        Compute the centroid of a cluster, i.e., its mean or its medianoid or its medoid, depending
+        on the centroid_method setting. For large clusters, the medianoids and medoids are approximated
+        to avoid the quadratic cost of the medoids: the observations used for the medoids are sampled
+        with random_state (a numpy RandomState), or with the global generator if it is None.
+        '''
+        large = cluster.shape[0] > self.__exactCentroidSize
+        if self._centroid_method.lower() == 'medianoid':
+            centroids = get_medianoids(cluster, n_bins=self.__medianoidBins if large else None)
+        elif self._centroid_method.lower() == 'medoid':
+            if large:
+                centroids = get_medoids(cluster, n_candidates=self.__medoidCandidates, n_references=self.__exactCentroidSize, random_state=random_state)
+            else:
+                centroids = get_medoids(cluster)
+        else:
+            centroids = get_centroids(cluster)
+
+        return centroids
+
+
+    def build_model(self, idx, factors=None, statistics=None):
+        '''
+        Build the fitted model from the final partition: the centering and scaling factors, and
+        the centroid, the local PCs and the eigenvalues of each cluster are stored in a lpca_model,
+        which can be saved and used to classify or reconstruct new observations without fitting again.
+
+        --- PARAMETERS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment. 
+        type idx :  numpy array
+
+        factors:    centering and scaling factors of the training matrix, if already available (optional).
+        type factors: tuple
+
+        statistics: sufficient statistics (counts, sums, scatters, references) of the clusters of idx
+                    in the preprocessed matrix, if already available (optional, see cluster_statistics).
+        type statistics: tuple
+
+
+        --- RETURNS ---
+        model:      fitted Local PCA model.
+        type model: lpca_model
+        '''
+        k = int(np.max(idx) +1)
+        if factors is None:
+            factors = self.preprocessing_factors(self.X, self._center, self._scale, self._centering, self._scaling, self.X.shape[0])
+        if statistics is None:
+            statistics = self.cluster_statistics(idx, k)
+        mu, sigma = factors
+        counts, sums, scatters, references = statistics
+        model = self.model_from_statistics(mu, sigma, counts, sums, scatters, idx, references)
+
+        if self._centroid_method.lower() != 'mean':
+            order, offsets = get_membership(idx, k)
+            for ii in range(0, k):
+                model.centroids[ii] = self.local_centroid(self.X_tilde[order[offsets[ii]:offsets[ii+1]]])
+
+        return model
+
+
+    def cluster_statistics(self, idx, k, references=None):
+        '''
+        Compute the sufficient statistics of the clusters of idx in the preprocessed matrix,
+        about the given reference points or, if they are not given, about the clusters' means
+        (see get_sufficient_statistics).
+
+        --- RETURNS ---
+        statistics:         counts, sums, scatters and reference points of the clusters.
+        type statistics:    tuple
+        '''
+        if references is None:
+            references = get_cluster_statistics(self.X_tilde, idx, k, covariances=False)[1]
+        counts, sums, scatters = get_sufficient_statistics(self.X_tilde, idx, k, references)
+
+        return counts, sums, scatters, references
+
+
+    def local_reconstruction_errors(self, idx):
+        '''
+        Compute the squared reconstruction error of each observation with respect to the final
+        local model (self.model) of the cluster it has been assigned to.
+
+        --- PARAMETERS ---
+        idx:        vector whose dimensions are (n,) containing the final cluster assignment. 
+        type idx :  numpy array
+
+
+        --- RETURNS ---
+        local_errors:       squared reconstruction error of each observation (n,).
+        type local_errors:  numpy array
+        '''
+        local_errors = np.zeros((self.X_tilde.shape[0],), dtype=float)
+        order, offsets = get_membership(idx, self.model.k)
+        for ii in range(0, self.model.k):
+            members = order[offsets[ii]:offsets[ii+1]]
+            if len(members) > 0:
+                local_errors[members] = get_reconstruction_errors(self.X_tilde[members], [self.model.centroids[ii]], [self.model.local_modes(ii)])[:,0]
+
+        return local_errors
+
+
+    def model_from_statistics(self, mu, sigma, counts, sums, scatters, idx=None, references=None):
+        '''
+        Build the fitted model (lpca_model) from the preprocessing factors and the sufficient
+        statistics of the clusters (see get_sufficient_statistics).
+        '''
+        k, cols = sums.shape
+        centroids, modes, evals = PCA_from_statistics(counts, sums, scatters, cols, self.covariance_solver(), references)
+        n_PCs = self.select_PCs(evals)
+
+        #the modes are stored with the same number of columns: the ones which are not retained are null
+        modes = modes[:, :, :np.max(n_PCs)].copy()
+        for ii in range(0, k):
+            modes[ii, :, n_PCs[ii]:] = 0
+
+        return lpca_model(mu, sigma, centroids, modes, evals, n_PCs, idx)
+
+
+
+    def compute_rec_error(self, ii, centroids, modes, sq_rec_err):
+        '''
+        Compute the rec error of all the observations with respect to the local manifold
+        of the ii-th cluster, and store it in the ii-th column of sq_rec_err.
+        '''
+        get_reconstruction_errors(self.X_tilde, [centroids[ii]], [modes[ii]], out=sq_rec_err[:,ii:ii+1])
+
+
+    def fit_local_cluster(self, ii, membership, sq_rec_err, seed=None):
+        '''
+        Perform PCA in the ii-th cluster, and compute the rec error of all the observations
+        with respect to its local manifold, which is stored in the ii-th column of sq_rec_err.
+
+        --- PARAMETERS ---
+        ii:         number of the cluster. 
+        type ii :   scalar
+
+        membership:         observations sorted by cluster and offsets of each cluster (see get_membership). 
+        type membership :   tuple
+
+        sq_rec_err:         matrix whose dimensions are (n x k), where the rec error is stored. 
+        type sq_rec_err :   numpy array
+
+        seed:       seed of the iteration, used with the cluster number to sample the observations for
+                    the approximated medoids, so that the result does not depend on the order of the tasks. 
+        type seed : scalar
+
+
+        --- RETURNS ---
+        centroids:      centroid (medianoid or medoid) of the cluster.
+        type centroids: numpy array 
+
+        modes:          local PCs of the cluster.
+        type modes:     numpy array 
+        '''
+        #group the observations of a certain cluster
+        order, offsets = membership
+        cluster = self.X_tilde[order[offsets[ii]:offsets[ii+1]]]
+        #compute the centroids, or the medianoids or the medoids, depending on the 
+        #selected choice
+        random_state = None if seed is None else np.random.RandomState([seed, ii])
+        centroids = self.local_centroid(cluster, random_state)
+        #perform PCA in the cluster, centering and scaling can be avoided
+        #because the observations are already standardized
+        local_model = model_order_reduction.PCA(cluster)
+        local_model.to_center = False
+        local_model.to_scale = False
+        local_model.eigen_solver = self._eigen_solver
+        if not self._adaptive:
+            local_model.eigens = self._nPCs
+            modes = local_model.fit()
+        else:
+            #set_PCs leaves the local model fitted with the selected number of PCs
+            local_model.set_PCs()
+            modes = local_model.evecs, local_model.evals
+        #compute the rec error for the considered cluster
+        get_reconstruction_errors(self.X_tilde, [centroids], [modes[0]], out=sq_rec_err[:,ii:ii+1])
+
+        return centroids, modes[0]
+
+
+    def fit_restarts(self):
+        '''
+        Run the lpca algorithm n_init times with different random seeds, in a pool of
+        n_jobs processes, and keep the solution with the lowest final reconstruction error.
+        The final errors of all the runs are stored in restart_errors.
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
+        type idx:   numpy array 
+        '''
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+
+        #all the runs would give the same solution
+        if self._method.lower() in ("uniform", "pkcia"):
+            warnings.warn("The {} initialization is deterministic: all the {} runs would be equal.".format(self._method, self._n_init))
+            print("\tThe algorithm will be run only once.")
+            n_init = self._n_init
+            self._n_init = 1
+            try:
+                idx = self.fit()
+            finally:
+                self._n_init = n_init
+            self.restart_errors = np.array([self.reconstruction_error])
+            return idx
+        if self._callback is not None:
+            warnings.warn("The callback is not called when the algorithm is run with n_init > 1.")
+
+        if self._verbose:
+            print("Fitting Local PCA model with {} different initializations...".format(self._n_init))
+        if self._writeFolder:
+            lpca.set_environment()
+            lpca.write_recap_text(self._k, self._nPCs, self._correction, self._method)
+
+        #the seeds are drawn from the global generator, so the runs are reproducible
+        seeds = np.random.randint(0, 2**31 -1, size=self._n_init)
+        n_workers = os.cpu_count() if self._n_jobs == -1 else self._n_jobs
+        n_workers = min(n_workers, self._n_init)
+
+        if n_workers <= 1:
+            _set_restart_model(self)
+            results = [_fit_lpca_restart(seed) for seed in seeds]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_restart_model, initargs=(self,)) as pool:
+                results = list(pool.map(_fit_lpca_restart, seeds))
+
+        #keep the best solution
+        self.restart_errors = np.array([result[1] for result in results])
+        best = int(np.argmin(self.restart_errors))
+        idx, self.reconstruction_error, self._k, self.iterations = results[best]
+        self.X_tilde, mu, sigma = self.preprocess_training(self.X, self._center, self._scale, self._centering, self._scaling, True)
+        self.model = self.build_model(idx, (mu, sigma))
+        self.local_errors = self.local_reconstruction_errors(idx)
+
+        if self._verbose:
+            print("Final reconstruction error of the {} runs:".format(self._n_init))
+            print("\tBest: {}".format(np.min(self.restart_errors)))
+            print("\tMean: {}".format(np.mean(self.restart_errors)))
+            print("\tWorst: {}".format(np.max(self.restart_errors)))
+            print("\tStandard deviation: {}".format(np.std(self.restart_errors)))
+        if self._writeFolder:
+            lpca.write_final_stats(self.iterations, self.reconstruction_error)
+
+        return idx
+
+
+    def split_worst_cluster(self, idx):
+        '''
+        Split in two parts the cluster with the largest total reconstruction error of the last fit.
+        The observations of the cluster are separated depending on the sign of their score on
+        the first local PC, and the ones with a positive score are moved to a new cluster.
+
+        --- PARAMETERS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment of the last fit
+                    (the errors of the observations are taken from local_errors).
+        type idx :  numpy array
+
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment with k+1 clusters.
+        type idx:   numpy array 
+        '''
+        k = np.max(idx) +1
+        idx = np.array(idx, copy=True)
+        cluster_error = np.bincount(idx, weights=self.local_errors, minlength=k)
+        #clusters with less than two observations cannot be split
+        cluster_error[np.bincount(idx, minlength=k) < 2] = -np.inf
+        worst = np.argmax(cluster_error)
+
+        members = np.flatnonzero(idx == worst)
+        cluster = self.X_tilde[members,:]
+        cluster_ = cluster - np.mean(cluster, axis=0)
+        evecs, evals = symmetric_eigens(cluster_.T @ cluster_, 1, self.covariance_solver())
+        scores = cluster_ @ evecs[:,0]
+        #do not leave one of the two halves empty if all the scores have the same sign
+        if np.all(scores > 0) or np.all(scores <= 0):
+            scores = scores - np.median(scores)
+        idx[members[scores > 0]] = k
+
+        return idx
+
+
+    def fit_path(self, final_k):
+        '''
+        Fit the lpca models for all the number of clusters between the current one (clusters setting)
+        and final_k. Only the first model is initialized with the selected initialization method: each
+        following solution is warm started from the previous one, splitting the cluster with the
+        largest reconstruction error (see split_worst_cluster). The number of clusters of each
+        solution, which can be lower than the requested one if small clusters are merged during
+        the fit, is stored in k_path.
+
+        --- PARAMETERS ---
+        final_k:        largest number of clusters to fit. 
+        type final_k :  scalar
+
+
+        --- RETURNS ---
+        idx_path:       list with the cluster assignment vectors, (n,), for each number of clusters.
+        type idx_path:  list
+
+        rec_errors:     vector containing the final reconstruction error for each number of clusters.
+        type rec_errors:numpy array 
+        '''
+        if not isinstance(final_k, int) or final_k < self._k:
+            raise Exception("The final number of clusters must be an integer larger than the initial one.")
+
+        #the folder and the recap are written only once for the whole path
+        write_folder = self._writeFolder
+        if write_folder:
+            lpca.set_environment()
+            lpca.write_recap_text(self._k, self._nPCs, self._correction, self._method)
+        self._writeFolder = False
+
+        idx_path = []
+        rec_errors = []
+        self.k_path = []
+        initial_k = self._k
+        try:
+            for target_k in range(initial_k, final_k +1):
+                if target_k == initial_k:
+                    idx = self.fit()
+                else:
+                    while np.max(idx) +1 < target_k:
+                        idx = self.split_worst_cluster(idx)
+                    idx = self.fit(idx)
+                idx_path.append(idx)
+                rec_errors.append(self.reconstruction_error)
+                self.k_path.append(int(np.max(idx) +1))
+        finally:
+            self._writeFolder = write_folder
+
+        return idx_path, np.array(rec_errors)
+
+
+    def fit(self, idx_init=None):
         '''
         Group the observations depending on the PCA reconstruction error.
+        If n_init > 1, the algorithm is run several times with different random
+        seeds and the solution with the lowest reconstruction error is returned.
+        The fitted model (centering and scaling factors, centroids, local PCs and
+        eigenvalues of the final clusters) is stored in self.model (see lpca_model).
+
+        --- PARAMETERS ---
+        idx_init:       optional vector (n,) with a previous clustering solution, used to warm start
+                        the algorithm instead of the selected initialization method. In this case, the
+                        number of clusters is set to max(idx_init) +1 and n_init is ignored.
+        type idx_init:  numpy array
 
         --- RETURNS ---
         idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
         type idx:   numpy array 
         
         '''
+        if self._n_init > 1 and idx_init is None:
+            return self.fit_restarts()
         #Center and scale the original training dataset
-        print("Preprocessing training matrix..")
-        self.X_tilde = self.preprocess_training(self.X, self._center, self._scale, self._centering, self._scaling)
-        print("Fitting Local PCA model...")
+        if self._verbose:
+            print("Preprocessing training matrix..")
+        self.X_tilde, mu, sigma = self.preprocess_training(self.X, self._center, self._scale, self._centering, self._scaling, True)
+        if self._verbose:
+            print("Fitting Local PCA model...")
         if self._writeFolder:
             lpca.set_environment()
             lpca.write_recap_text(self._k, self._nPCs, self._correction, self._method)
@@ -670,130 +1330,81 @@ class lpca:
         iteration, eps_rec, residuals, iter_max, eps_tol = lpca.initialize_parameters()
         rows, cols = np.shape(self.X_tilde)
         # Initialize the solution vector
-        idx = lpca.initialize_clusters(self.X_tilde, self._k, self._method)
+        if idx_init is not None:
+            idx = np.array(idx_init, dtype=int)
+            self._k = np.max(idx) +1
+        else:
+            idx = lpca.initialize_clusters(self.X_tilde, self._k, self._method)
         residuals = np.array(0)
+        #the rec errors are stored in the same (observations x k) matrix at each iteration
+        sq_rec_err = np.empty((rows, self._k), dtype=float)
+        #if the centroids are the clusters' means, the local models are computed from the sufficient
+        #statistics of the clusters, updated at each iteration only with the observations which moved.
+        #They are computed about the clusters' means, and computed again every few iterations
+        use_statistics = self._centroid_method.lower() == 'mean'
+        if use_statistics:
+            counts, sums, scatters, references = self.cluster_statistics(idx, self._k)
+            #number of updates since the statistics were computed
+            n_updates = 0
         if self._correction != "off":
             correction_ = np.zeros((rows, self._k), dtype=float)
             scores_factor = np.zeros((rows, self._k), dtype=float)
+        #quantities which do not change during the iterations, shared by the correction factors
+        self._correction_cache = {}
         # Iterate
         while(iteration < iter_max):
-            sq_rec_oss = np.zeros((rows, cols), dtype=float)
-            sq_rec_err = np.zeros((rows, self._k), dtype=float)
-
-            if self._correction == 'phc_multi':
-                PHC_coefficients, PHC_std = evaluate_clustering_PHC(self.X, idx, method='phc_standard')   #PHC_index(self.X, idx) or PHC_robustTrim(self.X, idx)
-                PHC_coefficients = PHC_coefficients/np.max(PHC_coefficients)
-
-            for ii in range(0, self._k):
-                #group the observations of a certain cluster
-                cluster = get_cluster(self.X_tilde, idx, ii)
-                #compute the centroids, or the medianoids or the medoids, depending on the 
-                #selected choice
-                if self._correction.lower() != 'medianoids' and self._correction.lower() != 'medoids':
-                    centroids = get_centroids(cluster)
-                elif self.correction.lower() == 'medianoids':
-                    centroids = get_medianoids(cluster)
-                elif self.correction.lower() == 'medoids':
-                    centroids = get_medoids(cluster)
-                #perform PCA in the cluster, centering and scaling can be avoided
-                #because the observations are already standardized
-                local_model = model_order_reduction.PCA(cluster)
-                local_model.to_center = False
-                local_model.to_scale = False
-                if not self._adaptive:
-                    local_model.eigens = self._nPCs
-                else:
-                    local_model.set_PCs()
-                modes = local_model.fit()
-                #create the centroids (medoids or medianoids, respectively) matrix
-                C_mat = np.matlib.repmat(centroids, rows, 1)
-                #compute the rec error for the considered cluster
-                rec_err_os = (self.X_tilde - C_mat) - (self.X_tilde - C_mat) @ modes[0] @ modes[0].T
-                sq_rec_oss = np.power(rec_err_os, 2)
-                sq_rec_err[:,ii] = sq_rec_oss.sum(axis=1)
-                
-                #use a penalty to eventually enhance the clustering performances
-                if self.correction.lower() == "c_range":
-                    #add a penalty if the observations are not in the centroids neighbourhood
-
-                    #compute the cluster considering the raw data, and compute
-                    #the cluster's centroids
-                    cluster2 = get_cluster(self.X, idx, ii)
-                    centroids2 = get_centroids(cluster2)  
-                    #compute the range for the centroid values: /2 = +-50%, /3 = +- 33% etc.
-                    C_mStar = centroids2/2      
-                    #lower bound: centroid - interval
-                    check1 = centroids2 - C_mStar
-                    #upper boundL centroid + interval
-                    check2 = centroids2 + C_mStar       
-                    #boolean matrix initialization as matrix of ones    
-                    boolean_mat = np.ones(self.X_tilde.shape)
-                    count = 0
-
-                    #for each element of the raw data matrix, check if it's in the interval.
-                    #If yes, put 0 in the boolean matrix
-                    for mm in range(0, self.X.shape[0]):
-                        for nn in range(0, self.X.shape[1]):
-                            if self.X[mm,nn] >= check1[nn] and self.X[mm,nn] <= check2[nn]:
-                                boolean_mat[mm,nn] = 0                                               
-                                count +=1         
-                    #For each row, sum up all the columns to obtain the multiplicative correction coefficient                                                  
-                    yo = np.sum(boolean_mat, axis=1)
-                    scores_factor[:,ii] = sq_rec_err[:,ii] * yo
-                    #activate the option to take into account the penalty in the error
-                    self.__activateCorrection = True
-                
-                elif self._correction.lower() == "uncorrelation":
-                    #the clusters where the observations maximize the uncorrelation are favoured
-                    maxF = np.max(np.var((self.X_tilde - C_mat) @ modes[0], axis=0))
-                    minF = np.min(np.var((self.X_tilde - C_mat) @ modes[0], axis=0))
-                    yo = 1-minF/maxF
-                    
-                    scores_factor[:,ii] = sq_rec_err[:,ii] * yo
-                    self.__activateCorrection = True
-
-                elif self._correction.lower() == "local_variance":
-                    #try to assign the observations to each cluster such that the
-                    #variance in that cluster is minimized, i.e., the variables are
-                    #more homogeneous
-                    cluster2 = get_cluster(self.X, idx, ii)
-                    yo = np.mean(np.var(cluster2))
-                    scores_factor[:,ii] = sq_rec_err[:,ii] * yo
-                    self.__activateCorrection = True
-
-                elif self._correction.lower() == "phc_multi":
-                    #assign the clusters to minimize the PHC 
-                    local_homogeneity = PHC_coefficients[ii]
-                    scores_factor[:,ii] = sq_rec_err[:,ii] * local_homogeneity
-                    self.__activateCorrection = True
-                
-                elif self._correction.lower() == "local_skewness":
-                    #assign the clusters to minimize the variables' skewness
-                    from scipy.stats import skew
-
-                    yo = np.mean(skew(cluster, axis=0))
-                    scores_factor[:,ii] = sq_rec_err[:,ii] * yo
-                    self.__activateCorrection = True
-                
-                else:
-                    pass                            
+            centroids_list = [None] *self._k
+            modes_list = [None] *self._k
+            timings = {}
+            start_time = time.perf_counter()
+
+            #fit the local PCA models and compute the rec errors, eventually in parallel:
+            #the clusters are independent, and each task writes only its own column
+            if use_statistics:
+                centroids_list, modes_list = self.local_models_from_statistics(counts, sums, scatters, references)
+                parallel_map(functools.partial(self.compute_rec_error, centroids=centroids_list, modes=modes_list, sq_rec_err=sq_rec_err), range(0, self._k), self._n_jobs)
+            else:
+                membership = get_membership(idx, self._k)
+                #the medoids are sampled with a generator for each cluster, seeded from the global one
+                seed = np.random.randint(0, 2**31 -1) if self._centroid_method.lower() == 'medoid' else None
+                local_models = parallel_map(functools.partial(self.fit_local_cluster, membership=membership, sq_rec_err=sq_rec_err, seed=seed), range(0, self._k), self._n_jobs)
+                for ii in range(0, self._k):
+                    centroids_list[ii], modes_list[ii] = local_models[ii]
+            timings["local_models"] = time.perf_counter() - start_time
+
+            #use a penalty to eventually enhance the clustering performances: the correction
+            #factors of all the clusters are computed together (see register_correction), from
+            #the statistics of the raw clusters computed once per iteration (without covariances)
+            if self._correction in lpca_corrections:
+                statistics = get_cluster_statistics(self.X, idx, self._k, covariances=False)[:4]
+                factors = lpca_corrections[self._correction](self, idx, centroids_list, modes_list, statistics)
+                np.multiply(sq_rec_err, factors, out=scores_factor)
+                self.__activateCorrection = True
+            timings["correction"] = time.perf_counter() - start_time - timings["local_models"]
             # Update idx --> choose the cluster where the rec err is minimized
+            start_time = time.perf_counter()
+            idx_old = idx
             if self.__activateCorrection == True:
                 idx = np.argmin(scores_factor, axis = 1)
             else:
                 idx = np.argmin(sq_rec_err, axis = 1)
+            labels_changed = np.count_nonzero(idx != idx_old)
             # Update convergence
             rec_err_min = np.min(sq_rec_err, axis = 1)
             eps_rec_new = np.mean(rec_err_min, axis = 0)
             eps_rec_var = np.abs((eps_rec_new - eps_rec) / (eps_rec_new) + eps_tol)
             eps_rec = eps_rec_new
+            timings["partition"] = time.perf_counter() - start_time
             # Print info
-            print("- Iteration number: {}".format(iteration+1))
-            print("\tReconstruction error: {}".format(eps_rec_new))
-            print("\tReconstruction error variance: {}".format(eps_rec_var))
+            if self._verbose:
+                print("- Iteration number: {}".format(iteration+1))
+                print("\tReconstruction error: {}".format(eps_rec_new))
+                print("\tReconstruction error variance: {}".format(eps_rec_var))
+            stop = self._callback is not None and self._callback({"iteration": iteration+1, "error": eps_rec_new, "variation": eps_rec_var, "labels_changed": labels_changed, "timings": timings})
             # Check convergence condition
-            if (eps_rec_var <= eps_tol):
-                lpca.write_final_stats(iteration, eps_rec)
+            if (eps_rec_var <= eps_tol) or stop:
+                if self._writeFolder:
+                    lpca.write_final_stats(iteration, eps_rec)
                 break
             else:
                 residuals = np.append(residuals, eps_rec_new)
@@ -802,22 +1413,925 @@ class lpca:
             # Consider only statistical meaningful groups of points: if there are <2 points
             #in a cluster, delete it because it's not statistically meaningful
             idx = lpca.merge_clusters(self.X_tilde, idx)
-            self._k = max(idx) +1
-        print("Convergence reached in {} iterations.".format(iteration))
+            if max(idx) +1 != self._k:
+                self._k = max(idx) +1
+                sq_rec_err = np.empty((rows, self._k), dtype=float)
+                if self._correction != "off":
+                    scores_factor = np.zeros((rows, self._k), dtype=float)
+                if use_statistics:
+                    counts, sums, scatters, references = self.cluster_statistics(idx, self._k)
+                    n_updates = 0
+            elif use_statistics:
+                #if most of the observations moved, it is cheaper to recompute the statistics, about
+                #the current centroids (the means of the previous partition)
+                if labels_changed > rows/2 or n_updates >= self.__statisticsUpdates:
+                    counts, sums, scatters, references = self.cluster_statistics(idx, self._k, np.array(centroids_list))
+                    n_updates = 0
+                else:
+                    update_sufficient_statistics(self.X_tilde, idx_old, idx, counts, sums, scatters, references)
+                    n_updates += 1
+        if self._verbose:
+            print("Convergence reached in {} iterations.".format(iteration))
         #lpca.plot_residuals(iteration, residuals)
+        self.iterations = iteration
+        self.reconstruction_error = eps_rec
+        #the loop can stop before the small clusters of the last partition are removed
+        idx = lpca.merge_clusters(self.X_tilde, idx)
+        self._k = int(np.max(idx) +1)
+        #the sufficient statistics of the final partition are computed again, about the last centroids
+        statistics = None
+        if use_statistics and len(centroids_list) == self._k:
+            statistics = self.cluster_statistics(idx, self._k, np.array(centroids_list))
+        self.model = self.build_model(idx, (mu, sigma), statistics)
+        self.local_errors = self.local_reconstruction_errors(idx)
         return idx
 
 
-class fpca(lpca):
+class lpca_model:
     '''
-    Supervised partitioning based on an a-priori conditioning (and subsequent dim reduction), by means
-    of a selected variable which is known to be important for the process. As it
-    is not an iterative algorithm, it allows for a faster clustering in comparison with
-    lpca via Vector Quantization, even if the choice of the optimal variable could constitute a
-    difficult task for some applications, as it requires prior knowledge on the process, and the choice must
-    be assessed case-by-case. For non-premixed, turbulent combustion applications, the
-    mixture fraction Z is an optimal variable for the data conditioning, leading to excellent
-    results both for data compression and interpretation tasks.
+    Fitted Local PCA model, i.e., all the quantities needed to classify new observations
+    or to reconstruct them from the local manifolds without fitting again: the centering
+    and scaling factors of the training data, and the centroid, the local PCs and the
+    eigenvalues of each cluster (all in the centered and scaled space).
+    The model is stored by lpca.fit() in lpca.model, and it can be saved in a binary
+    (uncompressed) .npz file, which can be loaded back with the arrays memory-mapped:
+    nothing is read from the disk until it is used.
+
+    --- PARAMETERS ---
+    mu:             centering factors of the training data (variables).
+    type mu:        numpy array
+
+    sigma:          scaling factors of the training data (variables).
+    type sigma:     numpy array
+
+    centroids:      centroid of each cluster (k x variables).
+    type centroids: numpy array
+
+    modes:          local PCs of each cluster (k x variables x q). If a cluster retains
+                    less than q PCs, the remaining columns are null.
+    type modes:     numpy array
+
+    eigenvalues:    eigenvalues of each cluster, in descending order (k x variables).
+    type eigenvalues: numpy array
+
+    n_PCs:          number of PCs retained in each cluster (k). Default: q in all the clusters.
+    type n_PCs:     numpy array
+
+    idx:            cluster assignment of the training observations (n). Optional.
+    type idx:       numpy array
+    '''
+    def __init__(self, mu, sigma, centroids, modes, eigenvalues, n_PCs=None, idx=None):
+        self.mu = mu
+        self.sigma = sigma
+        self.centroids = centroids
+        self.modes = modes
+        self.eigenvalues = eigenvalues
+        if n_PCs is None:
+            n_PCs = np.full(modes.shape[0], modes.shape[2], dtype=int)
+        self.n_PCs = n_PCs
+        self.idx = idx
+
+    @property
+    def k(self):
+        return self.centroids.shape[0]
+
+    def local_modes(self, ii):
+        '''
+        Return the local PCs retained in the ii-th cluster.
+        '''
+        return self.modes[ii][:, :self.n_PCs[ii]]
+
+    def preprocess(self, X):
+        '''
+        Center and scale the observations X with the factors of the training data.
+        '''
+        return center_scale(np.asarray(X, dtype=float), self.mu, self.sigma)
+
+    def classify(self, Y, block_size=None):
+        '''
+        Assign each observation of Y (raw, uncentered and unscaled) to the cluster whose
+        local manifold minimizes the reconstruction error.
+
+        --- PARAMETERS ---
+        Y:          RAW data matrix (observations x variables). 
+        type Y :    numpy array
+
+        block_size:         number of observations processed at the same time (see get_reconstruction_errors). 
+        type block_size :   scalar
+
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment.
+        type idx:   numpy array 
+        '''
+        Y_tilde = self.preprocess(Y)
+        modes = [self.local_modes(ii) for ii in range(0, self.k)]
+        sq_rec_err = get_reconstruction_errors(Y_tilde, list(self.centroids), modes, block_size=block_size)
+
+        return np.argmin(sq_rec_err, axis=1)
+
+    def recover(self, X, idx):
+        '''
+        Reconstruct the observations X (raw, uncentered and unscaled) from the local manifolds
+        of the clusters they are assigned to, given by idx.
+
+        --- RETURNS ---
+        X_rec:      reconstructed matrix, uncentered and unscaled (observations x variables).
+        type X_rec: numpy array 
+        '''
+        X_tilde = self.preprocess(X)
+        X_rec = np.empty(X_tilde.shape, dtype=float)
+        order, offsets = get_membership(idx, self.k)
+
+        for ii in range(0, self.k):
+            positions = order[offsets[ii]:offsets[ii+1]]
+            modes = self.local_modes(ii)
+            cluster_ = X_tilde[positions] - self.centroids[ii]
+            X_rec[positions] = (cluster_ @ modes) @ modes.T + self.centroids[ii]
+
+        return uncenter(unscale(X_rec, self.sigma), self.mu)
+
+    def arrays(self):
+        '''
+        Return the arrays of the model, with the names used in the .npz file.
+        '''
+        arrays = {"mu": self.mu, "sigma": self.sigma, "centroids": self.centroids, "modes": self.modes,
+                    "eigenvalues": self.eigenvalues, "n_PCs": self.n_PCs}
+        if self.idx is not None:
+            arrays["idx"] = self.idx
+
+        return arrays
+
+    def save(self, path):
+        '''
+        Save the model in a binary .npz file. The file is not compressed,
+        so it can be loaded memory-mapped (see lpca_model.load).
+        '''
+        np.savez(path, **self.arrays())
+
+    @staticmethod
+    def load(path, mmap=True):
+        '''
+        Load a model saved with lpca_model.save. If mmap is True, the arrays are memory-mapped
+        from the .npz file (see lpca_model.read_arrays).
+
+        --- PARAMETERS ---
+        path:       path to the .npz file. 
+        type path : string
+
+        mmap:       memory-map the arrays instead of reading them. 
+        type mmap : boolean
+
+
+        --- RETURNS ---
+        model:      the loaded Local PCA model.
+        type model: lpca_model
+        '''
+        return lpca_model.from_arrays(lpca_model.read_arrays(path, mmap))
+
+    @staticmethod
+    def from_arrays(arrays):
+        '''
+        Build the model from a dictionary with its arrays (see lpca_model.arrays).
+        '''
+        return lpca_model(arrays["mu"], arrays["sigma"], arrays["centroids"], arrays["modes"], arrays["eigenvalues"], arrays["n_PCs"], arrays.get("idx"))
+
+    @staticmethod
+    def read_arrays(path, mmap=True):
+        '''
+        Read all the arrays of an uncompressed .npz file. If mmap is True, the arrays are
+        memory-mapped: the position of each array in the archive is computed from the zip
+        and .npy headers, and only these are read.
+        '''
+        import zipfile
+        import struct
+
+        arrays = {}
+        not_mapped = []
+        if not mmap:
+            with np.load(path) as archive:
+                for name in archive.files:
+                    arrays[name] = archive[name]
+        else:
+            with zipfile.ZipFile(path) as archive, open(path, "rb") as file_:
+                for member in archive.infolist():
+                    if member.compress_type != zipfile.ZIP_STORED:
+                        raise Exception("The arrays of a compressed archive cannot be memory-mapped.")
+                    #the length of the local header of the member is not stored in the central directory
+                    file_.seek(member.header_offset)
+                    local_header = file_.read(30)
+                    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+                    file_.seek(member.header_offset + 30 + name_length + extra_length)
+                    #read the .npy header, the data follow it
+                    version = np.lib.format.read_magic(file_)
+                    name = member.filename[:-4] if member.filename.endswith(".npy") else member.filename
+                    if version == (1, 0):
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file_)
+                    elif version == (2, 0):
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file_)
+                    else:
+                        #other versions of the format are read by np.load
+                        not_mapped.append(name)
+                        continue
+                    if dtype.hasobject:
+                        not_mapped.append(name)
+                    elif int(np.prod(shape)) == 0:
+                        arrays[name] = np.empty(shape, dtype=dtype)
+                    else:
+                        arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=file_.tell(), shape=shape, order="F" if fortran_order else "C")
+            if not_mapped:
+                with np.load(path, allow_pickle=True) as archive:
+                    for name in not_mapped:
+                        arrays[name] = archive[name]
+
+        return arrays
+
+
+#Correction factors available for lpca. Each correction is a function
+#(model, idx, centroids, modes, statistics) -> factors, where statistics are the counts,
+#centroids, minima and maxima of the raw clusters (see get_cluster_statistics), and factors
+#is an array which can be broadcasted to the (observations x k) matrix of the rec errors,
+#i.e., with dimensions (k,) or (n x k). The rec errors are multiplied by the factors before
+#the partition.
+lpca_corrections = {}
+
+def register_correction(name):
+    '''
+    Decorator to add a correction factor to the ones available for lpca. The name
+    used to register the function is the one to use in the "correction_factor"
+    setting, or with the correction setter.
+    '''
+    def decorator(function):
+        lpca_corrections[name] = function
+        return function
+    return decorator
+
+
+@register_correction("c_range")
+def c_range_correction(model, idx, centroids, modes, statistics):
+    '''
+    Add a penalty if the observations are not in the centroids neighbourhood: for each
+    observation, the factor is the number of variables out of the interval centroid +-50%,
+    where the centroids are computed considering the raw data.
+    '''
+    k = len(centroids)
+    counts, raw_centroids, minima, maxima = statistics
+    #compute the range for the centroid values: /2 = +-50%, /3 = +- 33% etc.
+    C_mStar = raw_centroids/2
+    check1 = raw_centroids - C_mStar
+    check2 = raw_centroids + C_mStar
+
+    factors = np.empty((model.X.shape[0], k), dtype=float)
+    for ii in range(0, k):
+        outside = (model.X < check1[ii]) | (model.X > check2[ii])
+        factors[:,ii] = np.count_nonzero(outside, axis=1)
+
+    return factors
+
+
+@register_correction("uncorrelation")
+def uncorrelation_correction(model, idx, centroids, modes, statistics):
+    '''
+    The clusters where the observations maximize the uncorrelation are favoured. The variance
+    of the scores of all the observations on the local PCs is given by A^T C A, with C the
+    covariance matrix of the training data, which is computed only once.
+    '''
+    if "covariance" not in model._correction_cache:
+        model._correction_cache["covariance"] = np.cov(model.X_tilde, rowvar=False)
+    C = model._correction_cache["covariance"]
+
+    factors = np.empty(len(modes), dtype=float)
+    for ii in range(0, len(modes)):
+        scores_variance = np.einsum('ij,ik,kj->j', modes[ii], C, modes[ii])
+        factors[ii] = 1 - np.min(scores_variance)/np.max(scores_variance)
+
+    return factors
+
+
+@register_correction("local_variance")
+def local_variance_correction(model, idx, centroids, modes, statistics):
+    '''
+    Try to assign the observations to each cluster such that the variance in that cluster
+    is minimized, i.e., the variables are more homogeneous. The factor is the variance of
+    all the entries of the raw cluster.
+    '''
+    counts, raw_centroids, minima, maxima = statistics
+    n_obs = np.maximum(counts, 1)
+    cols = model.X.shape[1]
+    #squared deviations of the entries from the mean of their variable in the cluster, and
+    #then from the mean of all the entries of the cluster
+    deviations = model.X - raw_centroids[idx]
+    sum_squares = np.bincount(idx, weights=np.einsum('ij,ij->i', deviations, deviations), minlength=len(centroids))
+    entries_mean = np.mean(raw_centroids, axis=1)
+    factors = (sum_squares + n_obs * np.sum((raw_centroids - entries_mean[:,np.newaxis])**2, axis=1))/(n_obs*cols)
+
+    return factors
+
+
+@register_correction("phc_multi")
+def phc_multi_correction(model, idx, centroids, modes, statistics):
+    '''
+    Assign the clusters to minimize the PHC, computed on the raw data and normalized
+    with respect to its maximum value.
+    '''
+    TOL = 1E-16
+    counts, raw_centroids, minima, maxima = statistics
+    PHC_coefficients = np.mean((maxima - minima)/(raw_centroids +TOL), axis=1)
+
+    return PHC_coefficients/np.max(PHC_coefficients)
+
+
+@register_correction("local_skewness")
+def local_skewness_correction(model, idx, centroids, modes, statistics):
+    '''
+    Assign the clusters to minimize the variables' skewness: the factor is the mean
+    skewness of the variables in each cluster (biased estimator, as scipy.stats.skew).
+    '''
+    k = len(centroids)
+    order, offsets = get_membership(idx, k)
+    counts = np.diff(offsets)
+    factors = np.zeros(k, dtype=float)
+
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty) > 0:
+        starts = offsets[:-1][nonempty]
+        X_sorted = model.X_tilde[order[:offsets[-1]]]
+        means = np.add.reduceat(X_sorted, starts, axis=0) / counts[nonempty, np.newaxis]
+        X_sorted -= np.repeat(means, counts[nonempty], axis=0)
+        m2 = np.add.reduceat(X_sorted**2, starts, axis=0) / counts[nonempty, np.newaxis]
+        m3 = np.add.reduceat(X_sorted**3, starts, axis=0) / counts[nonempty, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skewness = np.where(m2 > 0, m3 / m2**1.5, 0)
+        factors[nonempty] = np.mean(skewness, axis=1)
+
+    return factors
+
+
+#Model shared with the worker processes running the lpca restarts (see lpca.fit_restarts).
+_restart_model = None
+
+def _set_restart_model(model):
+    global _restart_model
+    _restart_model = model
+
+def _fit_lpca_restart(seed):
+    '''
+    Run a single lpca fit with a given random seed on a copy of the shared model.
+    '''
+    import copy
+
+    np.random.seed(seed)
+    model = copy.copy(_restart_model)
+    model._n_init = 1
+    model._n_jobs = 1
+    model._writeFolder = False
+    model._callback = None
+    idx = model.fit()
+
+    return idx, model.reconstruction_error, model._k, model.iterations
+
+def _fit_kmeans_restart(seed):
+    '''
+    Run the iterative kMeans algorithm with a given random seed on a copy of the shared
+    model, whose matrix is already preprocessed (see KMeans.fit_restarts).
+    '''
+    import copy
+
+    np.random.seed(seed)
+    model = copy.copy(_restart_model)
+    model._callback = None
+    idx = model.iterate()
+
+    return idx, model.sse, model._k, model.iterations, model.centroids
+
+
+class minibatch_lpca(lpca):
+    '''
+    Mini-batch version of the iterative Local Principal Component Analysis clustering algorithm,
+    for data-sets which cannot be entirely loaded in memory. The training matrix can be given as
+    a numpy array, as a numpy memmap, or as the path to a .npy file (which is memory-mapped).
+    The algorithm is based on the following steps:
+
+    0.  Preprocessing: The centering and scaling factors are computed with a single pass over
+        the training matrix, reading one block of observations at the time.
+
+    1.  Initialization: The local models are initialized on a first random batch of observations,
+        with one of the initialization methods available for lpca.
+
+    2.  Partition: A new random batch of observations is drawn from the training matrix and each
+        observation is assigned to the cluster where the local reconstruction error is minimized;
+
+    3.  PCA: The sufficient statistics (number of observations, sum and scatter matrix) of each
+        cluster are updated with the observations of the batch, and the local centroids and PCs
+        are computed from the updated statistics.
+
+    4.  Iteration: Steps 2 and 3 are iterated until the (smoothed) mean reconstruction error of the
+        batches does not vary anymore. Finally, all the observations are assigned to the clusters
+        with a last pass over the training matrix.
+
+    
+    --- PARAMETERS ---
+    X:          RAW data matrix, uncentered and unscaled. It must be organized
+                with the structure: (observations x variables). It can also be
+                a memmap or the path to a .npy file.
+    type X :    numpy array, numpy memmap or string
+
+    dictionary:         Dictionary containing all the instruction for the setters
+    type dictionary:    dictionary
+
+    
+    --- SETTERS --- (inherited from LPCA)
+    batch_size:             number of observations in each batch
+    type _batch_size:       scalar
+
+    '''
+    def __init__(self, X, *dictionary):
+        #Load the training matrix as memmap if a path is given:
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode='r')
+        self.X = X
+        #Set the number of observations in each batch:
+        self._batch_size = 1000
+        #Set hard parameters (private, not meant to be modified).
+        self.__convergeTol = 1E-4
+        self.__smoothing = 0.9
+
+        super().__init__(X, *dictionary)
+
+        if dictionary:
+            settings = dictionary[0]
+            try:
+                self._batch_size = settings["batch_size"]
+                if not isinstance(self._batch_size, int) or self._batch_size <= 1:
+                    raise Exception
+            except:
+                self._batch_size = 1000
+                warnings.warn("An exception occured with regard to the input value for the batch size. It could be not acceptable, or not given to the dictionary.")
+                print("\tIt will be automatically set equal to: 1000.")
+                print("\tYou can ignore this warning if the batch size has been assigned later via setter.")
+                print("\tOtherwise, please check the conditions which must be satisfied by the input in the detailed documentation.")
+
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, new_number):
+        self._batch_size = new_number
+
+        if not isinstance(self._batch_size, int) or self._batch_size <= 1:
+            self._batch_size = 1000
+            warnings.warn("An exception occured with regard to the input value for the batch size. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: 1000.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+
+    def get_batch(self, batch_size):
+        '''
+        Draw a random batch of observations from the training matrix, and center and scale it.
+        The rows are read in ascending order, to limit the random accesses to the disk.
+        '''
+        rows_ = np.sort(np.random.randint(0, self.X.shape[0], size=batch_size))
+        X_batch = np.asarray(self.X[rows_], dtype=float)
+
+        return center_scale(X_batch, self.mu, self.sigma)
+
+
+    def fit_path(self, final_k):
+        '''
+        The path of solutions is not available with the mini-batch algorithm: the warm start
+        of each solution requires the whole preprocessed matrix (see lpca.split_worst_cluster).
+        '''
+        raise Exception("The path of solutions (fit_path) is not available with minibatch_lpca. Please use lpca.")
+
+
+    def fit(self):
+        '''
+        Group the observations depending on the PCA reconstruction error, estimating
+        the local models from random batches of observations. The final number of
+        iterations and the mean reconstruction error of all the observations are
+        stored in iterations and reconstruction_error.
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
+        type idx:   numpy array 
+        
+        '''
+        if self._centroid_method.lower() != 'mean' or self._correction != "off" or self._adaptive or self._n_init > 1:
+            warnings.warn("Only the clusters' means can be used as centroids with minibatch_lpca, and no correction, adaptive PCs or multiple initializations are available.")
+            print("\tThe centroids will be the clusters' means, no correction will be applied, and the algorithm will be run once with {} PCs.".format(self._nPCs))
+            self._centroid_method = 'mean'
+            self._correction = "off"
+            self._adaptive = False
+            self._n_init = 1
+
+        rows, cols = self.X.shape
+        batch_size = min(self._batch_size, rows)
+        #Compute the centering and scaling factors of the training dataset
+        if self._verbose:
+            print("Computing the centering and scaling factors..")
+        self.mu, self.sigma = self.preprocessing_factors(self.X, self._center, self._scale, self._centering, self._scaling, batch_size)
+        if self._verbose:
+            print("Fitting Local PCA model with mini-batches...")
+        if self._writeFolder:
+            lpca.set_environment()
+            lpca.write_recap_text(self._k, self._nPCs, self._correction, self._method)
+        # Initialization
+        iteration, eps_rec, residuals, iter_max, eps_tol = lpca.initialize_parameters()
+        X_batch = self.get_batch(batch_size)
+        idx_batch = np.minimum(lpca.initialize_clusters(X_batch, self._k, self._method), self._k -1)
+        counts, sums, scatters = get_sufficient_statistics(X_batch, idx_batch, self._k)
+        centroids, modes, evals = PCA_from_statistics(counts, sums, scatters, self._nPCs, self.covariance_solver())
+        sq_rec_err = np.empty((batch_size, self._k), dtype=float)
+        eps_rec = None
+        # Iterate
+        while(iteration < iter_max):
+            timings = {}
+            # Assign the observations of a new batch to the clusters
+            start_time = time.perf_counter()
+            X_batch = self.get_batch(batch_size)
+            timings["batch"] = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            get_reconstruction_errors(X_batch, centroids, modes, out=sq_rec_err)
+            idx_batch = np.argmin(sq_rec_err, axis = 1)
+            timings["partition"] = time.perf_counter() - start_time
+            # Update the statistics, and then the local models
+            start_time = time.perf_counter()
+            batch_counts, batch_sums, batch_scatters = get_sufficient_statistics(X_batch, idx_batch, self._k)
+            counts += batch_counts
+            sums += batch_sums
+            scatters += batch_scatters
+            centroids, modes, evals = PCA_from_statistics(counts, sums, scatters, self._nPCs, self.covariance_solver())
+            timings["local_models"] = time.perf_counter() - start_time
+            # Update convergence: the error of a single batch is noisy, so it is smoothed
+            rec_err_min = sq_rec_err[np.arange(batch_size), idx_batch]
+            eps_rec_batch = np.mean(rec_err_min, axis = 0)
+            if eps_rec is None:
+                eps_rec_new = eps_rec_batch
+                eps_rec_var = 1.0
+            else:
+                eps_rec_new = self.__smoothing * eps_rec + (1 - self.__smoothing) * eps_rec_batch
+                eps_rec_var = np.abs((eps_rec_new - eps_rec) / (eps_rec_new) + eps_tol)
+            eps_rec = eps_rec_new
+            # Print info
+            if self._verbose:
+                print("- Iteration number: {}".format(iteration+1))
+                print("\tReconstruction error (batch): {}".format(eps_rec_batch))
+                print("\tReconstruction error variance: {}".format(eps_rec_var))
+            stop = self._callback is not None and self._callback({"iteration": iteration+1, "error": eps_rec_new, "variation": eps_rec_var, "labels_changed": None, "timings": timings})
+            residuals = np.append(residuals, eps_rec_new)
+            iteration += 1
+            # Check convergence condition
+            if (eps_rec_var <= self.__convergeTol) or stop:
+                break
+        # Assign all the observations, one block at the time
+        if self._verbose:
+            print("Assigning the observations to the clusters..")
+        idx = np.empty((rows,), dtype=int)
+        sum_rec_err = 0
+        for start in range(0, rows, batch_size):
+            end = min(start + batch_size, rows)
+            X_block = center_scale(np.asarray(self.X[start:end], dtype=float), self.mu, self.sigma)
+            get_reconstruction_errors(X_block, centroids, modes, out=sq_rec_err[:end-start])
+            idx[start:end] = np.argmin(sq_rec_err[:end-start], axis = 1)
+            sum_rec_err += np.sum(np.min(sq_rec_err[:end-start], axis = 1))
+        self.iterations = iteration
+        self.reconstruction_error = sum_rec_err / rows
+        # Remove the empty clusters, if any
+        used = np.unique(idx)
+        if len(used) < self._k:
+            idx = np.unique(idx, return_inverse=True)[1]
+            print("WARNING:")
+            print("\tThe number of cluster was lowered because empty clusters were found.")
+            print("\tThe current number of clusters is equal to: {}".format(np.max(idx) +1))
+        self.model = lpca_model(self.mu, self.sigma, centroids[used], modes[used], evals[used], idx=idx)
+        if self._writeFolder:
+            lpca.write_final_stats(self.iterations, self.reconstruction_error)
+        if self._verbose:
+            print("Convergence reached in {} iterations.".format(iteration))
+        return idx
+
+
+#Shards of the training matrix and of the labels, opened by the worker processes of sharded_lpca.
+_shard_data = None
+_shard_labels = None
+
+def _open_shards(data_spec, labels_spec):
+    '''
+    Open (memory-mapped) the training matrix and the labels of the observations, given the
+    specifications (filename, dtype, shape, offset, order) of the files where they are stored.
+    '''
+    global _shard_data, _shard_labels
+    filename, dtype, shape, offset, order = data_spec
+    _shard_data = np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset, order=order)
+    filename, dtype, shape, offset, order = labels_spec
+    _shard_labels = np.memmap(filename, dtype=dtype, mode='r+', shape=shape, offset=offset, order=order)
+
+def _close_shards():
+    global _shard_data, _shard_labels
+    _shard_data = None
+    _shard_labels = None
+
+def _shard_moments(start, end, block_size):
+    '''
+    Compute the moments (see lpca.data_moments) of the observations [start, end) of the shared matrix.
+    '''
+    return lpca.data_moments(_shard_data[start:end], block_size)
+
+def _shard_assign(start, end, mu, sigma, centroids, modes, relabel, block_size):
+    '''
+    Assign the observations [start, end) of the shared matrix to the cluster which minimizes the
+    local reconstruction error, store their labels, and return the sufficient statistics of the
+    clusters computed on the shard, the sum of the reconstruction errors and the number of
+    observations whose label changed. If some clusters were removed after the previous iteration,
+    relabel maps the previous labels to the current ones.
+    '''
+    k = len(centroids)
+    cols = len(mu)
+    counts = np.zeros((k,), dtype=float)
+    sums = np.zeros((k, cols), dtype=float)
+    scatters = np.zeros((k, cols, cols), dtype=float)
+    error_sum = 0.0
+    labels_changed = 0
+
+    sq_rec_err = np.empty((min(block_size, end - start), k), dtype=float)
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        n_block = block_end - block_start
+        X_block = center_scale(np.asarray(_shard_data[block_start:block_end], dtype=float), mu, sigma)
+        get_reconstruction_errors(X_block, centroids, modes, out=sq_rec_err[:n_block])
+        idx_block = np.argmin(sq_rec_err[:n_block], axis = 1)
+        error_sum += np.sum(sq_rec_err[np.arange(n_block), idx_block])
+
+        idx_old = np.asarray(_shard_labels[block_start:block_end])
+        if relabel is not None:
+            idx_old = relabel[idx_old]
+        labels_changed += np.count_nonzero(idx_block != idx_old)
+        _shard_labels[block_start:block_end] = idx_block
+
+        block_counts, block_sums, block_scatters = get_sufficient_statistics(X_block, idx_block, k)
+        counts += block_counts
+        sums += block_sums
+        scatters += block_scatters
+
+    return counts, sums, scatters, error_sum, labels_changed
+
+
+class sharded_lpca(lpca):
+    '''
+    Data-parallel version of the iterative Local Principal Component Analysis clustering algorithm,
+    for very large data-sets. The observations are split in contiguous shards, one for each of the
+    n_jobs worker processes. The training matrix can be given as a numpy array, as a numpy memmap,
+    or as the path to a .npy file: the workers read their shard from the file where the matrix is
+    stored, or from a copy in shared memory (/dev/shm) if the matrix was given as an array.
+    The algorithm is based on the following steps:
+
+    0.  Preprocessing: Each worker computes the mean, the variance, the minimum and the maximum of
+        the variables on its shard; these moments are merged to get the centering and scaling factors.
+
+    1.  Initialization: The local models are initialized on a random sample of observations,
+        with one of the initialization methods available for lpca.
+
+    2.  Partition (map): The local models are sent to the workers, which assign each observation of
+        their shard to the cluster where the local reconstruction error is minimized, and return the
+        sufficient statistics (number of observations, sum and scatter matrix) of each cluster.
+
+    3.  PCA (reduce): The statistics of the shards are summed, and the local centroids and PCs are
+        computed from them. The clusters with less than 2 observations are removed.
+
+    4.  Iteration: Steps 2 and 3 are iterated until no observation changes cluster, or until the
+        reconstruction error does not vary anymore.
+
+    Only the clusters' means can be used as centroids, and no correction of the reconstruction
+    error is available, as they would need all the observations of each cluster.
+
+    
+    --- PARAMETERS ---
+    X:          RAW data matrix, uncentered and unscaled. It must be organized
+                with the structure: (observations x variables). It can also be
+                a memmap or the path to a .npy file.
+    type X :    numpy array, numpy memmap or string
+
+    dictionary:         Dictionary containing all the instruction for the setters
+    type dictionary:    dictionary
+
+    
+    --- SETTERS --- (inherited from LPCA)
+    n_jobs:             number of worker processes, i.e., of shards (-1: all the available cores)
+    type _n_jobs:       scalar
+
+    '''
+    def __init__(self, X, *dictionary):
+        #Load the training matrix as memmap if a path is given:
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode='r')
+        #Set hard parameters (private, not meant to be modified).
+        self.__blockSize = 10000
+        self.__sampleSize = 10000
+
+        super().__init__(X, *dictionary)
+        #keep the memmap, so that the workers can open the same file
+        self.X = X
+
+
+    def data_spec(self):
+        '''
+        Return the specifications (filename, dtype, shape, offset, order) of the file where the training
+        matrix is stored, or None if it is not entirely stored in a file (e.g., it is a numpy array).
+        '''
+        import mmap
+
+        if isinstance(self.X, np.memmap) and isinstance(self.X.base, mmap.mmap) and self.X.filename is not None:
+            if self.X.flags.c_contiguous:
+                return self.X.filename, self.X.dtype.str, self.X.shape, self.X.offset, 'C'
+            elif self.X.flags.f_contiguous:
+                return self.X.filename, self.X.dtype.str, self.X.shape, self.X.offset, 'F'
+        return None
+
+
+    @staticmethod
+    def create_shared_file(folder, name, shape, dtype):
+        '''
+        Create a .npy file in the given folder and return it (memory-mapped) with its specifications.
+        '''
+        import os
+
+        filename = os.path.join(folder, name + '.npy')
+        array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+
+        return array, (filename, array.dtype.str, array.shape, array.offset, 'C')
+
+
+    def map_shards(self, pool, function, *args):
+        '''
+        Call function(start, end, *args) for each shard [start, end) of the training matrix,
+        in the pool of worker processes (or in the current process if the pool is None).
+        '''
+        starts = [shard[0] for shard in self._shards]
+        ends = [shard[1] for shard in self._shards]
+        tasks = [starts, ends] + [[arg] *len(self._shards) for arg in args]
+        if pool is None:
+            return list(map(function, *tasks))
+        return list(pool.map(function, *tasks))
+
+
+    def fit(self):
+        '''
+        Group the observations depending on the PCA reconstruction error, with n_jobs
+        worker processes each assigning the observations of a different shard.
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
+        type idx:   numpy array 
+        
+        '''
+        import os
+        import tempfile
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self._centroid_method.lower() != 'mean' or self._correction != "off":
+            warnings.warn("Only the clusters' means can be used as centroids with sharded_lpca, and no correction is available.")
+            print("\tThe centroids will be the clusters' means and no correction will be applied.")
+
+        rows, cols = self.X.shape
+        block_size = min(self.__blockSize, rows)
+        n_workers = os.cpu_count() if self._n_jobs == -1 else self._n_jobs
+        n_workers = max(1, min(n_workers, rows))
+        bounds = np.linspace(0, rows, n_workers +1).astype(int)
+        self._shards = list(zip(bounds[:-1], bounds[1:]))
+
+        #the shared files are written in memory, if possible
+        shared_folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=shared_folder) as folder:
+            data_spec = self.data_spec()
+            if data_spec is None:
+                if self._verbose:
+                    print("Copying the training matrix to the shared memory..")
+                X_shared, data_spec = sharded_lpca.create_shared_file(folder, 'X', (rows, cols), float)
+                for start in range(0, rows, block_size):
+                    X_shared[start:start+block_size] = self.X[start:start+block_size]
+                X_shared.flush()
+                del X_shared
+            #the labels are initialized to -1, so that at the first iteration all of them change
+            labels, labels_spec = sharded_lpca.create_shared_file(folder, 'idx', (rows,), np.int64)
+            labels[:] = -1
+            labels.flush()
+
+            if n_workers > 1:
+                pool = ProcessPoolExecutor(max_workers=n_workers, initializer=_open_shards, initargs=(data_spec, labels_spec))
+            else:
+                pool = None
+                _open_shards(data_spec, labels_spec)
+            try:
+                self.fit_shards(pool, block_size)
+                idx = np.array(labels, dtype=int)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+                _close_shards()
+                del labels
+
+        # Remove the empty clusters, if any
+        used = np.flatnonzero(self._counts)
+        if len(used) < len(self._counts):
+            idx = np.unique(idx, return_inverse=True)[1]
+            print("WARNING:")
+            print("\tThe number of cluster was lowered because empty clusters were found.")
+            print("\tThe current number of clusters is equal to: {}".format(np.max(idx) +1))
+        self._k = len(used)
+        self.model = self.model_from_statistics(self.mu, self.sigma, self._counts[used], self._sums[used], self._scatters[used], idx)
+        del self._counts, self._sums, self._scatters
+        if self._writeFolder:
+            lpca.write_final_stats(self.iterations, self.reconstruction_error)
+        if self._verbose:
+            print("Convergence reached in {} iterations.".format(self.iterations))
+        return idx
+
+
+    def fit_shards(self, pool, block_size):
+        '''
+        Iterate the partition of the shards in the workers (map) and the computation of the
+        local models from the statistics of the shards (reduce), until convergence.
+        '''
+        rows, cols = self.X.shape
+        #Compute the centering and scaling factors of the training dataset
+        if self._verbose:
+            print("Computing the centering and scaling factors..")
+        moments = functools.reduce(lpca.merge_moments, self.map_shards(pool, _shard_moments, block_size))
+        self.mu, self.sigma = self.preprocessing_factors(None, self._center, self._scale, self._centering, self._scaling, block_size, moments=moments)
+        if self._verbose:
+            print("Fitting Local PCA model on {} shards...".format(len(self._shards)))
+        if self._writeFolder:
+            lpca.set_environment()
+            lpca.write_recap_text(self._k, self._nPCs, self._correction, self._method)
+        # Initialization on a random sample of observations, read in ascending order
+        iteration, eps_rec, residuals, iter_max, eps_tol = lpca.initialize_parameters()
+        if rows > self.__sampleSize:
+            rows_ = np.sort(np.random.choice(rows, size=self.__sampleSize, replace=False))
+        else:
+            rows_ = np.arange(rows)
+        X_sample = center_scale(np.asarray(self.X[rows_], dtype=float), self.mu, self.sigma)
+        idx_sample = np.minimum(lpca.initialize_clusters(X_sample, self._k, self._method), self._k -1)
+        counts, sums, scatters = get_sufficient_statistics(X_sample, idx_sample, self._k)
+        relabel = None
+        # Iterate
+        while(iteration < iter_max):
+            timings = {}
+            # Reduce: consider only statistical meaningful groups of points, i.e., with at least 2
+            #points, and compute the local models. The observations of the removed clusters are
+            #assigned to the remaining ones at the next partition.
+            start_time = time.perf_counter()
+            kept = np.flatnonzero(counts >= 2)
+            if len(kept) < len(counts):
+                if iteration > 0:
+                    relabel = np.full((len(counts),), -1, dtype=np.int64)
+                    relabel[kept] = np.arange(len(kept))
+                counts, sums, scatters = counts[kept], sums[kept], scatters[kept]
+            centroids, modes = self.local_models_from_statistics(counts, sums, scatters)
+            timings["local_models"] = time.perf_counter() - start_time
+            # Map: assign the observations of each shard with the new local models
+            start_time = time.perf_counter()
+            results = self.map_shards(pool, _shard_assign, self.mu, self.sigma, centroids, modes, relabel, block_size)
+            counts = np.sum([result[0] for result in results], axis=0)
+            sums = np.sum([result[1] for result in results], axis=0)
+            scatters = np.sum([result[2] for result in results], axis=0)
+            labels_changed = int(np.sum([result[4] for result in results]))
+            relabel = None
+            timings["partition"] = time.perf_counter() - start_time
+            # Update convergence
+            eps_rec_new = np.sum([result[3] for result in results]) / rows
+            eps_rec_var = np.abs((eps_rec_new - eps_rec) / (eps_rec_new) + eps_tol)
+            eps_rec = eps_rec_new
+            iteration += 1
+            # Print info
+            if self._verbose:
+                print("- Iteration number: {}".format(iteration))
+                print("\tReconstruction error: {}".format(eps_rec_new))
+                print("\tReconstruction error variance: {}".format(eps_rec_var))
+                print("\tObservations which changed cluster: {}".format(labels_changed))
+            stop = self._callback is not None and self._callback({"iteration": iteration, "error": eps_rec_new, "variation": eps_rec_var, "labels_changed": labels_changed, "timings": timings})
+            residuals = np.append(residuals, eps_rec_new)
+            # Check convergence condition
+            if labels_changed == 0 or (eps_rec_var <= eps_tol) or stop:
+                break
+
+        self.iterations = iteration
+        self.reconstruction_error = eps_rec
+        #statistics of the final clusters, used to build the model
+        self._counts, self._sums, self._scatters = counts, sums, scatters
+
+
+class fpca(lpca):
+    '''
+    Supervised partitioning based on an a-priori conditioning (and subsequent dim reduction), by means
+    of a selected variable which is known to be important for the process. As it
+    is not an iterative algorithm, it allows for a faster clustering in comparison with
+    lpca via Vector Quantization, even if the choice of the optimal variable could constitute a
+    difficult task for some applications, as it requires prior knowledge on the process, and the choice must
+    be assessed case-by-case. For non-premixed, turbulent combustion applications, the
+    mixture fraction Z is an optimal variable for the data conditioning, leading to excellent
+    results both for data compression and interpretation tasks.
 
     Input:
     X = raw data matrix (observations x variables)
@@ -974,9 +2488,13 @@ class KMeans(lpca):
     The K-Means clustering is an iterative algorithm to partition a matrix X, composed
     by 'n' observations and 'p' variables, into 'k' groups of similar points (clusters).
     The number of clusters is a-priori defined by the user.
-    Initially, the clusters are assigned randomly, then, the algorithm shift the center 
+    Initially, the centroids are chosen among the observations (seeding), then, the algorithm shift the center 
     of mass of each cluster by means of the minimization of their squared euclidean 
     distances and the observations.
+    The centroids can be seeded randomly, with k-means++ [1] or with its scalable variant k-means|| [2]. 
+
+    [1] Arthur, David, and Sergei Vassilvitskii. "k-means++: The advantages of careful seeding." SODA (2007): 1027-1035.
+    [2] Bahmani, Bahman, et al. "Scalable k-means++." Proceedings of the VLDB Endowment 5.7 (2012): 622-633.
 
     --- PARAMETERS ---
     X:          RAW data matrix, uncentered and unscaled. It must be organized
@@ -1009,6 +2527,32 @@ class KMeans(lpca):
     initMode:               to activate in case Kmeans is used to initialize LPCA (has a lower tol for convergence)
     type   _method:         boolean
 
+    seeding:                seeding of the centroids: 'random' (k random observations), 'kmeans++' or 'kmeans||'.
+    type _seeding:          string
+
+    n_init:                 number of times the algorithm is run with different random seeds. The solution
+                            with the lowest SSE is kept. The callback is not called during the runs.
+    type _n_init:           scalar
+
+    n_jobs:                 number of processes used to run the different initializations concurrently.
+                            If equal to -1, all the available cores are used.
+    type _n_jobs:           scalar
+
+    batch_size:             if given, the mini-batch kMeans [3] is used: at each step, the centroids are updated with
+                            a random batch of observations, instead of the whole matrix. If None (default), the whole
+                            matrix is used at each iteration, unless initMode is active and the matrix is large.
+                            With fit_centroids, only the centroids are computed, without a final pass over the matrix.
+    type _batch_size:       scalar
+
+    algorithm:              'lloyd' (default) computes the distances between all the observations and all the centroids
+                            at each iteration. 'hamerly' [4] keeps an upper and a lower bound of the distance of each
+                            observation from its nearest and second nearest centroid, and computes the distances from
+                            all the centroids only for the observations whose label can change: the result is the same
+                            as 'lloyd', but far less distances are computed after the first iterations.
+    type _algorithm:        string
+
+    [3] Sculley, David. "Web-scale k-means clustering." Proceedings of the 19th international conference on World wide web (2010): 1177-1178.
+    [4] Hamerly, Greg. "Making k-means even faster." Proceedings of the 2010 SIAM international conference on data mining (2010): 130-140.
     '''
     
     def __init__(self,X, *dictionary):
@@ -1025,6 +2569,25 @@ class KMeans(lpca):
         self.__iterMax = 100
         self.__numericTol = 1e-16
         self.__convergeTol = 1E-16
+        #Number of rounds of the k-means|| seeding, and number of candidates sampled at each round (times k):
+        self.__parallelRounds = 5
+        self.__oversampling = 2
+        #Mini-batch kMeans: batch size used in initMode for matrices with more than __miniBatchRows observations,
+        #number of steps without improvement of the (smoothed) batch SSE before stopping, tolerance on the
+        #squared shift of the centroids (relative to the SSE per observation) and max number of passes over the matrix.
+        self.__initBatchSize = 1024
+        self.__miniBatchRows = 2**14
+        self.__noImprovement = 10
+        self.__shiftTol = 1E-5
+        self.__maxEpochs = 10
+        #Safety margin of the bounds of the accelerated kMeans (relative to the norms), to account for the round-off:
+        self.__boundTol = 1E-6
+        #Algorithm used for the iterations ('lloyd' or 'hamerly'):
+        self._algorithm = 'lloyd'
+        #Seeding of the centroids ('random', 'kmeans++' or 'kmeans||'):
+        self._seeding = 'kmeans++'
+        #Mini-batch kMeans:
+        self._batch_size = None
 
         #Decide if the input matrix must be centered:
         self._center = True
@@ -1091,6 +2654,42 @@ class KMeans(lpca):
                 print("\tIt will be automatically set equal to: auto.")
                 print("\tYou can ignore this warning if the scaling criterion has been assigned later via setter.")
                 print("\tOtherwise, please check the conditions which must be satisfied by the input in the detailed documentation.")
+            try:
+                self._verbose = settings["verbose"]
+                if not isinstance(self._verbose, bool):
+                    raise Exception
+            except:
+                self._verbose = False
+            try:
+                self._seeding = settings["seeding"]
+                if not isinstance(self._seeding, str) or self._seeding.lower() not in ("random", "kmeans++", "kmeans||"):
+                    raise Exception
+            except:
+                self._seeding = 'kmeans++'
+            try:
+                self._n_init = settings["number_of_initializations"]
+                if not isinstance(self._n_init, int) or self._n_init <= 0:
+                    raise Exception
+            except:
+                self._n_init = 1
+            try:
+                self._n_jobs = settings["number_of_jobs"]
+                if not isinstance(self._n_jobs, int) or (self._n_jobs <= 0 and self._n_jobs != -1):
+                    raise Exception
+            except:
+                self._n_jobs = 1
+            try:
+                self._batch_size = settings["batch_size"]
+                if self._batch_size is not None and (not isinstance(self._batch_size, int) or self._batch_size <= 0):
+                    raise Exception
+            except:
+                self._batch_size = None
+            try:
+                self._algorithm = settings["algorithm"]
+                if not isinstance(self._algorithm, str) or self._algorithm.lower() not in ("lloyd", "hamerly"):
+                    raise Exception
+            except:
+                self._algorithm = 'lloyd'
             
 
     @property
@@ -1101,10 +2700,317 @@ class KMeans(lpca):
     def initMode(self, new_bool):
         self._initMode = new_bool
 
+    @property
+    def seeding(self):
+        return self._seeding
+
+    @seeding.setter
+    def seeding(self, new_string):
+        self._seeding = new_string
+
+        if not isinstance(self._seeding, str) or self._seeding.lower() not in ("random", "kmeans++", "kmeans||"):
+            self._seeding = 'kmeans++'
+            warnings.warn("An exception occured with regard to the input value for the seeding. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: kmeans++.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, new_number):
+        self._batch_size = new_number
+
+        if self._batch_size is not None and (not isinstance(self._batch_size, int) or self._batch_size <= 0):
+            self._batch_size = None
+            warnings.warn("An exception occured with regard to the input value for the batch size. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: None (the whole matrix is used at each iteration).")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def algorithm(self):
+        return self._algorithm
+
+    @algorithm.setter
+    def algorithm(self, new_string):
+        self._algorithm = new_string
+
+        if not isinstance(self._algorithm, str) or self._algorithm.lower() not in ("lloyd", "hamerly"):
+            self._algorithm = 'lloyd'
+            warnings.warn("An exception occured with regard to the input value for the kMeans algorithm. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: lloyd.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @staticmethod
+    def seed_plusplus(X, k, weights=None, X_norms=None):
+        '''
+        Choose 'k' observations as initial centroids with the k-means++ seeding: the first one
+        is chosen randomly, then each new one is sampled with a probability proportional to its
+        (weighted) squared distance from the nearest centroid already chosen. At each step, a few
+        candidates are sampled and the one which reduces the most the SSE is kept (greedy k-means++).
+
+        --- PARAMETERS ---
+        X:          data matrix (observations x variables). 
+        type X :    numpy array
+
+        k:          number of centroids.
+        type k:     scalar
+
+        weights:    weight of each observation (optional).
+        type weights: numpy array
+
+        X_norms:    squared norms of the observations, if already available (optional).
+        type X_norms: numpy array
+
+
+        --- RETURNS ---
+        C_mat:      initial centroids (k x variables).
+        type C_mat: numpy array 
+        '''
+        rows = X.shape[0]
+        if weights is None:
+            weights = np.ones((rows,), dtype=float)
+        if X_norms is None:
+            X_norms = np.einsum('ij,ij->i', X, X)
+        n_trials = 2 + int(np.log(k))
+
+        C_mat = np.empty((k, X.shape[1]), dtype=float)
+        C_mat[0,:] = X[np.random.choice(rows, p=weights/np.sum(weights))]
+        idx_, minDist_ = get_nearest_centroids(X, C_mat[:1], X_norms=X_norms)
+
+        for ii in range(1, k):
+            potential = weights * minDist_
+            if np.sum(potential) <= 0:
+                #all the observations are already centroids
+                candidates = np.random.randint(0, rows, size=n_trials)
+            else:
+                candidates = np.random.choice(rows, size=n_trials, p=potential/np.sum(potential))
+            #distances from each candidate (computed in blocks of rows), and SSE obtained with it
+            best_sse = np.inf
+            for candidate in candidates:
+                idx_, dist_ = get_nearest_centroids(X, X[candidate:candidate+1], X_norms=X_norms)
+                np.minimum(dist_, minDist_, out=dist_)
+                sse = weights @ dist_
+                if sse < best_sse:
+                    best_sse, best, best_dist = sse, candidate, dist_
+            C_mat[ii,:] = X[best]
+            minDist_ = best_dist
+
+        return C_mat
+
+    def seed_parallel(self, X, k, X_norms=None):
+        '''
+        Choose 'k' initial centroids with the k-means|| seeding: starting from a random observation,
+        at each round about (oversampling x k) observations are sampled with a probability proportional
+        to their squared distance from the nearest candidate, all together. Each candidate is then
+        weighted with the number of observations which are closer to it, and the 'k' centroids are
+        chosen among the candidates with the k-means++ seeding. Only a few passes over the matrix
+        are needed, instead of 'k'.
+
+        --- PARAMETERS ---
+        X:          data matrix (observations x variables). 
+        type X :    numpy array
+
+        k:          number of centroids.
+        type k:     scalar
+
+        X_norms:    squared norms of the observations, if already available (optional).
+        type X_norms: numpy array
+
+
+        --- RETURNS ---
+        C_mat:      initial centroids (k x variables).
+        type C_mat: numpy array 
+        '''
+        rows = X.shape[0]
+        if X_norms is None:
+            X_norms = np.einsum('ij,ij->i', X, X)
+
+        candidates = [np.random.randint(0, rows)]
+        idx_, minDist_ = get_nearest_centroids(X, X[candidates], X_norms=X_norms)
+        for ii in range(0, self.__parallelRounds):
+            potential = np.sum(minDist_)
+            if potential <= 0:
+                break
+            sampled = np.flatnonzero(np.random.rand(rows) < self.__oversampling * k * minDist_ / potential)
+            if len(sampled) == 0:
+                continue
+            candidates.extend(sampled)
+            idx_, dist_ = get_nearest_centroids(X, X[sampled], X_norms=X_norms)
+            np.minimum(minDist_, dist_, out=minDist_)
+
+        #at least k candidates are needed
+        candidates = np.unique(candidates)
+        if len(candidates) < k:
+            others = np.setdiff1d(np.arange(rows), candidates)
+            candidates = np.concatenate((candidates, np.random.choice(others, size=k - len(candidates), replace=False)))
+
+        idx_, minDist_ = get_nearest_centroids(X, X[candidates], X_norms=X_norms)
+        weights = np.bincount(idx_, minlength=len(candidates)).astype(float)
+        #candidates which are not the nearest of any observation (duplicated rows) get a tiny weight
+        weights += 1E-16
+
+        return self.seed_plusplus(X[candidates], k, weights=weights)
+
+    def seed_centroids(self, X_norms=None, rows=None):
+        '''
+        Choose the initial centroids with the seeding method chosen via setter, among
+        all the observations or only among the given rows.
+        '''
+        X = self.X if rows is None else self.X[rows]
+        if X_norms is not None and rows is not None:
+            X_norms = X_norms[rows]
+
+        if self._seeding.lower() == 'kmeans++':
+            return self.seed_plusplus(X, self._k, X_norms=X_norms)
+        elif self._seeding.lower() == 'kmeans||':
+            return self.seed_parallel(X, self._k, X_norms=X_norms)
+
+        #'k' random observations taken from the dataset
+        C_mat = np.empty((self._k, X.shape[1]), dtype=float)
+        for ii in range(0,self._k):
+            C_mat[ii,:] = X[np.random.randint(0,X.shape[0]),:]
+
+        return C_mat
+
+    def assign_bounded(self, C_mat, X_norms, bounds=None):
+        '''
+        Assign each observation to the nearest centroid with the Hamerly's bounds. For each observation,
+        the distance from the assigned centroid (upper bound) is compared with a lower bound of the distance
+        from all the other centroids: the larger between the lower bound of the distance from the second
+        nearest centroid (decreased by the largest shift of the other centroids since it was computed) and
+        half the distance between the assigned centroid and the closest other one. If it is smaller, the
+        label cannot change and the other distances are not computed.
+
+        --- PARAMETERS ---
+        C_mat:      current centroids (k x variables).
+        type C_mat: numpy array
+
+        X_norms:    squared norms of the observations.
+        type X_norms: numpy array
+
+        bounds:     bounds returned by the previous call (None at the first iteration, or if the number
+                    of clusters has changed).
+        type bounds: dictionary
+
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
+        type idx:   numpy array 
+
+        minDist_:   squared distance of each observation from its centroid.
+        type minDist_: numpy array
+
+        bounds:     bounds to be given to the next call.
+        type bounds: dictionary
+        '''
+        C_mat = np.array(C_mat, dtype=float)
+        if bounds is None:
+            idx, minDist_, second_ = get_nearest_centroids(self.X, C_mat, X_norms=X_norms, second=True)
+            return idx.copy(), minDist_, {"centroids": C_mat, "idx": idx, "lower": np.sqrt(second_), "recomputed": len(idx)}
+
+        rows, cols = self.X.shape
+        k = C_mat.shape[0]
+        idx = bounds["idx"]
+        C_norms = np.einsum('ij,ij->i', C_mat, C_mat)
+
+        #the lower bounds decrease by the largest shift of the other centroids
+        shifts = np.sqrt(np.sum((C_mat - bounds["centroids"])**2, axis=1))
+        largest = np.argsort(shifts)[::-1]
+        shift_others = np.full((k,), shifts[largest[0]])
+        if k > 1:
+            shift_others[largest[0]] = shifts[largest[1]]
+        lower = bounds["lower"] - shift_others[idx]
+
+        #half distance between each centroid and the closest other one
+        C_dist = np.maximum(C_norms[:,np.newaxis] + C_norms[np.newaxis,:] - 2 * C_mat @ C_mat.T, 0)
+        np.fill_diagonal(C_dist, np.inf)
+        half_dist = 0.5 * np.sqrt(np.min(C_dist, axis=1))
+
+        #squared distance of each observation from its centroid, in blocks of rows
+        minDist_ = np.empty((rows,), dtype=float)
+        block_size = max(1, int(2**20 / max(cols, 1)))
+        for start in range(0, rows, block_size):
+            end = min(start + block_size, rows)
+            minDist_[start:end] = X_norms[start:end] - 2 * np.einsum('ij,ij->i', self.X[start:end], C_mat[idx[start:end]]) + C_norms[idx[start:end]]
+        np.maximum(minDist_, 0, out=minDist_)
+
+        #the distances from all the centroids are computed only where the bounds are not enough
+        margin = self.__boundTol * (np.sqrt(X_norms) + np.sqrt(np.max(C_norms)))
+        recompute = np.flatnonzero(np.sqrt(minDist_) + margin >= np.maximum(half_dist[idx], lower))
+        if len(recompute) > 0:
+            idx_, minDist_[recompute], second_ = get_nearest_centroids(self.X[recompute], C_mat, X_norms=X_norms[recompute], second=True)
+            idx[recompute] = idx_
+            lower[recompute] = np.sqrt(second_)
+
+        return idx.copy(), minDist_, {"centroids": C_mat, "idx": idx, "lower": lower, "recomputed": len(recompute)}
+
+    def reseed_empty(self, idx, minDist_, C_mat):
+        '''
+        Re-seed the empty clusters, keeping the number of clusters and the other centroids: each
+        empty cluster is moved to the observation which is the farthest from its centroid (i.e.,
+        with the largest contribution to the SSE), without emptying another cluster. The labels,
+        the distances and the centroids are modified in place.
+
+        --- PARAMETERS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment.
+        type idx:   numpy array
+
+        minDist_:   squared distance of each observation from its centroid.
+        type minDist_: numpy array
+
+        C_mat:      centroids (k x variables).
+        type C_mat: numpy array
+
+
+        --- RETURNS ---
+        n_empty:    number of clusters which have been re-seeded.
+        type n_empty: scalar
+        '''
+        counts = np.bincount(idx, minlength=self._k)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty) == 0:
+            return 0
+
+        farthest = np.argsort(minDist_)[::-1]
+        position = 0
+        for jj in empty:
+            #an observation cannot be moved if it is the only one in its cluster
+            while counts[idx[farthest[position]]] < 2:
+                position += 1
+            obs = farthest[position]
+            position += 1
+            counts[idx[obs]] -= 1
+            counts[jj] += 1
+            idx[obs] = jj
+            minDist_[obs] = 0
+            C_mat[jj,:] = self.X[obs]
+
+        if self._verbose:
+            print("{} empty clusters were re-seeded.".format(len(empty)))
+
+        return len(empty)
+
+    def minibatch_size(self):
+        '''
+        Return the batch size of the mini-batch kMeans, or None if the whole matrix must be used
+        at each iteration. In initMode, mini-batches are used by default for large matrices.
+        '''
+        if self._batch_size is not None:
+            return self._batch_size
+        if self._initMode and self.X.shape[0] > self.__miniBatchRows:
+            return self.__initBatchSize
+
+        return None
+
     @staticmethod
     def remove_empty(X, idx):
         '''
-        Remove a cluster if it is empty, or not statistically meaningful.
+        Remove a cluster if it is empty, or not statistically meaningful, merging it with an
+        adjacent one (see lpca.merge_clusters). It is not used by the kMeans iterations anymore,
+        where the empty clusters are re-seeded (see reseed_empty), but it is kept to post-process
+        a given partition.
 
         --- PARAMETERS ---
         X:          Original data matrix (observations x variables). 
@@ -1119,72 +3025,155 @@ class KMeans(lpca):
         type idx:   numpy array 
         '''
 
-        k = np.max(idx) +1
-        jj = 0
-        while jj < k:
-            cluster_ = get_cluster(X, idx, jj)
-            if cluster_.shape[0] < 2: 
-                if jj > 0:
-                    mask = np.where(idx >=jj)
-                    idx[mask] -= 1
-                else:
-                    mask = np.where(idx >jj)
-                    idx[mask] -= 1
-                print("WARNING:")
-                print("\tAn empty cluster was found:")
-                print("\tThe number of cluster was lowered to ensure statistically meaningful results.")
-                print("\tThe current number of clusters is equal to: {}".format(np.max(idx) +1))
-                k = np.max(idx) +1
-                jj = 0
-            else:
-                jj += 1
-
-        return idx
+        return lpca.merge_clusters(X, idx)
 
 
     def fit(self):
         '''
         Group the observations depending on the sum of squared Euclidean distances.
+        If n_init > 1, the algorithm is run several times with different random seeds
+        (see fit_restarts), and the solution with the lowest SSE is kept.
 
         --- RETURNS ---
         idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
         type idx:   numpy array 
         '''
-        from scipy.spatial.distance import euclidean, cdist
         if not self._initMode:
-            print("Fitting kmeans model..")
+            if self._verbose:
+                print("Fitting kmeans model..")
             self.X = self.preprocess_training(self.X, self._center, self._scale, self._centering, self._scaling)
-        else:
+        elif self._verbose:
             print("Initializing clusters via KMeans algorithm..")
             #pass the centering/scaling if the kMeans is used for the initialization, if
             #explicitely asked.
+
+        if self._n_init > 1:
+            return self.fit_restarts()
+
+        return self.iterate()
+
+
+    def fit_centroids(self):
+        '''
+        Compute only the centroids, without assigning all the observations to them: with the
+        mini-batch kMeans (see batch_size), the matrix is only read in random batches, and the
+        SSE stored in sse is estimated from the batches. The algorithm is run once, regardless
+        of n_init.
+
+        --- RETURNS ---
+        centroids:          final centroids (k x variables).
+        type centroids:     numpy array 
+        '''
+        if not self._initMode:
+            if self._verbose:
+                print("Fitting kmeans centroids..")
+            self.X = self.preprocess_training(self.X, self._center, self._scale, self._centering, self._scaling)
+
+        batch_size = self.minibatch_size()
+        if batch_size is not None:
+            self.iterate_minibatch(batch_size, final_assignment=False)
+        else:
+            self.iterate()
+
+        return self.centroids
+
+
+    def fit_restarts(self):
+        '''
+        Run the kMeans algorithm n_init times with different random seeds, in a pool of
+        n_jobs processes, and keep the solution with the lowest SSE. The final SSE of
+        all the runs are stored in restart_errors.
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
+        type idx:   numpy array 
+        '''
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self._callback is not None:
+            warnings.warn("The callback is not called when the kMeans algorithm is run with n_init > 1.")
+
+        #the seeds are drawn from the global generator, so the runs are reproducible
+        seeds = np.random.randint(0, 2**31 -1, size=self._n_init)
+        n_workers = os.cpu_count() if self._n_jobs == -1 else self._n_jobs
+        n_workers = min(n_workers, self._n_init)
+
+        if n_workers <= 1:
+            _set_restart_model(self)
+            results = [_fit_kmeans_restart(seed) for seed in seeds]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_restart_model, initargs=(self,)) as pool:
+                results = list(pool.map(_fit_kmeans_restart, seeds))
+
+        #keep the best solution
+        self.restart_errors = np.array([result[1] for result in results])
+        best = int(np.argmin(self.restart_errors))
+        idx, self.sse, self._k, self.iterations, self.centroids = results[best]
+
+        if self._verbose:
+            print("Final SSE of the {} runs:".format(self._n_init))
+            print("\tBest: {}".format(np.min(self.restart_errors)))
+            print("\tMean: {}".format(np.mean(self.restart_errors)))
+            print("\tWorst: {}".format(np.max(self.restart_errors)))
+
+        return idx
+
+
+    def iterate(self):
+        '''
+        Run the iterative kMeans algorithm on the (already preprocessed) matrix, starting from
+        the seeded centroids. If a cluster becomes empty, only its centroid is re-seeded (see
+        reseed_empty), so the number of clusters does not change. The final SSE, the number of
+        iterations and the centroids are stored in sse, iterations and centroids.
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each observation.
+        type idx:   numpy array 
+        '''
+        batch_size = self.minibatch_size()
+        if batch_size is not None:
+            return self.iterate_minibatch(batch_size)
+
         #Declare matrix and variables to be used:
-        C_mat = np.empty((self._k, self.X.shape[1]), dtype=float)
+        self._k = min(self._k, self.X.shape[0])
         C_old = np.empty((self._k, self.X.shape[1]), dtype=float)
-        dist = np.empty((self.X.shape[0], self._k), dtype=float)
-        idx = np.empty((self.X.shape[0],), dtype=int)
-        minDist_ = np.empty((self.X.shape[0],), dtype=float)
+        idx = np.zeros((self.X.shape[0],), dtype=int)
         minDist_OLD = 1E15
         iter = 0
+        #the squared norms of the observations do not change between the iterations
+        X_norms = np.einsum('ij,ij->i', self.X, self.X)
 
-        #Initialize the centroids using 'k' random observations taken from the
-        #dataset.
-        for ii in range(0,self._k):
-            C_mat[ii,:] = self.X[np.random.randint(0,self.X.shape[0]),:]
+        #Initialize the centroids with the chosen seeding.
+        C_mat = self.seed_centroids(X_norms)
+        #bounds of the distances, centroids of the last assignment and stability of the labels
+        #(only for the accelerated algorithm)
+        bounds = None
+        C_assigned = C_mat
+        labels_stable = False
 
         #Start with the iterative algorithm:
         while iter < self.__iterMax:
-            #Compute the euclidean distances between the matrix and all the
-            #centroids. The function cdist returns a matrix 'dist' = (nObs x k)
-            dist = cdist(self.X, C_mat)**2
-            #For each observation, choose the nearest centroid.
+            timings = {}
+            start_time = time.perf_counter()
+            idx_old = idx.copy()
+            #For each observation, choose the nearest centroid (squared Euclidean
+            #distance), computing the distances in blocks of observations.
             #The vector idx contains the corresponding class, while the minDist_
             #vector contains the numerical value of the distance, which will
             #be useful later, for the convergence check.
-            for ii in range(0, self.X.shape[0]):
-                idx[ii] = np.argmin(dist[ii,:])
-                minDist_[ii] = np.min(dist[ii,:])
+            if self._algorithm.lower() == 'hamerly':
+                idx, minDist_, bounds = self.assign_bounded(C_mat, X_norms, bounds)
+                C_assigned = bounds["centroids"]
+            else:
+                idx, minDist_ = get_nearest_centroids(self.X, C_mat, X_norms=X_norms)
+            #Move the empty clusters to the farthest observations: the bounds of
+            #the accelerated algorithm are not valid anymore.
+            if self.reseed_empty(idx, minDist_, C_mat) > 0:
+                bounds = None
+            timings["partition"] = time.perf_counter() - start_time
             #Compute the new clusters and the sum of the distances.
+            start_time = time.perf_counter()
             clusters = get_all_clusters(self.X, idx)
             C_old = C_mat
             minDist_sum = np.sum(minDist_)
@@ -1192,40 +3181,120 @@ class KMeans(lpca):
             for ii in range(0, self._k):
                 centroid = get_centroids(clusters[ii])
                 C_mat[ii,:] = centroid
+            timings["centroids"] = time.perf_counter() - start_time
             #Check the convergence measuring how much the centroids have changed
             varDist = np.abs((minDist_sum - minDist_OLD) / (minDist_sum + 1E-16))
             minDist_OLD = minDist_sum
+            stop = self._callback is not None and self._callback({"iteration": iter+1, "error": minDist_sum, "variation": varDist, "labels_changed": np.count_nonzero(idx != idx_old), "timings": timings})
 
             #If the variation between the new and the old position is below the
             #convergence tolerance, then stop the iterative algorithm and return
             #the current idx. Otherwise, keep iterating.
-            if varDist < self.__convergeTol:
-                print("The kMeans algorithm has reached convergence.")
+            #With the bounds, the distances of the observations whose label cannot change are
+            #computed with a different rounding, so the SSE is not compared: it does not change
+            #when the labels did not change in this iteration and in the previous one (i.e., the
+            #centroids did not move), which is when the Lloyd's iterations stop.
+            if self._algorithm.lower() == 'hamerly':
+                converged = labels_stable and np.array_equal(idx, idx_old)
+                labels_stable = np.array_equal(idx, idx_old)
+            else:
+                converged = varDist < self.__convergeTol
+            if converged or stop:
+                if self._verbose:
+                    print("The kMeans algorithm has reached convergence.")
                 break
 
             iter += 1
-            if not self._initMode:
+            if not self._initMode and self._verbose:
                 print("Iteration number: {}".format(iter))
                 print("The SSE over all cluster is equal to: {}".format(minDist_sum))
                 print("The SSE variance is equal to: {}".format(varDist))
-            
-            #Consider only statistical meaningful groups of points: if there
-            #are empty cluster, delete them. The algorithm's iterations will
-            #be re-initialized each time a cluster is deleted.
-            idx = self.remove_empty(self.X, idx)
-            check_ = np.max(idx)
-            if check_+1 != self._k:
-                self._k = max(idx) +1
-                C_mat = np.empty((self._k, self.X.shape[1]), dtype=float)
-                C_old = np.empty((self._k, self.X.shape[1]), dtype=float)
-                dist = np.empty((self.X.shape[0], self._k), dtype=float)
-                idx = np.empty((self.X.shape[0],), dtype=int)
-                minDist_ = np.empty((self.X.shape[0],), dtype=float)
-                minDist_OLD = 1E15
-                iter = 0
-                for ii in range(0,self._k):
-                    C_mat[ii,:] = self.X[np.random.randint(0,self.X.shape[0]),:]
-            
+
+        self.sse = minDist_sum
+        if self._algorithm.lower() == 'hamerly':
+            #final SSE computed as in the Lloyd's iterations
+            self.sse = np.sum(get_nearest_centroids(self.X, C_assigned, X_norms=X_norms)[1])
+        self.iterations = iter
+        self.centroids = C_mat
+
+        return idx
+
+
+    def iterate_minibatch(self, batch_size, final_assignment=True):
+        '''
+        Run the mini-batch kMeans algorithm on the (already preprocessed) matrix. At each step, a
+        random batch of observations is assigned to the nearest centroids, and each centroid is
+        moved to the mean of all the observations assigned to it so far (i.e., with a learning
+        rate equal to the inverse of its count). The centroids are seeded on a random subset of
+        the matrix. The algorithm stops when the centroids do not move anymore, when the smoothed
+        SSE of the batches does not improve for a few steps, or after a maximum number of passes
+        over the matrix.
+        If final_assignment is True, all the observations are then assigned to the final
+        centroids, and the empty clusters are re-seeded (see reseed_empty).
+
+        --- PARAMETERS ---
+        batch_size: number of observations used at each step.
+        type batch_size: scalar
+
+        final_assignment:       assign all the observations to the final centroids (see fit_centroids).
+        type final_assignment:  boolean
+
+
+        --- RETURNS ---
+        idx:        vector whose dimensions are (n,) containing the cluster assignment for each
+                    observation (None, if final_assignment is False).
+        type idx:   numpy array 
+        '''
+        rows, cols = self.X.shape
+        batch_size = min(batch_size, rows)
+        self._k = min(self._k, rows)
+
+        #the centroids are seeded on a subset of the matrix
+        subset = np.random.choice(rows, size=min(rows, max(3 * batch_size, self._k)), replace=False)
+        C_mat = self.seed_centroids(rows=np.sort(subset))
+        counts = np.zeros((self._k,), dtype=float)
+
+        n_steps = max(1, self.__maxEpochs * rows // batch_size)
+        sse_smooth = None
+        sse_best = np.inf
+        no_improvement = 0
+        for step in range(0, n_steps):
+            batch = np.random.randint(0, rows, size=batch_size)
+            X_batch = np.asarray(self.X[batch], dtype=float)
+            idx_batch, minDist_ = get_nearest_centroids(X_batch, C_mat)
+
+            #c_j = (n_j c_j + sum of the batch observations in j) / (n_j + b_j)
+            batch_counts = np.bincount(idx_batch, minlength=self._k).astype(float)
+            batch_sums = np.zeros((self._k, cols), dtype=float)
+            np.add.at(batch_sums, idx_batch, X_batch)
+            updated = batch_counts > 0
+            counts[updated] += batch_counts[updated]
+            shift = (batch_sums[updated] - batch_counts[updated,np.newaxis] * C_mat[updated]) / counts[updated,np.newaxis]
+            C_mat[updated] += shift
+
+            #exponentially weighted average of the SSE per observation of the batches
+            sse_batch = np.mean(minDist_)
+            alpha = min(1.0, 2.0 * batch_size / (rows + 1))
+            sse_smooth = sse_batch if sse_smooth is None else (1 - alpha) * sse_smooth + alpha * sse_batch
+            if sse_smooth < sse_best:
+                sse_best = sse_smooth
+                no_improvement = 0
+            else:
+                no_improvement += 1
+            if self._verbose and not self._initMode:
+                print("Step number: {}, smoothed SSE per observation: {}".format(step+1, sse_smooth))
+            if no_improvement >= self.__noImprovement or np.sum(shift**2) < self.__shiftTol * self._k * sse_batch:
+                break
+
+        self.iterations = step +1
+        self.centroids = C_mat
+        if not final_assignment:
+            self.sse = sse_smooth * rows
+            return None
+
+        idx, minDist_ = get_nearest_centroids(self.X, C_mat)
+        self.reseed_empty(idx, minDist_, C_mat)
+        self.sse = np.sum(minDist_)
 
         return idx
 
@@ -16,11 +16,13 @@ MODULE: model_order_reduction.py
 
 '''
 
+import os
 import numpy as np
 from numpy import linalg as LA
 import matplotlib
 import matplotlib.pyplot as plt
 import warnings
+import time
 
 from .utilities import *
 from . import clustering
@@ -39,7 +41,9 @@ class PCA:
 
     --- PARAMETERS ---
     X:          RAW data matrix, uncentered and unscaled. It must be organized
-                with the structure: (observations x variables).
+                with the structure: (observations x variables). It can be None
+                if the model is trained chunk by chunk with partial_fit: in this
+                case the number of variables is read from the first chunk.
     type X :    numpy array
 
 
@@ -66,12 +70,25 @@ class PCA:
                             'nrmse' set the num of PCs considering the reconstruction error, which
                             has to be < 10% on average
     type _assessPCs:        boolean or string
+
+    _eigen_solver:          solver used for the eigendecomposition: 'auto', 'eigh', 'svd', 'eigsh', 'fastSVD' or 'snapshot'.
+                            By default it is chosen on the basis of the matrix dimensions (see select_eigen_solver):
+                            if the variables are many more than the observations (e.g., POD of snapshot matrices,
+                            with a mesh field in each row), the method of snapshots is used.
+    type _eigen_solver:     string
+
+    _verbose:               print the information about the assessment of the number of PCs.
+    type _verbose:          boolean
     '''
     def __init__(self, X, *dictionary):
         #Useful variables from training dataset
         self.X = X
-        self.n_obs = X.shape[0]
-        self.n_var = X.shape[1]
+        if X is not None:
+            self.n_obs = X.shape[0]
+            self.n_var = X.shape[1]
+        else:
+            self.n_obs = 0
+            self.n_var = None
 
         #Decide if the input matrix must be centered:
         self._center = True
@@ -89,17 +106,25 @@ class PCA:
         self._threshold_nrmse = 0.1                                                                 # treshold in case of reconstruction error criterion
         #Set the PC number to plot or the variable's number to plot
         self._num_to_plot = 1
-        #Initialize the number of PCs
-        self._nPCs = X.shape[1] -1
+        #Initialize the number of PCs (if X is not given, it is set with the first chunk given to partial_fit)
+        self._nPCs = self.n_var -1 if self.n_var is not None else None
+        #Set the solver for the eigendecomposition
+        self._eigen_solver = 'auto'                                                                 #'auto';'eigh';'svd';'eigsh';'fastSVD';'snapshot' are available
+        #Print the information about the assessment of the number of PCs
+        self._verbose = False
+        #Statistics of the observations given to partial_fit: number, mean, scatter matrix about the mean, min and max
+        self._n_seen = 0
+        if self.n_var is not None:
+            self.initialize_statistics()
 
         if dictionary:
             settings = dictionary[0] 
             try:
                 self._nPCs = settings["number_of_eigenvectors"]
-                if self._nPCs < 0 or self._nPCs >= self.X.shape[1]:
+                if self._nPCs < 0 or (self.n_var is not None and self._nPCs >= self.n_var):
                     raise Exception
             except:
-                self._nPCs = self.X.shape[1]-1
+                self._nPCs = self.n_var -1 if self.n_var is not None else None
                 warnings.warn("An exception occured with regard to the input value for the number of PCs. It could be not acceptable, or not given to the dictionary.")
                 print("\tIt will be automatically set equal to: X.shape[1]-1.")
                 print("\tYou can ignore this warning if the number of PCs has been assigned later via setter.")
@@ -176,7 +201,7 @@ class PCA:
                 self._threshold_var = 0.95
             try:
                 self._num_to_plot = settings["variable_to_plot"]
-                if not isinstance(self._num_to_plot, int) or self._num_to_plot > self.X.shape[1]:
+                if not isinstance(self._num_to_plot, int) or (self.n_var is not None and self._num_to_plot > self.n_var):
                     raise Exception
             except:
                 self._num_to_plot = 0
@@ -184,6 +209,18 @@ class PCA:
                 print("\tIt will be automatically set equal to: 0.")
                 print("\tYou can ignore this warning if it has been assigned later via setter.")
                 print("\tOtherwise, please check the conditions which must be satisfied by the input in the detailed documentation.")
+            try:
+                self._eigen_solver = settings["eigen_solver"]
+                if self._eigen_solver not in eigen_solvers:
+                    raise Exception
+            except:
+                self._eigen_solver = 'auto'
+            try:
+                self._verbose = settings["verbose"]
+                if not isinstance(self._verbose, bool):
+                    raise Exception
+            except:
+                self._verbose = False
 
     @property
     def eigens(self):
@@ -193,8 +230,15 @@ class PCA:
     def eigens(self, new_value):
         self._nPCs = new_value
 
-        if self._nPCs <= 0 or self._nPCs >= self.X.shape[1]:
-            self._nPCs = int(self.X.shape[1]/2)
+        if self.n_var is None:
+            #the number of variables is not known yet: it is checked with the first chunk given to partial_fit
+            if self._nPCs <= 0:
+                self._nPCs = None
+                warnings.warn("An exception occured with regard to the input value for the number of PCs. It could be not acceptable, or not given to the dictionary.")
+                print("\tIt will be automatically set equal to: n_variables-1, when the first chunk is given to partial_fit.")
+                print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+        elif self._nPCs <= 0 or self._nPCs >= self.n_var:
+            self._nPCs = int(self.n_var/2)
             warnings.warn("An exception occured with regard to the input value for the number of PCs. It could be not acceptable, or not given to the dictionary.")
             print("\tIt will be automatically set equal to: X.shape[1]/2.")
             print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
@@ -307,10 +351,39 @@ class PCA:
 
     @set_num_to_plot.setter
     def set_num_to_plot(self, new_number):
-        if not isinstance(self._num_to_plot, int) or self._num_to_plot > self.X.shape[1]:
+        if not isinstance(self._num_to_plot, int) or (self.n_var is not None and self._num_to_plot > self.n_var):
             self._num_to_plot = 0
 
 
+    @property
+    def eigen_solver(self):
+        return self._eigen_solver
+
+    @eigen_solver.setter
+    def eigen_solver(self, new_solver):
+        self._eigen_solver = new_solver
+
+        if self._eigen_solver not in eigen_solvers:
+            self._eigen_solver = 'auto'
+            warnings.warn("An exception occured with regard to the input value for the eigensolver. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: auto.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def verbose(self):
+        return self._verbose
+
+    @verbose.setter
+    def verbose(self, new_bool):
+        self._verbose = new_bool
+
+        if not isinstance(self._verbose, bool):
+            self._verbose = False
+            warnings.warn("An exception occured with regard to the input value for the verbose option. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: false.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+
     @staticmethod
     def preprocess_training(X, centering_decision, scaling_decision, centering_method, scaling_method):
         '''
@@ -330,6 +403,23 @@ class PCA:
         return X_tilde
 
 
+    @staticmethod
+    def preprocessing_factors(X, centering_decision, scaling_decision, centering_method, scaling_method):
+        '''
+        Compute the centering and scaling factors used by preprocess_training (the scaling factors
+        are computed on the centered matrix), with zeros and ones if the matrix must not be centered
+        or scaled, respectively.
+        '''
+        mu = np.zeros((X.shape[1],), dtype=float)
+        sigma = np.ones((X.shape[1],), dtype=float)
+        if centering_decision:
+            mu = center(X, centering_method)
+        if scaling_decision:
+            sigma = scale(X - mu, scaling_method)
+
+        return mu, sigma
+
+
     def fit(self):
         '''
         Perform Principal Component Analysis on the dataset X,
@@ -347,23 +437,108 @@ class PCA:
         type evecs: list
 
         '''
-        #Center and scale the original training dataset
-        self.X_tilde = self.preprocess_training(self.X, self._center, self._scale, self._centering, self._scaling)
+        #Center and scale the original training dataset: the factors are stored, to be used by
+        #transform and inverse_transform
+        self.mu, self.sigma = self.preprocessing_factors(self.X, self._center, self._scale, self._centering, self._scaling)
+        self.X_tilde = center_scale(self.X, self.mu, self.sigma)
 
-        #Compute the covariance matrix
-        C = np.cov(self.X_tilde, rowvar=False) #rowvar=False because the X matrix is (observations x variables)
+        #The eigenvectors and the prescribed number of eigenvalues are computed with the selected
+        #solver, already ordered in decreasing order of magnitude
+        self.evecs, self.evals = PCA_fit(self.X_tilde, self._nPCs, self._eigen_solver)
+        #The total variance is the sum of all the eigenvalues, i.e., the trace of the covariance matrix
+        self.total_variance = np.sum(np.var(self.X_tilde, axis=0, ddof=1))
 
-        #All the eigenvectors and eigenvalues are firstly calculated
-        self.ALLevals, self.ALLevecs = LA.eig(C)
-        
-        #After that, they are ordered in decreasing order of magnitude
-        mask = np.argsort(self.ALLevals)[::-1]
-        self.evecs = self.ALLevecs[:,mask]
-        self.evals = self.ALLevals[mask]
+        return self.evecs, self.evals
 
-        #Cut the last PCs and consider only the prescribed number of eigenvectors
-        self.evecs = self.evecs[:,:self._nPCs]
-        self.evals = self.evals[:self._nPCs]
+
+    def initialize_statistics(self):
+        '''
+        Reset the statistics accumulated by partial_fit (number of observations, mean, scatter
+        matrix about the mean, minimum and maximum of each variable).
+        '''
+        self._n_seen = 0
+        self._mean = np.zeros((self.n_var,), dtype=float)
+        self._scatter = np.zeros((self.n_var, self.n_var), dtype=float)
+        self._minima = np.full((self.n_var,), np.inf)
+        self._maxima = np.full((self.n_var,), -np.inf)
+
+
+    def partial_fit(self, chunk):
+        '''
+        Update the statistics of the training data (number of observations, mean, scatter matrix
+        about the mean, minimum and maximum of each variable) with a new chunk of RAW observations.
+        The statistics of the chunk are merged with the previous ones with the parallel algorithm by
+        Chan et al., to avoid the loss of precision of the sum of squares. This allows to train a global
+        PCA from a chunked reader or a memmap, reading one block of observations at the time: the
+        decomposition can be computed at any time with finalize. The model can be built without the
+        training matrix, i.e. PCA(None): the number of variables is then set by the first chunk.
+
+
+        --- PARAMETERS ---
+        chunk:          RAW observations, uncentered and unscaled (observations x variables).
+        type chunk:     numpy array
+
+        '''
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.ndim != 2:
+            raise Exception("The chunk must be organized with the structure: (observations x variables).")
+        if self.n_var is None:
+            #the model was built without the training matrix: the first chunk sets the number of variables
+            self.n_var = chunk.shape[1]
+            if self._nPCs is None or self._nPCs >= self.n_var:
+                self._nPCs = self.n_var -1
+            self.initialize_statistics()
+        if chunk.shape[1] != self.n_var:
+            raise Exception("The second dimension of the chunk and the number of variables of the training matrix must agree.")
+        n_chunk = chunk.shape[0]
+        if n_chunk == 0:
+            return
+
+        mean_chunk = np.mean(chunk, axis=0)
+        chunk_ = chunk - mean_chunk
+        n_obs = self._n_seen + n_chunk
+        delta = mean_chunk - self._mean
+
+        self._scatter += chunk_.T @ chunk_ + np.outer(delta, delta) * (self._n_seen * n_chunk / n_obs)
+        self._mean += delta * (n_chunk / n_obs)
+        self._minima = np.minimum(self._minima, np.min(chunk, axis=0))
+        self._maxima = np.maximum(self._maxima, np.max(chunk, axis=0))
+        self._n_seen = n_obs
+
+
+    def finalize(self):
+        '''
+        Perform Principal Component Analysis from the statistics accumulated by partial_fit,
+        and retain 'n' Principal Components. The centering and scaling factors are computed as in
+        fit, and the covariance matrix of the centered and scaled data is obtained from the scatter
+        matrix. More chunks can be given to partial_fit afterwards, to update the decomposition.
+
+
+        --- RETURNS ---
+        evecs:      eigenvectors from the covariance matrix decomposition (PCs)
+        type evecs: list
+
+        evals:      eigenvalues from the covariance matrix decomposition (lambda)
+        type evecs: list
+
+        '''
+        if self._n_seen < 2:
+            raise Exception("At least two observations must be given to partial_fit before the decomposition.")
+
+        #Centering and scaling factors, from the moments of the variables
+        moments = (self._n_seen, self._mean, np.diag(self._scatter), self._minima, self._maxima)
+        mu, sigma = clustering.lpca.preprocessing_factors(None, self._center, self._scale, self._centering, self._scaling, None, moments=moments)
+        #the factors can be the accumulated moments themselves, which are updated in place by partial_fit
+        self.mu, self.sigma = np.array(mu, copy=True), np.array(sigma, copy=True)
+
+        #Covariance matrix of the scaled data: the centering does not change it
+        unscaling = self.sigma + 1E-16
+        C = self._scatter / (self._n_seen - 1) / np.outer(unscaling, unscaling)
+
+        #the data matrix is not available, so only the solvers for the covariance matrix can be used
+        solver = 'eigh' if self._eigen_solver.lower() in ('svd', 'fastsvd', 'snapshot') else self._eigen_solver
+        self.evecs, self.evals = symmetric_eigens(C, self._nPCs, solver)
+        self.total_variance = np.trace(C)
 
         return self.evecs, self.evals
 
@@ -383,33 +558,101 @@ class PCA:
         except:
             self.evecs, ____ = self.fit()
             
-
-        #Compute the centering and the scaling factors. Later they will be useful.
-        self.mu = center(self.X, self.centering)
-        self.sigma = scale(self.X, self.scaling)
-        #Reconstruct the original matrix
+        #Reconstruct the original matrix, with the centering and scaling factors computed by fit
         self.X_r = self.X_tilde @ self.evecs @ self.evecs.T
-        # Uncenter and unscale to get the reconstructed original matrix depending on
-        #the centering and scaling decisions:
-
-        #If the matrix has been centered and scaled, unscale and uncenter:
-        if self._center and self._scale:
-            X_unsc = unscale(self.X_r, self.sigma)
-            self.X_rec = uncenter(X_unsc, self.mu)
-        #If it has only been centered, uncenter:
-        elif self._center and not self._scale:
-            self.X_rec = uncenter(self.X_r, self.mu)
-        #If it has only been scaled, unscale:
-        elif self._scale and not self._center:
-            self.X_rec = unscale(self.X_r, self.sigma)
-        #Otherwise no additional operation is needed
-        else:
-            self.X_rec = self.X_r
-
+        self.X_rec = self.inverse_transform(self.X_tilde @ self.evecs)
 
         return self.X_rec
 
 
+    def transform(self, Y, block_size=None, out=None):
+        '''
+        Project a set of RAW observations on the PCA-manifold, centering and scaling them with the
+        factors computed when the model was fitted. Centering, scaling and projection are fused in a
+        single matrix product: Z = (Y - mu)/sigma A = Y (A/sigma) - (mu/sigma) A.
+
+
+        --- PARAMETERS ---
+        Y:              RAW observations, uncentered and unscaled (observations x variables).
+        type Y:         numpy array
+
+        block_size:     number of observations projected at the time (default: all).
+        type block_size: scalar
+
+        out:            matrix where the scores are stored (observations x PCs) (optional).
+        type out:       numpy array
+
+
+        --- RETURNS ---
+        Z:          scores of the observations.
+        type Z:     numpy array
+        '''
+        try:
+            self.evecs
+        except:
+            self.evecs, ____ = self.fit()
+
+        #the scaling factors are applied to the PCs, and the centering factors to the scores
+        weights = self.evecs / (self.sigma + 1E-16)[:, np.newaxis]
+        shift = self.mu @ weights
+
+        return PCA.apply_affine(Y, weights, -shift, block_size, out)
+
+
+    def inverse_transform(self, Z, block_size=None, out=None):
+        '''
+        Reconstruct the RAW observations from their scores on the PCA-manifold, unscaling and uncentering
+        them with the factors computed when the model was fitted. The reconstruction, unscaling and uncentering
+        are fused in a single matrix product: X = (Z A^T) sigma + mu = Z (A^T sigma) + mu.
+
+
+        --- PARAMETERS ---
+        Z:              scores of the observations (observations x PCs).
+        type Z:         numpy array
+
+        block_size:     number of observations reconstructed at the time (default: all).
+        type block_size: scalar
+
+        out:            matrix where the reconstructed observations are stored (observations x variables) (optional).
+        type out:       numpy array
+
+
+        --- RETURNS ---
+        X_rec:      reconstructed observations, uncentered and unscaled.
+        type X_rec: numpy array
+        '''
+        try:
+            self.evecs
+        except:
+            self.evecs, ____ = self.fit()
+
+        weights = self.evecs.T * (self.sigma + 1E-16)
+
+        return PCA.apply_affine(Z, weights, self.mu, block_size, out)
+
+
+    @staticmethod
+    def apply_affine(Y, weights, shift, block_size=None, out=None):
+        '''
+        Compute Y weights + shift, one block of rows at the time, storing the result in out.
+        '''
+        rows = Y.shape[0]
+        if out is None:
+            out = np.empty((rows, weights.shape[1]), dtype=float)
+        elif out.shape != (rows, weights.shape[1]):
+            raise Exception("The output matrix must have dimensions ({} x {}).".format(rows, weights.shape[1]))
+        if block_size is None:
+            block_size = rows
+        block_size = max(1, int(block_size))
+
+        for start in range(0, rows, block_size):
+            end = min(start + block_size, rows)
+            np.matmul(Y[start:end], weights, out=out[start:end])
+            out[start:end] += shift
+
+        return out
+
+
     def get_explained(self):
         '''
         Assess the variance explained by the first 'n_eigs' retained
@@ -430,7 +673,7 @@ class PCA:
         except:
             self.evecs, self.evals = self.fit()
         
-        explained_variance = np.cumsum(self.evals)/sum(self.ALLevals)
+        explained_variance = np.cumsum(self.evals)/self.total_variance
         explained = explained_variance[-1]
         #If the plot boolean is True, produce an image to show the explained variance curve.
         if self._plot_explained_variance:
@@ -478,6 +721,10 @@ class PCA:
         the explained variance criterion: retain nPCs such that the 95% of the original data variance is explained; the 
         second one is the nrmse criterion: retain nPCs such that the difference between the original and the reconstructed
         matrix is lower than the 10%.
+        The covariance matrix is decomposed only once: the explained variance of each number of PCs is given by the
+        cumulative sum of the eigenvalues, and the reconstruction with ii PCs is obtained from the one with ii-1 PCs by
+        adding the contribution of the ii-th PC (rank-one update). At the end, the model is fitted with the number of
+        PCs which was assessed last.
 
 
         --- RETURNS ---
@@ -487,31 +734,51 @@ class PCA:
         optimalPCs = None
         if self._assessPCs != False:
             self.plot_explained_variance = False
-            for ii in range(1, self.n_var):
+            #Decompose the covariance matrix once, retaining all the PCs which can be assessed: with
+            #less observations than variables, the PCs after the (n-1)-th one do not add any information
+            self.mu, self.sigma = self.preprocessing_factors(self.X, self._center, self._scale, self._centering, self._scaling)
+            self.X_tilde = center_scale(self.X, self.mu, self.sigma)
+            max_PCs = min(self.n_var -1, self.n_obs -1)
+            all_evecs, all_evals = PCA_fit(self.X_tilde, max_PCs, select_eigen_solver(self.n_obs, self.n_var, self.n_var))
+            self.total_variance = np.sum(np.var(self.X_tilde, axis=0, ddof=1))
+            if self._assessPCs == 'var':
+                explained_variance = np.cumsum(all_evals) / self.total_variance
+            elif self._assessPCs == 'nrmse':
+                #residuals of the reconstruction in the original units (as in recover), starting from
+                #the reconstruction with zero PCs, i.e., the centering factors
+                residuals = self.X - self.mu
+                unscaling = self.sigma + 1E-16
+                norms = np.sqrt(np.mean(self.X**2, axis=0))
+            for ii in range(1, max_PCs +1):
                 #print("Assessing the optimal number of PCs by means of: " + self._assessPCs + " criterion. Now using: {} Principal Component(s).".format(ii))
 
                 self.eigens = ii
-                self.fit()
                 #Assess the optimal number of PCs by means of the explained variance threshold (>= 99% explained is the default setting)
                 if self._assessPCs == 'var':
-                    explained = self.get_explained()
+                    explained = explained_variance[ii -1]
 
                     if explained >= self._threshold_var:
-                        #print("With {} PCs, the following percentage of variance is explained: {}".format(self.eigens, explained))
-                        #print("The variance is larger than the given fixed threshold: {}. Thus, {} PCs will be retained.".format(self._threshold_var, self.eigens))
+                        if self._verbose:
+                            print("With {} PCs, the following percentage of variance is explained: {}".format(self.eigens, explained))
+                            print("The variance is larger than the given fixed threshold: {}. Thus, {} PCs will be retained.".format(self._threshold_var, self.eigens))
                         self.plot_explained_variance = True
                         optimalPCs = ii
                         break
                 #Otherwise with the nrmse of the reconstructed matrix, which has to be below a specific threshold (<= 10% error is the default setting)
                 elif self._assessPCs == 'nrmse':
-                    reconstructed_ = self.recover()
-                    variables_reconstruction = NRMSE(self.X, reconstructed_)
+                    #add the unscaled projection on the ii-th PC to the reconstruction
+                    scores = self.X_tilde @ all_evecs[:,ii -1]
+                    residuals -= np.outer(scores, all_evecs[:,ii -1] * unscaling)
+                    variables_reconstruction = np.sqrt(np.einsum('ij,ij->j', residuals, residuals) / self.n_obs) / norms
 
                     if np.mean(variables_reconstruction) <= self._threshold_nrmse:
-                        print("With {} PCs, the following average error (NRMSE) for the variables reconstruction (from the PCA manifold) is obtained: {}".format(self.eigens, np.mean(variables_reconstruction)))
-                        print("The error is lower than the given fixed threshold: {}. Thus, {} PCs will be retained.".format(self._threshold_nrmse, self.eigens))
+                        if self._verbose:
+                            print("With {} PCs, the following average error (NRMSE) for the variables reconstruction (from the PCA manifold) is obtained: {}".format(self.eigens, np.mean(variables_reconstruction)))
+                            print("The error is lower than the given fixed threshold: {}. Thus, {} PCs will be retained.".format(self._threshold_nrmse, self.eigens))
                         optimalPCs = ii
                         break
+            self.evecs = all_evecs[:,:self._nPCs]
+            self.evals = all_evals[:self._nPCs]
         return optimalPCs
 
 
@@ -612,49 +879,14 @@ class PCA:
         #put again the user-defined number of PCs
         self.eigens = input_eigens
 
-        scores_dist = np.empty((self.X.shape[0],), dtype=float)
         #For each observation, compute the distance from the center of the manifold
-        for ii in range(0,self.X.shape[0]):
-            t_sq = 0
-            lam_j = 0
-            for jj in range(input_eigens, scores.shape[1]):
-                t_sq += scores[ii,jj]**2
-                lam_j += eigval[jj]
-            scores_dist[ii] = t_sq/(lam_j + TOL)
+        #on the last PCs
+        scores_dist = np.sum(scores[:,input_eigens:]**2, axis=1) / (np.sum(eigval[input_eigens:]) + TOL)
 
         #Now compute the distance distribution, and delete the observations in the
-        #upper 2% (done in the while loop) to get the outlier-free matrix.
-
-        #Divide the distance vector in 100 bins
-        n_bins = 100
-        min_interval = np.min(scores_dist)
-        max_interval = np.max(scores_dist)
-        
-        #compute the step of each bin
-        delta_step = (max_interval - min_interval) / n_bins
-
-        counter = 0
-        bin = np.empty((len(scores_dist),))
-        var_left = min_interval
-
-        #Find the observations in each bin (find the idx, where the classes are
-        #the different bins number)
-        while counter <= n_bins:
-            var_right = var_left + delta_step
-            mask = np.logical_and(scores_dist >= var_left, scores_dist < var_right)
-            bin[np.where(mask)] = counter
-            counter += 1
-            var_left += delta_step
-
-        unique,counts=np.unique(bin,return_counts=True)
-        cumulativeDensity = 0
-        new_counter = 0
-
-        #remove the upper 2% of the CDF, i.e., x_{i} \in [0.98; 1]
-        while cumulativeDensity < 0.98:
-            cumulative_ = counts[new_counter]/self.X.shape[0]
-            cumulativeDensity += cumulative_
-            new_counter += 1
+        #upper 2% to get the outlier-free matrix.
+        bin = PCA.distribution_bins(scores_dist).astype(float)
+        new_counter = PCA.distribution_cut(bin, self.X.shape[0])
 
         new_mask = np.where(bin > new_counter)
         self.X = np.delete(self.X, new_mask, axis=0)
@@ -694,40 +926,10 @@ class PCA:
         sq_rec_oss = np.power(epsilon_rec, 2)
 
         #Now compute the distance distribution, and delete the observations in the
-        #upper 2% (done in the while loop) to get the outlier-free matrix.
-
-        #Divide the distance vector in 100 bins
-        n_bins = 100
-        min_interval = np.min(sq_rec_oss)
-        max_interval = np.max(sq_rec_oss)
-        
-        #compute the step of each bin
-        delta_step = (max_interval - min_interval) / n_bins
-
-        counter = 0
-        bin_id = np.empty((len(epsilon_rec),))
-        var_left = min_interval
-
-        #Find the observations in each bin (find the idx, where the classes are
-        #the different bins number)
-        while counter <= n_bins:
-            var_right = var_left + delta_step
-            mask = np.logical_and(sq_rec_oss >= var_left, sq_rec_oss < var_right)
-            bin_id[np.where(mask)[0]] = counter
-            counter += 1
-            var_left += delta_step
-
-        #Compute the classes (unique) and the number of elements per class (counts)
-        unique,counts=np.unique(bin_id,return_counts=True)
-        #Declare the variables to build the CDF to select the observations belonging to the
-        #98% of the total
-        cumulativeDensity = 0
-        new_counter = 0
-
-        while cumulativeDensity < 0.98:
-            cumulative_ = counts[new_counter]/self.X.shape[0]
-            cumulativeDensity += cumulative_
-            new_counter += 1
+        #upper 2% to get the outlier-free matrix. Each observation is assigned to the
+        #highest bin of the squared errors of its variables
+        bin_id = np.max(PCA.distribution_bins(sq_rec_oss), axis=1).astype(float)
+        new_counter = PCA.distribution_cut(bin_id, self.X.shape[0])
 
         #delete the observations in the upper 2%, i.e., x_{i} \in [0.98; 1]
         new_mask = np.where(bin_id > new_counter)
@@ -736,6 +938,146 @@ class PCA:
         return self.X, bin_id, new_mask
 
 
+    @staticmethod
+    def distribution_bins(distances, n_bins=100):
+        '''
+        Divide the range of the distances in n_bins bins of equal width, and return
+        the bin of each distance (the last bin contains the maximum distance).
+        '''
+        min_interval = np.min(distances)
+        max_interval = np.max(distances)
+        #compute the step of each bin, and its bounds (accumulated, as the bins were built one at the time)
+        delta_step = (max_interval - min_interval) / n_bins
+        bounds = np.cumsum(np.concatenate(([min_interval], np.full((n_bins +1,), delta_step))))
+
+        return np.minimum(np.searchsorted(bounds, distances, side='right') -1, n_bins)
+
+
+    @staticmethod
+    def distribution_cut(bins, n_obs, quantile=0.98):
+        '''
+        Build the Cumulative Density Function of the bins, and return the number of
+        (non-empty) bins which are needed to reach the given quantile.
+        '''
+        unique, counts = np.unique(bins, return_counts=True)
+        cumulativeDensity = np.cumsum(counts / n_obs)
+
+        return int(np.searchsorted(cumulativeDensity, quantile, side='left')) +1
+
+
+    def outlier_scores(self, Y=None, block_size=None):
+        '''
+        Compute the Hotelling T^2 and the Q (squared prediction error) statistics of a set of
+        observations with respect to the fitted PCA model, i.e., for each observation x with
+        scores z on the retained PCs A:
+        T^2 = sum_k z_k^2 / l_k         Q = ||x - z A^T||^2
+        in the centered and scaled space. The observations are processed in blocks of rows, with
+        the centering and scaling factors computed by fit (or finalize), so that new data can be
+        screened without fitting the model again.
+
+
+        --- PARAMETERS ---
+        Y:              RAW observations, uncentered and unscaled (default: the training matrix).
+        type Y:         numpy array
+
+        block_size:     number of observations processed at the time (default: all).
+        type block_size: scalar
+
+
+        --- RETURNS ---
+        T2:         Hotelling T^2 statistic of each observation.
+        type T2:    numpy array
+
+        Q:          Q statistic (squared reconstruction error) of each observation.
+        type Q:     numpy array
+        '''
+        try:
+            self.evecs
+        except:
+            self.evecs, self.evals = self.fit()
+        if Y is None:
+            Y = self.X
+
+        rows = Y.shape[0]
+        if block_size is None:
+            block_size = rows
+        block_size = max(1, int(block_size))
+        TOL = 1E-16
+
+        T2 = np.empty((rows,), dtype=float)
+        Q = np.empty((rows,), dtype=float)
+        for start in range(0, rows, block_size):
+            end = min(start + block_size, rows)
+            Y_tilde = center_scale(np.asarray(Y[start:end], dtype=float), self.mu, self.sigma)
+            scores = Y_tilde @ self.evecs
+            T2[start:end] = np.einsum('ij,ij->i', scores, scores / (self.evals + TOL))
+            residuals = Y_tilde - scores @ self.evecs.T
+            Q[start:end] = np.einsum('ij,ij->i', residuals, residuals)
+
+        return T2, Q
+
+
+    def outlier_limits(self, quantile=0.98, block_size=None):
+        '''
+        Compute the limits of the T^2 and Q statistics as the given quantile of the statistics
+        of the training observations. The limits are stored (T2_limit and Q_limit), to be used
+        by outlier_mask for the new observations.
+
+
+        --- RETURNS ---
+        T2_limit:       limit of the Hotelling T^2 statistic.
+        type T2_limit:  scalar
+
+        Q_limit:        limit of the Q statistic.
+        type Q_limit:   scalar
+        '''
+        T2, Q = self.outlier_scores(block_size=block_size)
+        self.T2_limit = np.quantile(T2, quantile)
+        self.Q_limit = np.quantile(Q, quantile)
+
+        return self.T2_limit, self.Q_limit
+
+
+    def outlier_mask(self, Y=None, method='both', block_size=None):
+        '''
+        Screen a set of observations for outliers: an observation is an outlier if its T^2 (leverage)
+        or its Q (orthogonal) statistic exceeds the limit computed by outlier_limits (which is called
+        with the default quantile, if the limits have not been computed yet). The observations are not
+        copied: a boolean mask is returned, so that new observations can be screened in streaming
+        (the observations to be kept are selected with ~mask).
+
+
+        --- PARAMETERS ---
+        Y:              RAW observations, uncentered and unscaled (default: the training matrix).
+        type Y:         numpy array
+
+        method:         statistics to be checked: 'leverage' (T^2), 'orthogonal' (Q) or 'both'.
+        type method:    string
+
+        block_size:     number of observations processed at the time (default: all).
+        type block_size: scalar
+
+
+        --- RETURNS ---
+        mask:       True for the observations which are outliers.
+        type mask:  numpy array
+        '''
+        try:
+            self.T2_limit
+        except:
+            self.outlier_limits(block_size=block_size)
+
+        T2, Q = self.outlier_scores(Y, block_size)
+        if method.lower() == 'leverage':
+            return T2 > self.T2_limit
+        elif method.lower() == 'orthogonal':
+            return Q > self.Q_limit
+        elif method.lower() == 'both':
+            return np.logical_or(T2 > self.T2_limit, Q > self.Q_limit)
+        else:
+            raise Exception("Unsupported outlier detection method. Please choose: LEVERAGE, ORTHOGONAL or BOTH.")
+
+
 class LPCA(PCA):
     '''
     Perfom model order reduction via Local Principal Component Analysis (LPCA).
@@ -757,20 +1099,36 @@ class LPCA(PCA):
 
 
     --- SETTERS ---
-    _path_to_idx:           path to the .txt file containing the class assignment for the matrix
+    _path_to_idx:           path to the folder with the .txt file ('idx.txt') containing the class assignment
+                            for the matrix, or path to a binary .npy file containing it
     type _path_to_idx:      string
 
+    _idx:                   class assignment for the matrix (observations). It can be given in memory (also
+                            as a np.memmap), or as the path to a binary .npy file, which is memory-mapped.
+                            If given, path_to_idx is not used. Otherwise, the idx is read from path_to_idx
+                            at the first fit, and it is kept for the following ones.
+    type _idx:              numpy array
+
     _clust_to_plot:          number of cluster where the chosen LPCs must be plotted
     type   _clust_to_plot:   scalar
 
+    _model:                 previously fitted lpca model (clustering.lpca_model), or path to the .npz file
+                            where it was saved, or a fitted clustering.lpca object. If given, the idx, the
+                            centroids and the LPCs are taken from the model, and they are not computed again.
+    type _model:            lpca_model
+
     '''
     def __init__(self,X, *dictionary):
         #Set the path where the file 'idx.txt' (containing the partitioning solution) is located
         self._path_to_idx = 'path'
+        #Class assignment for the matrix (if None, it is read from path_to_idx):
+        self._idx = None
         #Set the PC number to plot or the variable's number to plot
         self._num_to_plot = 1
         #Set the cluster number where plot the PC
         self._clust_to_plot = 1
+        #Previously fitted lpca model:
+        self._model = None
 
         super().__init__(X)
 
@@ -861,10 +1219,29 @@ class LPCA(PCA):
     @path_to_idx.setter
     def path_to_idx(self, new_string):
         self._path_to_idx = new_string
+        #the idx previously read from the old path, and the LPCs, are not valid anymore
+        self._idx = None
+        self.clear_fit()
 
         if not isinstance(self._path_to_idx, str):
             self._path_to_idx = ' '
 
+    @property
+    def idx(self):
+        return self._idx
+
+    @idx.setter
+    def idx(self, new_idx):
+        if isinstance(new_idx, str):
+            new_idx = self.get_idx(new_idx)
+        if new_idx is not None:
+            new_idx = np.asarray(new_idx) if not isinstance(new_idx, np.ndarray) else new_idx
+            #integer arrays (and memmaps) are kept as they are, without copying them
+            if not np.issubdtype(new_idx.dtype, np.integer):
+                new_idx = new_idx.astype(int)
+        self._idx = new_idx
+        self.clear_fit()
+
     @property
     def clust_to_plot(self):
         return self._clust_to_plot
@@ -876,18 +1253,62 @@ class LPCA(PCA):
         if not isinstance(self._clust_to_plot, int) or self._clust_to_plot < 0:
             raise Exception
 
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, new_model):
+        if isinstance(new_model, str):
+            new_model = clustering.lpca_model.load(new_model)
+        elif isinstance(new_model, clustering.lpca):
+            #fitted lpca object: its model is taken (None if it was not fitted yet)
+            new_model = getattr(new_model, "model", None)
+            if new_model is None:
+                warnings.warn("The given lpca object has not been fitted yet.")
+        self._model = new_model
+
+        if self._model is not None and not isinstance(self._model, clustering.lpca_model):
+            self._model = None
+            warnings.warn("An exception occured with regard to the input value for the fitted model. It must be a lpca_model, or the path to the file where it was saved.")
+            print("\tThe LPCs will be computed from the idx.")
+        self.clear_fit()
+
+    def clear_fit(self):
+        '''
+        Remove the LPCs, the u_scores, the eigenvalues and the centroids of the last fit, which
+        are not valid anymore after a change of the idx or of the fitted model.
+        '''
+        for attribute in ("LPCs", "u_scores", "Leigen", "centroids", "_fit_settings"):
+            self.__dict__.pop(attribute, None)
+
+    def fit_settings(self):
+        '''
+        Return the settings the LPCs depend on: the idx (and the fitted model), the number of
+        PCs and the preprocessing. The LPCs are computed again if they have changed since the last fit.
+        '''
+        return (id(self._idx), id(self._model), self._nPCs, self._center, self._scale, self._centering, self._scaling)
+
     @staticmethod
     def get_idx(path):
         '''
-        try to load the solution obtained from a previous partitioned given a path
+        try to load the solution obtained from a previous partitioned given a path:
+        a binary .npy file is memory-mapped, otherwise the file 'idx.txt' in the
+        given folder is parsed
         '''
 
+        if not path.endswith('.npy'):
+            path = os.path.join(path, 'idx.txt')
+        if not os.path.isfile(path):
+            raise FileNotFoundError("Could not find the selected file: " + path)
+
         try:
+            if path.endswith('.npy'):
+                return np.load(path, mmap_mode='r')
             print("Reading idx..")
-            idx = np.genfromtxt(path + '/idx.txt', delimiter= ',')
-        except OSError:
-            print("Could not open/read the selected file: " + path + 'idx.txt')
-            exit()
+            idx = np.genfromtxt(path, delimiter= ',')
+        except (OSError, ValueError):
+            raise ValueError("Could not read the selected file: " + path)
 
         return idx
 
@@ -919,13 +1340,18 @@ class LPCA(PCA):
         centroids:      centroids in each cluster 
         type centroids:  list of k elements
         '''
-        #Load the idx (from a previous clustering partitioning) from the given path.
-        #after that, compute the number of clusters and preprocess the training matrix
-        #with the given settings
-        self.idx = self.get_idx(self.path_to_idx)
+        if self._model is not None and self._model.idx is not None:
+            return self.fit_from_model()
+
+        #Load the idx (from a previous clustering partitioning) from the given path, if
+        #it was not given or already read. After that, compute the number of clusters and
+        #preprocess the training matrix with the given settings
+        if self._idx is None:
+            self.idx = self.get_idx(self.path_to_idx)
         self.check_sanity_input()
-        self.k = int(max(self.idx) +1)
-        self.X_tilde = self.preprocess_training(self.X, self.to_center, self.to_scale, self.centering, self.scaling)
+        self.k = int(np.max(self.idx) +1)
+        self.mu, self.sigma = self.preprocessing_factors(self.X, self._center, self._scale, self._centering, self._scaling)
+        self.X_tilde = center_scale(self.X, self.mu, self.sigma)
 
         #Initialize the lists containing the variables of interest
         self.centroids = [None] *self.k
@@ -935,63 +1361,100 @@ class LPCA(PCA):
 
         #In each cluster, compute the centroid. After that, center inside the cluster (with the centroid)
         #and perform PCA to obtain the LocalPCs and the LocalEigens.
+        order, offsets = get_membership(self.idx, self.k)
         for ii in range (0,self.k):
-            cluster = get_cluster(self.X_tilde, self.idx, ii)
+            cluster = self.X_tilde[order[offsets[ii]:offsets[ii+1]]]
             self.centroids[ii], cluster_ = center(cluster, self._centering, True)
             self.LPCs[ii], self.Leigen[ii] = PCA_fit(cluster_, self._nPCs)
             self.u_scores[ii] = cluster_ @ self.LPCs[ii]
 
+        self._fit_settings = self.fit_settings()
+
+        return self.LPCs, self.u_scores, self.Leigen, self.centroids
+
+
+    def fit_from_model(self):
+        '''
+        Take the idx, the LPCs, the eigenvalues and the centroids from the fitted lpca model,
+        and compute only the u_scores. The training matrix is preprocessed with the centering
+        and scaling factors stored in the model.
+        '''
+        self.idx = np.asarray(self._model.idx, dtype=int)
+        self.check_sanity_input()
+        self.k = self._model.k
+        self.mu, self.sigma = np.asarray(self._model.mu), np.asarray(self._model.sigma)
+        self.X_tilde = self._model.preprocess(self.X)
+
+        self.centroids = [np.asarray(self._model.centroids[ii]) for ii in range(0, self.k)]
+        self.LPCs = [np.asarray(self._model.local_modes(ii)) for ii in range(0, self.k)]
+        self.Leigen = [np.asarray(self._model.eigenvalues[ii]) for ii in range(0, self.k)]
+        self.u_scores = [None] *self.k
+
+        order, offsets = get_membership(self.idx, self.k)
+        for ii in range (0,self.k):
+            cluster_ = self.X_tilde[order[offsets[ii]:offsets[ii+1]]] - self.centroids[ii]
+            self.u_scores[ii] = cluster_ @ self.LPCs[ii]
+
+        self._fit_settings = self.fit_settings()
+
         return self.LPCs, self.u_scores, self.Leigen, self.centroids
 
 
+    def compress(self, dtype=float):
+        '''
+        Build the compressed representation of the training matrix (see lpca_compressed): the idx,
+        the scores of each observation on the LPCs of its cluster, the LPCs and the centroids of
+        the clusters, and the global centering and scaling factors. The LPCs are computed by fit,
+        if this was not done yet or if the idx, the number of PCs or the preprocessing have changed.
+
+
+        --- PARAMETERS ---
+        dtype:          type used to store the scores (e.g., np.float32 to halve the size).
+        type dtype:     numpy dtype
+
+
+        --- RETURNS ---
+        compressed:         compressed matrix.
+        type compressed:    lpca_compressed
+        '''
+        if getattr(self, "_fit_settings", None) != self.fit_settings():
+            self.LPCs, self.u_scores, self.Leigen, self.centroids = self.fit()
+
+        rows, cols = self.X.shape
+        idx = np.asarray(self.idx, dtype=int)
+        n_PCs = np.array([LPCs_.shape[1] for LPCs_ in self.LPCs], dtype=int)
+        modes = np.zeros((self.k, cols, np.max(n_PCs)), dtype=float)
+        eigenvalues = np.zeros((self.k, cols), dtype=float)
+        scores = np.zeros((rows, np.max(n_PCs)), dtype=dtype)
+
+        #the u_scores of each cluster are sorted as its observations in the training matrix
+        order, offsets = get_membership(idx, self.k)
+        for ii in range(0, self.k):
+            modes[ii, :, :n_PCs[ii]] = self.LPCs[ii]
+            eigenvalues[ii, :len(self.Leigen[ii])] = self.Leigen[ii]
+            scores[order[offsets[ii]:offsets[ii+1]], :n_PCs[ii]] = self.u_scores[ii]
+
+        #the idx is stored with the smallest integer type
+        idx = idx.astype(np.min_scalar_type(self.k -1))
+        model = clustering.lpca_model(self.mu, self.sigma, np.array(self.centroids, dtype=float), modes, eigenvalues, n_PCs, idx)
+
+        return lpca_compressed(model, scores)
+
+
     def recover(self):
         '''
         Reconstruct the original matrix from the 'k' local reduced PCA-manifolds.
         Given the idx vector, for each cluster the points are reconstructed from the
-        local manifolds spanned by the local PCs.
+        local manifolds spanned by the local PCs. The LPCs are computed by fit, if this
+        was not done yet or if its settings have changed, and the matrix is decoded from
+        its compressed representation.
 
 
         --- RETURNS ---
         X_rec:      matrix reconstructed by means of the LPCs 
         type X_rec: numpy matrix
         '''
-
-        #Initialize the reconstructed matrix, and center the input matrix
-        self.X_rec = np.empty(self.X.shape, dtype=float)
-        self.X_tilde = self.preprocess_training(self.X, self.to_center, self.to_scale, self.centering, self.scaling)
-
-        #The centering and scaling factors are computed from the training matrix
-        #because they will be used in the future to unscale/uncenter
-        mu_global = center(self.X, self.centering)
-        sigma_global = scale(self.X, self.scaling)
-
-        #Perform LPCA
-        self.LPCs, self.u_scores, self.Leigen, self.centroids = self.fit()
-
-        #Considering the idx of that set of partition
-        for ii in range (0,self.k):
-            cluster_ = get_cluster(self.X_tilde, self.idx, ii)
-            centroid_ =self.centroids[ii]
-            C = np.empty(cluster_.shape, dtype=float)
-            C = (cluster_ - centroid_) @ self.LPCs[ii] @ self.LPCs[ii].T
-            C_ = uncenter(C, centroid_)
-            positions = np.where(self.idx == ii)
-            self.X_rec[positions] = C_
-
-        #unscale and uncenter to get back the original values
-
-        if self._center and self._scale:
-            X_unsc = unscale(self.X_rec, sigma_global)
-            self.X_rec = uncenter(X_unsc, mu_global)
-        #If it has only been centered, uncenter:
-        elif self._center and not self._scale:
-            self.X_rec = uncenter(self.X_rec, mu_global)
-        #If it has only been scaled, unscale:
-        elif self._scale and not self._center:
-            self.X_rec = unscale(self.X_rec, sigma_global)
-        #Otherwise no additional operation is needed
-        else:
-            self.X_rec = self.X_rec
+        self.X_rec = self.compress().decode()
 
         return self.X_rec
 
@@ -1041,6 +1504,147 @@ class LPCA(PCA):
         plt.show()
 
 
+class lpca_compressed:
+    '''
+    Compressed representation of a matrix with Local PCA: each observation is stored as the number
+    of its cluster and its scores on the LPCs of the cluster. The LPCs, the centroids and the global
+    centering and scaling factors are stored in a lpca_model (see clustering.lpca_model), whose idx
+    is the cluster of each observation. The observations are decoded as:
+    x = (z A_j^T + c_j) sigma + mu
+    where the unscaling and uncentering are fused with the LPCs and the centroids of each cluster,
+    so each cluster is decoded with a single matrix product. The representation is built by
+    LPCA.compress, and it can be saved in a binary .npz file, which can be loaded back with the
+    arrays memory-mapped.
+
+
+    --- PARAMETERS ---
+    model:          the Local PCA model, with the idx of the observations.
+    type model:     lpca_model
+
+    scores:         scores of each observation on the LPCs of its cluster (observations x q).
+    type scores:    numpy array
+    '''
+    def __init__(self, model, scores):
+        self.model = model
+        self.scores = scores
+        #Batches smaller than this are decoded row by row, without sorting them by cluster:
+        self.__gatherSize = 256
+        self._decoder = None
+
+    def decoder(self):
+        '''
+        Return the decoding matrices (k x q x variables) and offsets (k x variables) of the clusters,
+        i.e., the LPCs and the centroids with the unscaling and the uncentering applied.
+        '''
+        if self._decoder is None:
+            unscaling = np.asarray(self.model.sigma, dtype=float) + 1E-16
+            modes = np.array(self.model.modes, dtype=float)
+            #the LPCs which are not retained in a cluster are null
+            for ii in range(0, self.model.k):
+                modes[ii, :, self.model.n_PCs[ii]:] = 0
+            weights = np.transpose(modes, (0, 2, 1)) * unscaling
+            shifts = np.asarray(self.model.centroids, dtype=float) * unscaling + self.model.mu
+            self._decoder = (weights, shifts)
+
+        return self._decoder
+
+    def decode_batch(self, clusters, scores, out=None):
+        '''
+        Decode a batch of observations, given their cluster and their scores. Small batches are decoded
+        row by row, otherwise the observations are sorted by cluster and each cluster is decoded with a
+        single matrix product on a contiguous block.
+
+        --- PARAMETERS ---
+        clusters:       cluster of each observation (observations).
+        type clusters:  numpy array
+
+        scores:         scores of each observation on the LPCs of its cluster (observations x q).
+        type scores:    numpy array
+
+        out:            matrix where the decoded observations are stored (observations x variables) (optional).
+        type out:       numpy array
+
+
+        --- RETURNS ---
+        X_rec:      decoded observations, uncentered and unscaled.
+        type X_rec: numpy array
+        '''
+        weights, shifts = self.decoder()
+        clusters = np.asarray(clusters, dtype=int)
+        scores = np.asarray(scores, dtype=float)
+        rows = len(clusters)
+        if out is None:
+            out = np.empty((rows, weights.shape[2]), dtype=float)
+        elif out.shape != (rows, weights.shape[2]):
+            raise Exception("The output matrix must have dimensions (observations x variables).")
+
+        if rows <= self.__gatherSize:
+            np.einsum('ij,ijk->ik', scores, weights[clusters], out=out)
+            out += shifts[clusters]
+        else:
+            order, offsets = get_membership(clusters, self.model.k)
+            scores_sorted = scores[order]
+            X_sorted = np.empty(out.shape, dtype=float)
+            for ii in np.flatnonzero(np.diff(offsets)):
+                np.matmul(scores_sorted[offsets[ii]:offsets[ii+1]], weights[ii], out=X_sorted[offsets[ii]:offsets[ii+1]])
+                X_sorted[offsets[ii]:offsets[ii+1]] += shifts[ii]
+            out[order] = X_sorted
+
+        return out
+
+    def decode(self, rows=None, block_size=None, out=None):
+        '''
+        Decode the stored observations (all of them, or a subset of rows), one block at the time.
+
+        --- PARAMETERS ---
+        rows:           indices (or boolean mask) of the observations to decode (default: all).
+        type rows:      numpy array
+
+        block_size:     number of observations decoded at the time (default: all).
+        type block_size: scalar
+
+        out:            matrix where the decoded observations are stored (optional).
+        type out:       numpy array
+
+
+        --- RETURNS ---
+        X_rec:      decoded observations, uncentered and unscaled.
+        type X_rec: numpy array
+        '''
+        if rows is None:
+            rows = np.arange(self.scores.shape[0])
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        if out is None:
+            out = np.empty((len(rows), self.model.mu.shape[0]), dtype=float)
+        if block_size is None:
+            block_size = max(len(rows), 1)
+
+        for start in range(0, len(rows), block_size):
+            rows_ = rows[start:start+block_size]
+            self.decode_batch(self.model.idx[rows_], self.scores[rows_], out=out[start:start+len(rows_)])
+
+        return out
+
+    def save(self, path):
+        '''
+        Save the compressed matrix in a binary .npz file. The file is not compressed,
+        so it can be loaded memory-mapped (see lpca_compressed.load).
+        '''
+        np.savez(path, scores=self.scores, **self.model.arrays())
+
+    @staticmethod
+    def load(path, mmap=True):
+        '''
+        Load a compressed matrix saved with lpca_compressed.save. If mmap is True, the
+        arrays are memory-mapped from the .npz file (see clustering.lpca_model.read_arrays).
+        '''
+        arrays = clustering.lpca_model.read_arrays(path, mmap)
+
+        return lpca_compressed(clustering.lpca_model.from_arrays(arrays), arrays["scores"])
+
+
 class KPCA(PCA):
     def __init__(self, X, *dictionary):
 
@@ -2220,6 +2824,15 @@ class NMF():
                             squares ('ALS') or the multiplicative update rule ('mur').
     type _algorithm:        string
 
+    _verbose:               print the information about the algorithm at each iteration.
+    type _verbose:          boolean
+
+    _callback:              function called at the end of each iteration with a dictionary containing: the
+                            'iteration' number, the reconstruction 'error', its relative 'variation', the number
+                            of 'labels_changed' (None for NMF) and the 'timings' of the iteration phases (in seconds).
+                            If the function returns True, the algorithm is stopped.
+    type _callback:         function
+
     __iterMax:              maximum number of iterations for the iterative algorithm (PRIVATE)
     type   __iterMax:       scalar
     
@@ -2253,6 +2866,10 @@ class NMF():
         #alternating least squares ('ALS') or the multiplicative update rule ('mur')
         self._algorithm = 'mur'
 
+        #print the information at each iteration, and function called at the end of each iteration:
+        self._verbose = False
+        self._callback = None
+
         #private properties for iterative algorithm
         self.__iterMax = 1000
         self.__convergence = False
@@ -2353,6 +2970,12 @@ class NMF():
             except:
                 self._metric = 'frobenius'
                 print("Using Frobenius norm to compute the reconstruction accuracy.")
+            try:
+                self._verbose = settings["verbose"]
+                if not isinstance(self._verbose, bool):
+                    raise Exception
+            except:
+                self._verbose = False
 
 
     @property
@@ -2510,6 +3133,34 @@ class NMF():
             print("\tIt will be automatically set equal to: ALS.")
             print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
 
+    @property
+    def verbose(self):
+        return self._verbose
+
+    @verbose.setter
+    def verbose(self, new_bool):
+        self._verbose = new_bool
+
+        if not isinstance(self._verbose, bool):
+            self._verbose = False
+            warnings.warn("An exception occured with regard to the input value for the verbose option. It could be not acceptable, or not given to the dictionary.")
+            print("\tIt will be automatically set equal to: false.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
+    @property
+    def callback(self):
+        return self._callback
+
+    @callback.setter
+    def callback(self, new_function):
+        self._callback = new_function
+
+        if self._callback is not None and not callable(self._callback):
+            self._callback = None
+            warnings.warn("An exception occured with regard to the input value for the callback. It must be a function, or None.")
+            print("\tIt will be automatically set equal to: None.")
+            print("\tPlease check the conditions which must be satisfied by the input in the detailed documentation.")
+
     @staticmethod
     def preprocess_training(X, centering_decision, scaling_decision, centering_method, scaling_method):
 
@@ -2626,6 +3277,8 @@ class NMF():
             eps_tol = 1E-16
 
             while not self.__convergence and iteration < self.__iterMax:
+                timings = {}
+                start_time = time.perf_counter()
 
                 if self._method.lower() == 'standard':
                     #optimize H, and after that delete negative coefficients
@@ -2661,6 +3314,8 @@ class NMF():
 
 
                 #Compute the reconstructed matrix from the reduced-order basis
+                timings["update"] = time.perf_counter() - start_time
+                start_time = time.perf_counter()
                 X_rec = self.W @ self.H 
 
 
@@ -2677,11 +3332,15 @@ class NMF():
                 eps_rec_var = np.abs((eps_rec_new - eps_rec) / (eps_rec_new) + eps_tol)
                 eps_rec = eps_rec_new
 
+                timings["error"] = time.perf_counter() - start_time
+                stop = self._callback is not None and self._callback({"iteration": iteration, "error": eps_rec_new, "variation": eps_rec_var, "labels_changed": None, "timings": timings})
+
                 #Check if the convergence conditions have been satisfied
-                if eps_rec_var > convTol and iteration < self.__iterMax:
-                    print("Iteration number: {}".format(iteration))
-                    print("\tReconstruction error: {}".format(eps_rec_new))
-                    print("\tReconstruction error variance: {}".format(eps_rec_var))
+                if eps_rec_var > convTol and iteration < self.__iterMax and not stop:
+                    if self._verbose:
+                        print("Iteration number: {}".format(iteration))
+                        print("\tReconstruction error: {}".format(eps_rec_new))
+                        print("\tReconstruction error variance: {}".format(eps_rec_var))
                     iteration +=1
                 else:
                     #scale again the W matrix to have unitary L2-norm before lstsq as prescribed in [3]
@@ -2690,8 +3349,9 @@ class NMF():
                         self.W[:,jj] = self.W[:,jj]/tmp 
                         tmp2 = norm(self.H[jj,:])
                         self.H[jj,:] = self.H[jj,:]/tmp
-                    print("Convergence has been reached after {} iterations.".format(iteration))
-                    print("\tFinal reconstruction error variance: {}".format(eps_rec_var))
+                    if self._verbose:
+                        print("Convergence has been reached after {} iterations.".format(iteration))
+                        print("\tFinal reconstruction error variance: {}".format(eps_rec_var))
                     
                     break
         
@@ -2710,6 +3370,8 @@ class NMF():
             self.H[mask] = 0
 
             while not self.__convergence and iteration < self.__iterMax:
+                timings = {}
+                start_time = time.perf_counter()
                 if self._metric.lower() == 'frobenius':
                     phi = self.W.T @ A                                                          #(k x m) @ (m x n) = (k x n)
                     chi = (self.W.T @ self.W @ self.H) + +1E-16                                 #(k x m) @ (m x k) @ (k x n) = (k x n)
@@ -2741,6 +3403,8 @@ class NMF():
                     self.W *= gamma
 
 
+                timings["update"] = time.perf_counter() - start_time
+                start_time = time.perf_counter()
                 X_rec = self.W @ self.H 
 
 
@@ -2757,11 +3421,15 @@ class NMF():
                 eps_rec_var = np.abs((eps_rec_new - eps_rec) / (eps_rec_new) + eps_tol)
                 eps_rec = eps_rec_new
 
+                timings["error"] = time.perf_counter() - start_time
+                stop = self._callback is not None and self._callback({"iteration": iteration, "error": eps_rec_new, "variation": eps_rec_var, "labels_changed": None, "timings": timings})
+
                 #Check if the convergence conditions have been satisfied
-                if eps_rec_var > convTol and iteration < self.__iterMax:
-                    print("Iteration number: {}".format(iteration))
-                    print("\tReconstruction error: {}".format(eps_rec_new))
-                    print("\tReconstruction error variance: {}".format(eps_rec_var))
+                if eps_rec_var > convTol and iteration < self.__iterMax and not stop:
+                    if self._verbose:
+                        print("Iteration number: {}".format(iteration))
+                        print("\tReconstruction error: {}".format(eps_rec_new))
+                        print("\tReconstruction error variance: {}".format(eps_rec_var))
                     iteration +=1
                 else:
                     #scale again the W matrix to have unit L2-norm as prescribed in [3]
@@ -2770,8 +3438,9 @@ class NMF():
                         self.W[:,jj] = self.W[:,jj]/tmp 
                         #tmp2 = norm(self.H[jj,:])
                         self.H[jj,:] = self.H[jj,:]/tmp
-                    print("Convergence has been reached after {} iterations.".format(iteration))
-                    print("\tFinal reconstruction error variance: {}".format(eps_rec_var))
+                    if self._verbose:
+                        print("Convergence has been reached after {} iterations.".format(iteration))
+                        print("\tFinal reconstruction error variance: {}".format(eps_rec_var))
                     
                     break
 
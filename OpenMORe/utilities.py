@@ -19,11 +19,15 @@ import numpy as np
 from numpy import linalg as LA
 import functools
 import time
+import warnings
 
 
 import matplotlib
 import matplotlib.pyplot as plt
-__all__ = ["unscale", "uncenter", "center", "scale", "center_scale", "evaluate_clustering_PHC", "fastSVD", "get_centroids", "get_cluster", "get_all_clusters", "explained_variance", "evaluate_clustering_DB", "NRMSE", "PCA_fit", "readCSV", "varimax_rotation", "get_medianoids", "split_for_validation", "get_medoids"]
+__all__ = ["unscale", "uncenter", "center", "scale", "center_scale", "evaluate_clustering_PHC", "fastSVD", "get_centroids", "get_cluster", "get_all_clusters", "explained_variance", "evaluate_clustering_DB", "NRMSE", "PCA_fit", "readCSV", "varimax_rotation", "get_medianoids", "split_for_validation", "get_medoids", "get_reconstruction_errors", "parallel_map", "get_sufficient_statistics", "PCA_from_statistics", "update_sufficient_statistics", "get_membership", "get_nearest_centroids", "get_cluster_statistics", "PCA_from_covariances", "eigen_solvers", "select_eigen_solver", "symmetric_eigens"]
+
+#solvers available for the eigendecomposition in PCA_fit and the other PCA functions (see select_eigen_solver)
+eigen_solvers = ("auto", "eigh", "svd", "eigsh", "fastSVD", "snapshot")
 
 
 # ------------------------------
@@ -110,12 +114,16 @@ def explained_variance(X, n_eigs, plot=False):
     - Output:
     explained: percentage of explained variance -- dim: (scalar)
     '''
-    #compute PCA
-    PCs, eigens = PCA_fit(X, n_eigs)
+    #compute PCA: all the eigenvalues are needed, so a full solver is used. The last one is
+    #given by the total variance (the trace of the covariance matrix) minus the others
+    cols = X.shape[1]
+    PCs, eigens = PCA_fit(X, cols -1, select_eigen_solver(X.shape[0], cols, cols))
+    total_variance = np.sum(np.var(X, axis=0, ddof=1))
+    eigens = np.append(eigens, max(total_variance - np.sum(eigens), 0))
     
     #the explained variance is defined as the sum of the 'q' eigenvalues to retain
     #divided by the total sum of the eigenvalues
-    explained_variance = np.cumsum(eigens)/sum(eigens)
+    explained_variance = np.cumsum(eigens)/total_variance
     explained = explained_variance[n_eigs]
 
     #plot the curve of the cumulative variance, if the option is activated
@@ -140,45 +148,37 @@ def evaluate_clustering_DB(X, idx):
     clustering solution. The more it approaches to zero, the better
     the clustering solution is. -- Tested OK with comparison Matlab
     """
-    from scipy.spatial.distance import euclidean, cdist
+    from scipy.spatial.distance import cdist
     
     #Initialize matrix and other quantitites
     k = int(np.max(idx) +1)
-    centroids_list = [None] *k
-    S_i = [None] *k
-    M_ij = np.zeros((k,k), dtype=float)
     TOL = 1E-16
 
-    #For each cluster, compute the mean distance between the points and their centroids
-    for ii in range(0,k):
-        cluster_ = get_cluster(X, idx, ii)
-        centroids_list[ii] = get_centroids(cluster_)
-        S_i[ii] = np.mean(cdist(cluster_, centroids_list[ii].reshape((1,-1))))  #reshape centroids_list[ii] from (n,) to (1,n)
+    #For each cluster, compute the mean distance between the points and their centroids:
+    #the observations are grouped only once, sorting the membership vector
+    order, offsets = get_membership(idx, k)
+    counts = np.diff(offsets)
+    X_sorted = np.take(X, order[:offsets[-1]], axis=0)
+    centroids = np.zeros((k, X.shape[1]), dtype=float)
+    S_i = np.full(k, np.nan)
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty) > 0:
+        starts = offsets[:-1][nonempty]
+        centroids[nonempty] = np.add.reduceat(X_sorted, starts, axis=0) / counts[nonempty, np.newaxis]
+        distances = np.linalg.norm(X_sorted - np.repeat(centroids, counts, axis=0), axis=1)
+        S_i[nonempty] = np.add.reduceat(distances, starts) / counts[nonempty]
 
     #Compute the distance between once centroid and all the others:
-    for ii in range(0,k):
-        for jj in range(0,k):
-            if ii != jj:
-                M_ij[ii,jj] = euclidean(centroids_list[ii], centroids_list[jj])
-            else:
-                M_ij[ii,jj] = 1
-
-    R_ij = np.empty((k,k),dtype=float)
+    M_ij = cdist(centroids, centroids)
+    np.fill_diagonal(M_ij, 1)
 
     #Compute the R_ij coefficient for each couple of clusters, using the
     #two coefficients S_ij and M_ij
-    for ii in range(0,k):
-        for jj in range(0,k):
-            if ii != jj:
-                R_ij[ii,jj] = (S_i[ii] + S_i[jj])/M_ij[ii,jj] +TOL
-            else:
-                R_ij[ii,jj] = 0
-
-    D_i = [None] *k
+    R_ij = (S_i[:, np.newaxis] + S_i[np.newaxis, :])/M_ij +TOL
+    np.fill_diagonal(R_ij, 0)
 
     #Compute the Davies-Bouldin index as the mean of the maximum R_ij value
-    for ii in range(0,k):
-        D_i[ii] = np.max(R_ij[ii], axis=0)
+    D_i = np.max(R_ij, axis=1)
 
     #The final DB index is the mean value of the DBs for each cluster
     DB = np.mean(D_i)
@@ -200,37 +200,31 @@ def evaluate_clustering_PHC(X, idx):
     PHC_coeff = vector with the PHC scores for each cluster -- dim: (number_of_cluster)
     '''
 
-    k = max(idx) +1
+    k = int(np.max(idx) +1)
     TOL = 1E-16
     PHC_coeff=[None] *k
     PHC_deviations=[None] *k
 
     #The standard PHC for one variable is computed as: (max - min)/ mean
     #If the training matrix has more than 1 variable, the PHCs are stored in a list PHC_coeff.
+    #The max, min and mean of all the clusters are computed with a single grouping of the observations.
+    counts, media, minima, maxima, covariances = get_cluster_statistics(X, idx, k, covariances=False)
 
     for ii in range (0,k):
-        try:
-            #take the clusters' observations
-            cluster_ = get_cluster(X, idx, ii)
-
-            #compute max, min and mean
-            maxima = np.max(cluster_, axis = 0)
-            minima = np.min(cluster_, axis = 0)
-            media = np.mean(cluster_, axis=0)
-
-            #compute the standard deviation of each cluster, because PHC can be sensitive to outliers
-            #so if dev it's high PHC could not be completely reliable
-            dev = np.std(cluster_, axis=0)
-
-            #compute PHCs. TOL is added to avoid dividing by 0
-            PHC_coeff[ii] = np.mean((maxima-minima)/(media +TOL))
-            
-            #compute the average standard deviations
-            PHC_deviations[ii] = np.mean(dev)
-        except ValueError:
+        if counts[ii] == 0:
             print("An exception was thrown by Python during the PHC computation. Probably the considered cluster was found empty.")
             print("Passing..")
-            pass
+            continue
+
+        #compute the standard deviation of each cluster, because PHC can be sensitive to outliers
+        #so if dev it's high PHC could not be completely reliable
+        dev = np.sqrt(np.diag(covariances[ii]) * max(counts[ii] -1, 1) / counts[ii])
+
+        #compute PHCs. TOL is added to avoid dividing by 0
+        PHC_coeff[ii] = np.mean((maxima[ii]-minima[ii])/(media[ii] +TOL))
+        
+        #compute the average standard deviations
+        PHC_deviations[ii] = np.mean(dev)
 
     return PHC_coeff, PHC_deviations
 
@@ -301,43 +295,259 @@ def get_centroids(X):
     return centroid
 
 
-def get_medianoids(X):
+def get_medianoids(X, n_bins=None, block_size=None):
     '''
     Given a matrix (or a cluster), calculate its
     medianoid (same as centroid, but with median).
+    If n_bins is given, the medianoid is approximated reading the observations
+    by blocks (so X can also be a memory-mapped array): the median of each variable
+    is located with a histogram of n_bins bins, and then refined with a second
+    histogram inside the selected bin. The approximation error is lower than
+    (max - min)/n_bins^2 for each variable.
     - Input:
     X = data matrix -- dim: (observations x variables)
+    n_bins = number of bins of the histograms (None = exact median) -- dim: (scalar)
+    block_size = number of observations read at each step -- dim: (scalar)
     - Output:
     medianoid = medianoid vector -- dim: (1 x variables)
     '''
-    medianoid = np.median(X, axis = 0)
+    if n_bins is None:
+        medianoid = np.median(X, axis = 0)
+        return medianoid
+
+    rows, cols = X.shape
+    if block_size is None:
+        block_size = max(1, 2**20 // max(cols, 1))
+
+    #first pass: range of each variable
+    lower = np.full(cols, np.inf)
+    upper = np.full(cols, -np.inf)
+    for start in range(0, rows, block_size):
+        block = np.asarray(X[start:start+block_size], dtype=float)
+        np.minimum(lower, np.min(block, axis=0), out=lower)
+        np.maximum(upper, np.max(block, axis=0), out=upper)
+
+    #the median has rank (rows -1)/2: at each pass, count the observations in the bins
+    #of the current interval, and restrict the interval to the bin containing the median
+    rank = (rows -1)/2
+    below = np.zeros(cols, dtype=float)
+    offsets = np.arange(cols)*n_bins
+    for refinement in range(0, 2):
+        width = (upper - lower)/n_bins
+        width[width == 0] = 1
+        counts = np.zeros(cols*n_bins, dtype=float)
+        for start in range(0, rows, block_size):
+            block = np.asarray(X[start:start+block_size], dtype=float)
+            inside = (block >= lower) & (block <= upper)
+            bins = np.clip(np.floor((block - lower)/width).astype(int), 0, n_bins -1) + offsets
+            counts += np.bincount(bins[inside], minlength=cols*n_bins)
+        counts = counts.reshape((cols, n_bins))
+        cumulative = below[:, np.newaxis] + np.cumsum(counts, axis=1)
+        selected = np.minimum(np.argmax(cumulative > rank, axis=1), n_bins -1)
+        below = cumulative[np.arange(cols), selected] - counts[np.arange(cols), selected]
+        lower = lower + selected*width
+        upper = lower + width
+        n_selected = counts[np.arange(cols), selected]
+
+    #linear interpolation inside the final bin
+    fraction = np.clip((rank - below + 0.5)/np.maximum(n_selected, 1), 0, 1)
+    medianoid = lower + fraction*(upper - lower)
+
     return medianoid
 
 
-def get_medoids(X):
+def get_medoids(X, n_candidates=None, n_references=None, block_size=None, random_state=None):
     '''
     Given a matrix (or a cluster), calculate its
     medoid: the point which minimize the sum of distances
     with respect to the other observations.
+    The distances are computed by blocks of candidates, so the full (observations x observations)
+    distance matrix is never stored. For large clusters, the medoid can be approximated (as in CLARA)
+    considering only n_candidates observations, randomly sampled, as candidate medoids and
+    evaluating their sum of distances with respect to n_references sampled observations.
     - Input:
     X = data matrix -- dim: (observations x variables)
+    n_candidates = number of candidate medoids (None = all the observations) -- dim: (scalar)
+    n_references = number of observations to compute the sum of distances (None = all) -- dim: (scalar)
+    block_size = number of candidates whose distances are computed together -- dim: (scalar)
+    random_state = numpy RandomState used to sample the observations (None = global generator)
     - Output:
     medoid = medoid vector -- dim: (1 x variables)
     '''
-    from scipy.spatial.distance import euclidean, cdist
-    #Compute the distances between each point of the matrix
-    dist = cdist(X, X)
-    #Sum all the distances along the columns, to have the
-    #cumulative sum of distances.
-    cumSum = np.sum(dist, axis=1)
+    from scipy.spatial.distance import cdist
+
+    rows = X.shape[0]
+    if random_state is None:
+        random_state = np.random
+    if n_candidates is None or n_candidates >= rows:
+        candidates = np.arange(rows)
+    else:
+        candidates = np.sort(random_state.choice(rows, n_candidates, replace=False))
+    if n_references is None or n_references >= rows:
+        references = X
+    else:
+        references = X[np.sort(random_state.choice(rows, n_references, replace=False))]
+    if block_size is None:
+        block_size = max(1, 2**22 // max(references.shape[0], 1))
+
+    #Compute the distances between each candidate and the reference observations, and
+    #sum them up to have the cumulative sum of distances.
+    cumSum = np.empty(len(candidates), dtype=float)
+    for start in range(0, len(candidates), block_size):
+        dist = cdist(X[candidates[start:start+block_size]], references)
+        cumSum[start:start+block_size] = np.sum(dist, axis=1)
     #Pick up the point which minimize the distances from
     #all the other points as a medoid
-    mask = np.argmin(cumSum)
+    mask = candidates[np.argmin(cumSum)]
     medoid = X[mask,:]
 
     return medoid
 
 
+def get_membership(idx, k=None):
+    '''
+    Group the observations by cluster sorting the membership vector only once.
+    The grouping is stored as a permutation of the observations and the offsets
+    of each group, so that the observations of the j-th cluster are given by:
+    X[order[offsets[j]:offsets[j+1]]]. Labels larger than k-1 are not considered.
+    - Input:
+    idx = class membership vector -- dim: (obs x 1)
+    k = number of clusters. If None, it is set to max(idx) +1 -- dim: (scalar)
+    - Output:
+    order = observations sorted by cluster -- dim: (obs)
+    offsets = position of the first observation of each cluster in order -- dim: (k+1)
+    '''
+    idx = np.asarray(idx).ravel().astype(int, copy=False)
+    if k is None:
+        k = int(np.max(idx) +1) if len(idx) > 0 else 0
+
+    order = np.argsort(idx, kind='stable')
+    offsets = np.zeros(k +1, dtype=int)
+    np.cumsum(np.bincount(idx, minlength=k)[:k], out=offsets[1:])
+
+    return order, offsets
+
+
+
+def get_nearest_centroids(X, centroids, block_size=None, X_norms=None, second=False):
+    '''
+    Assign each observation to the nearest centroid (squared Euclidean distance), and return
+    the distance from it. The distances are computed in blocks of rows as:
+    ||x - c||^2 = ||x||^2 - 2 x c^T + ||c||^2
+    so each block needs a single matrix product, and the (observations x k) distance matrix
+    is never built for the whole matrix.
+    - Input:
+    X = data matrix -- dim: (observations x variables)
+    centroids = centroid of each cluster -- dim: (k x variables)
+    block_size = number of observations per block (optional)
+    X_norms = squared norms of the observations, if already available (optional) -- dim: (observations)
+    second = return also the squared distance from the second nearest centroid (optional) -- dim: (boolean)
+    - Output:
+    idx = nearest centroid of each observation -- dim: (observations)
+    min_dist = squared distance from the nearest centroid -- dim: (observations)
+    second_dist = squared distance from the second nearest centroid, if second is True -- dim: (observations)
+    '''
+    rows = X.shape[0]
+    centroids = np.asarray(centroids, dtype=float)
+    k = centroids.shape[0]
+
+    #by default, each block of distances takes about 8 MB of memory
+    if block_size is None:
+        block_size = int(2**20 / max(k, 1))
+    block_size = max(1, min(int(block_size), rows))
+
+    C_norms = np.einsum('ij,ij->i', centroids, centroids)
+    idx = np.empty((rows,), dtype=int)
+    min_dist = np.empty((rows,), dtype=float)
+    dist = np.empty((block_size, k), dtype=float)
+    if second:
+        second_dist = np.full((rows,), np.inf, dtype=float)
+
+    for start in range(0, rows, block_size):
+        end = min(start + block_size, rows)
+        block = np.asarray(X[start:end], dtype=float)
+        D = dist[:end-start]
+        np.dot(block, centroids.T, out=D)
+        D *= -2
+        D += C_norms
+        #||x||^2 does not change the nearest centroid, so it is added only to the minimum
+        np.argmin(D, axis=1, out=idx[start:end])
+        norms = np.einsum('ij,ij->i', block, block) if X_norms is None else X_norms[start:end]
+        np.add(D[np.arange(end-start), idx[start:end]], norms, out=min_dist[start:end])
+        if second and k > 1:
+            D[np.arange(end-start), idx[start:end]] = np.inf
+            np.add(np.min(D, axis=1), norms, out=second_dist[start:end])
+
+    #remove the (tiny) negative values due to round-off
+    np.maximum(min_dist, 0, out=min_dist)
+    if second:
+        np.maximum(second_dist, 0, out=second_dist)
+        return idx, min_dist, second_dist
+
+    return idx, min_dist
+
+
+def get_reconstruction_errors(X, centroids, modes, block_size=None, out=None):
+    '''
+    Compute the squared reconstruction error of each observation with respect to 'k'
+    local PCA manifolds, i.e., for each cluster j and observation x:
+    e_j(x) = ||x - c_j||^2 - ||A_j^T (x - c_j)||^2
+    which holds because the modes A_j are orthonormal. The matrix X is processed in
+    blocks of rows, reusing the same preallocated buffers for all the clusters, so the
+    (observations x variables) reconstructed matrix is never built.
+    - Input:
+    X = CENTERED/SCALED data matrix -- dim: (observations x variables)
+    centroids = list with the centroid of each cluster -- dim: (k) x (variables)
+    modes = list with the local PCs of each cluster -- dim: (k) x (variables x q)
+    block_size = number of observations per block (optional)
+    out = preallocated matrix to store the errors (optional) -- dim: (observations x k)
+    - Output:
+    sq_rec_err = squared reconstruction errors -- dim: (observations x k)
+    '''
+    rows, cols = X.shape
+    k = len(centroids)
+
+    if out is None:
+        out = np.empty((rows, k), dtype=float)
+    elif out.shape != (rows, k):
+        raise Exception("The output matrix must have dimensions (observations x clusters).")
+
+    #by default, each block of differences takes about 8 MB of memory
+    if block_size is None:
+        block_size = int(2**20 / max(cols, 1))
+    block_size = max(1, min(int(block_size), rows))
+
+    #buffers: differences from the centroid, their squared norm, the projection on
+    #the local PCs (one buffer for each number of retained PCs) and its squared norm
+    diff = np.empty((block_size, cols), dtype=float)
+    sq_norm = np.empty((block_size,), dtype=float)
+    sq_proj = np.empty((block_size,), dtype=float)
+    projections = {}
+
+    modes = [np.asarray(A, dtype=float) for A in modes]
+    for A in modes:
+        if A.shape[1] not in projections:
+            projections[A.shape[1]] = np.empty((block_size, A.shape[1]), dtype=float)
+
+    for start in range(0, rows, block_size):
+        end = min(start + block_size, rows)
+        n_block = end - start
+        D = diff[:n_block]
+        for jj in range(0, k):
+            #||x - c||^2
+            np.subtract(X[start:end], centroids[jj], out=D)
+            np.einsum('ij,ij->i', D, D, out=sq_norm[:n_block])
+            #||A^T (x - c)||^2
+            Z = projections[modes[jj].shape[1]][:n_block]
+            np.dot(D, modes[jj], out=Z)
+            np.einsum('ij,ij->i', Z, Z, out=sq_proj[:n_block])
+            np.subtract(sq_norm[:n_block], sq_proj[:n_block], out=out[start:end, jj])
+
+    #remove the (tiny) negative values due to round-off
+    np.maximum(out, 0, out=out)
+
+    return out
+
 
 def get_cluster(X, idx, index, write=False):
     '''
@@ -364,7 +574,100 @@ def get_cluster(X, idx, index, write=False):
         print("No observations in cluster number: {}. Passing by.".format(index))
         pass
 
+
+def get_cluster_statistics(X, idx, k=None, covariances=True):
+    '''
+    Compute the number of observations, the centroid, the minimum, the maximum and the
+    covariance matrix of all the clusters. The observations are grouped only once, sorting
+    the membership vector (see get_membership), and each statistic is computed with a single
+    pass on the grouped observations. The covariance matrices of all the clusters can be
+    decomposed together with PCA_from_covariances. Empty clusters get null statistics.
+    - Input:
+    X = data matrix -- dim: (observations x variables)
+    idx = class membership vector -- dim: (obs x 1)
+    k = number of clusters. If None, it is set to max(idx) +1 -- dim: (scalar)
+    covariances = if False, the covariance matrices are not computed, and None is returned -- dim: (boolean)
+    - Output:
+    counts = number of observations in each cluster -- dim: (k)
+    centroids = centroid of each cluster -- dim: (k x variables)
+    minima = minimum of each variable in each cluster -- dim: (k x variables)
+    maxima = maximum of each variable in each cluster -- dim: (k x variables)
+    covariances = covariance matrix of each cluster -- dim: (k x variables x variables)
+    '''
+    order, offsets = get_membership(idx, k)
+    k = len(offsets) -1
+    cols = X.shape[1]
+    counts = np.diff(offsets)
+
+    centroids = np.zeros((k, cols), dtype=float)
+    minima = np.zeros((k, cols), dtype=float)
+    maxima = np.zeros((k, cols), dtype=float)
+    if not covariances:
+        covariances = None
+    else:
+        covariances = np.zeros((k, cols, cols), dtype=float)
+
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty) > 0:
+        X_sorted = np.take(X, order[:offsets[-1]], axis=0).astype(float, copy=False)
+        #the empty clusters are skipped: each start is the end of the previous non-empty group
+        starts = offsets[:-1][nonempty]
+        centroids[nonempty] = np.add.reduceat(X_sorted, starts, axis=0) / counts[nonempty, np.newaxis]
+        minima[nonempty] = np.minimum.reduceat(X_sorted, starts, axis=0)
+        maxima[nonempty] = np.maximum.reduceat(X_sorted, starts, axis=0)
+
+    if covariances is not None and len(nonempty) > 0:
+        X_sorted = X_sorted - np.repeat(centroids, counts, axis=0)
+        for ii in nonempty:
+            cluster_ = X_sorted[offsets[ii]:offsets[ii+1]]
+            covariances[ii] = (cluster_.T @ cluster_) / max(counts[ii] -1, 1)
+
+    return counts, centroids, minima, maxima, covariances
+
+
     
+def get_sufficient_statistics(X, idx, k, references=None):
+    '''
+    Compute the sufficient statistics of each cluster, i.e., the number of observations,
+    their sum and their scatter matrix (sum of the outer products). The statistics of
+    different subsets of observations (batches, shards) can be merged by summing them,
+    and the local PCA models can be computed from them via PCA_from_statistics.
+    The observations are grouped by sorting the membership vector once.
+    If the reference points are given, the sums and the scatter matrices are computed
+    with the observations shifted by the reference point of their cluster: with points
+    close to the clusters' means, the covariance matrices obtained by PCA_from_statistics
+    are accurate also for observations far from the origin.
+    - Input:
+    X = data matrix -- dim: (observations x variables)
+    idx = class membership vector -- dim: (obs x 1)
+    k = number of clusters -- dim: (scalar)
+    references = reference point of each cluster (None = origin) -- dim: (k x variables)
+    - Output:
+    counts = number of observations in each cluster -- dim: (k)
+    sums = sum of the observations in each cluster -- dim: (k x variables)
+    scatters = scatter matrix of each cluster, sum of x x^T -- dim: (k x variables x variables)
+    '''
+    cols = X.shape[1]
+
+    #sort the observations by cluster, so that each group is a contiguous slice
+    order, offsets = get_membership(idx, k)
+    counts = np.diff(offsets).astype(float)
+    sums = np.zeros((k, cols), dtype=float)
+    scatters = np.zeros((k, cols, cols), dtype=float)
+
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty) > 0:
+        X_sorted = np.take(X, order[:offsets[-1]], axis=0)
+        if references is not None:
+            X_sorted = X_sorted - np.repeat(references[nonempty], np.diff(offsets)[nonempty], axis=0)
+        sums[nonempty] = np.add.reduceat(X_sorted, offsets[:-1][nonempty], axis=0)
+        for ii in nonempty:
+            cluster_ = X_sorted[offsets[ii]:offsets[ii+1]]
+            scatters[ii] = cluster_.T @ cluster_
+
+    return counts, sums, scatters
+
+
 def get_all_clusters(X, idx):
     '''
     Group all the observations of the matrix X given their membership vector idx,
@@ -375,13 +678,12 @@ def get_all_clusters(X, idx):
     - Output:
     clusters: list with the clusters from 0 to k -- dim: (k)
     '''
-    k = max(idx) +1
-    clusters = [None] *k
+    k = int(np.max(idx) +1)
 
-    for ii in range (0,k):
-        #identify the observations which belong to a certain cluster
-        #and store them in the clusters' list
-        clusters[ii] = get_cluster(X, idx, ii)
+    #group all the observations sorting the membership vector once,
+    #and split the sorted matrix in the clusters' list
+    order, offsets = get_membership(idx, k)
+    clusters = np.split(np.take(X, order, axis=0), offsets[1:-1])
 
     return clusters
 
@@ -398,7 +700,38 @@ def NRMSE (X_true, X_pred):
     return NRMSE
 
 
-def PCA_fit(X, n_eig):
+def parallel_map(function, arguments, n_jobs=1):
+    '''
+    Apply a function to each element of a list of arguments, spreading the calls
+    over a pool of threads. The results are returned in the same order of the
+    arguments, so the output is identical to the one of a serial loop. Threads are
+    used because numpy releases the GIL inside the linear algebra kernels, and the
+    (large) data matrices are shared by all the workers without being copied.
+    - Input:
+    function = function to be called on each argument
+    arguments = list of arguments -- dim: (number of tasks)
+    n_jobs = number of workers. If equal to -1, all the available cores are used -- dim: (scalar)
+    - Output:
+    results = list with the output of each call -- dim: (number of tasks)
+    '''
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    arguments = list(arguments)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(int(n_jobs), len(arguments))
+
+    if n_jobs <= 1:
+        return [function(argument) for argument in arguments]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results = list(pool.map(function, arguments))
+
+    return results
+
+
+def PCA_fit(X, n_eig, solver='auto'):
     '''
     Perform Principal Component Analysis on the dataset X,
     and retain 'n_eig' Principal Components.
@@ -406,29 +739,69 @@ def PCA_fit(X, n_eig):
     decomposed in eigenvalues and eigenvectors.
     Lastly, the eigenvalues are ordered depending on their
     magnitude and the associated eigenvectors (the PCs) are retained.
+    The decomposition is computed with one of the eigen_solvers: 'eigh'
+    and 'eigsh' decompose the covariance matrix, while 'svd' and 'fastSVD'
+    decompose the (centered) data matrix. The 'snapshot' solver (method of
+    snapshots, for matrices with less observations than variables) decomposes
+    the (observations x observations) Gram matrix, and the PCs are obtained
+    projecting the data on its eigenvectors. By default, the solver is chosen
+    by select_eigen_solver.
     - Input:
     X = CENTERED/SCALED data matrix -- dim: (observations x variables)
     n_eig = number of principal components to retain -- dim: (scalar)
+    solver = 'auto', 'eigh', 'svd', 'eigsh', 'fastSVD' or 'snapshot' -- dim: (string)
     - Output:
     evecs: eigenvectors from the covariance matrix decomposition (PCs)
-    evals: eigenvalues from the covariance matrix decomposition (lambda)
+    evals: first n_eig eigenvalues from the covariance matrix decomposition (lambda), with
+    all the solvers. The total variance is the trace of the covariance matrix.
+    With the 'snapshot' solver, if n_eig exceeds the rank of the centered matrix (at most
+    observations -1), only the PCs with a non-null eigenvalue are returned, with a warning.
     !!! WARNING !!! the PCs are already ordered (decreasing, for importance)
     because the eigenvalues are also ordered in terms of magnitude.
     '''
-    if n_eig < X.shape[1]:
-        #compute the covariance matrix from the original data matrix
-        C = np.cov(X, rowvar=False) #rowvar=False because the X matrix is (observations x variables)
-
-        #perform an eigendecomposition
-        evals, evecs = LA.eig(C)
-
-        #sort the eigenvalues in descending order
-        mask = np.argsort(evals)[::-1]
-        evecs = evecs[:,mask]
-        evals = evals[mask]
+    rows, cols = X.shape
+    if n_eig < cols:
+        if solver.lower() == 'auto':
+            solver = select_eigen_solver(rows, cols, n_eig)
+
+        if solver.lower() == 'eigh' or solver.lower() == 'eigsh':
+            #compute the covariance matrix from the original data matrix
+            C = np.cov(X, rowvar=False) #rowvar=False because the X matrix is (observations x variables)
+            evecs, evals = symmetric_eigens(C, n_eig, solver)
+
+        elif solver.lower() == 'svd':
+            #the right singular vectors of the centered matrix are the PCs, and the
+            #squared singular values are proportional to the eigenvalues
+            ____, S, Vt = np.linalg.svd(X - np.mean(X, axis=0), full_matrices=False)
+            evecs = Vt[:n_eig].T
+            evals = np.zeros((n_eig,), dtype=float)
+            evals[:min(len(S), n_eig)] = S[:n_eig]**2 / (rows - 1)
+
+        elif solver.lower() == 'fastsvd':
+            ____, evecs, S = fastSVD(X - np.mean(X, axis=0), n_eig)
+            evals = S**2 / (rows - 1)
+
+        elif solver.lower() == 'snapshot':
+            #Gram matrix of the centered observations, obtained centering the rows and the
+            #columns of X X^T, so that the centered matrix is never built
+            G = X @ X.T
+            G_mean = np.mean(G, axis=0)
+            G = G - G_mean[:, np.newaxis] - G_mean[np.newaxis, :] + np.mean(G_mean)
+            V, evals_gram = symmetric_eigens(G / (rows - 1), min(n_eig, rows), 'eigh')
+            #the centered matrix has rank at most rows-1: the eigenvectors of the Gram matrix with
+            #null eigenvalue (e.g., the mean direction) do not give a PC, so they are discarded
+            rank = np.count_nonzero(evals_gram > max(rows, cols) * np.finfo(float).eps * max(evals_gram[0], 0))
+            if rank < n_eig:
+                warnings.warn("The number of PCs exceeds the rank of the centered data-set. Only {} PCs are retained.".format(rank))
+            #the PCs are the projections of the data on the eigenvectors of the Gram matrix (the
+            #eigenvectors with non-null eigenvalue are orthogonal to the mean, so X can be used
+            #instead of the centered matrix). They are normalized to unit length.
+            evecs = X.T @ V[:, :rank]
+            evecs /= np.linalg.norm(evecs, axis=0)
+            evals = evals_gram[:rank]
 
-        #retain only the selected number 'q' of eigenvalues
-        evecs = evecs[:, :n_eig]
+        else:
+            raise Exception("Unsupported eigensolver. Please choose: AUTO, EIGH, SVD, EIGSH, FASTSVD or SNAPSHOT.")
 
         return evecs, evals
 
@@ -436,6 +809,60 @@ def PCA_fit(X, n_eig):
         raise Exception("The number of PCs exceeds the number of variables in the data-set.")
 
 
+def PCA_from_covariances(covariances, n_eig, solver='auto'):
+    '''
+    Perform Principal Component Analysis in each cluster from its covariance matrix
+    (see get_cluster_statistics): with the 'eigh' solver, the covariance matrices of
+    all the clusters are decomposed together, with a single batched call.
+    - Input:
+    covariances = covariance matrix of each cluster -- dim: (k x variables x variables)
+    n_eig = number of principal components to retain -- dim: (scalar)
+    solver = 'auto', 'eigh' or 'eigsh' (see symmetric_eigens) -- dim: (string)
+    - Output:
+    modes = local PCs of each cluster -- dim: (k x variables x n_eig)
+    evals = first n_eig eigenvalues of each cluster, in descending order -- dim: (k x n_eig)
+    '''
+    if n_eig > covariances.shape[-1]:
+        raise Exception("The number of PCs exceeds the number of variables in the data-set.")
+
+    modes, evals = symmetric_eigens(covariances, n_eig, solver)
+
+    return modes, evals
+
+
+def PCA_from_statistics(counts, sums, scatters, n_eig, solver='auto', references=None):
+    '''
+    Perform Principal Component Analysis in each cluster starting from its sufficient
+    statistics (see get_sufficient_statistics), without accessing the observations.
+    The covariance matrices are computed as: (S - n mu mu^T)/(n - 1), and they are
+    decomposed all together. Empty clusters get a null centroid and covariance.
+    - Input:
+    counts = number of observations in each cluster -- dim: (k)
+    sums = sum of the observations in each cluster -- dim: (k x variables)
+    scatters = scatter matrix of each cluster -- dim: (k x variables x variables)
+    n_eig = number of principal components to retain -- dim: (scalar)
+    solver = 'auto', 'eigh' or 'eigsh' (see symmetric_eigens) -- dim: (string)
+    references = reference points the statistics were computed about (None = origin) -- dim: (k x variables)
+    - Output:
+    centroids = centroid of each cluster -- dim: (k x variables)
+    modes = local PCs of each cluster -- dim: (k x variables x n_eig)
+    evals = first n_eig eigenvalues of each cluster, in descending order -- dim: (k x n_eig)
+    '''
+    if n_eig > sums.shape[1]:
+        raise Exception("The number of PCs exceeds the number of variables in the data-set.")
+
+    n_obs = np.maximum(counts, 1)[:, np.newaxis]
+    centroids = sums / n_obs
+    C = scatters - n_obs[:, :, np.newaxis] * (centroids[:, :, np.newaxis] * centroids[:, np.newaxis, :])
+    C /= np.maximum(counts - 1, 1)[:, np.newaxis, np.newaxis]
+    if references is not None:
+        centroids = centroids + (counts > 0)[:, np.newaxis] * references
+
+    modes, evals = PCA_from_covariances(C, n_eig, solver)
+
+    return centroids, modes, evals
+
+
 def readCSV(path, name):
     try:
         print("Reading training matrix..")
@@ -507,6 +934,32 @@ def scale(X, method, return_scaled_matrix=False):
         return sig, X0
 
 
+def select_eigen_solver(n, p, q):
+    '''
+    Choose the fastest of the eigen_solvers to retain q Principal Components of a
+    matrix with n observations and p variables. If there are less observations than
+    variables, the p x p covariance matrix is never built: 'snapshot' is used if the
+    variables are many more than the observations (p >= 10 n), 'svd' otherwise.
+    Otherwise, 'eigh' is used for small matrices or when many PCs are retained, and a
+    truncated solver in the other cases: 'fastSVD' if the data matrix is very large
+    (the covariance matrix is never built), 'eigsh' otherwise.
+    - Input:
+    n = number of observations, or None if only the covariance matrix is available -- dim: (scalar)
+    p = number of variables -- dim: (scalar)
+    q = number of principal components to retain -- dim: (scalar)
+    - Output:
+    solver = name of the selected solver -- dim: (string)
+    '''
+    if n is not None and n < p:
+        return 'snapshot' if p >= 10*n else 'svd'
+    #the full decomposition of a small matrix is cheaper than the Lanczos iterations
+    if p < 500 or q > p/10:
+        return 'eigh'
+    if n is not None and n*p >= 1E8:
+        return 'fastSVD'
+    return 'eigsh'
+
+
 def split_for_validation(X, validation_quota):
     '''
     Split the data into two matrices, one to train the model (X_train) and the
@@ -536,6 +989,86 @@ def split_for_validation(X, validation_quota):
     return X_train, X_test
 
 
+def symmetric_eigens(C, n_eig, solver='auto'):
+    '''
+    Compute the eigenvectors associated to the n_eig largest eigenvalues of a symmetric
+    (covariance or Gram) matrix, or of a stack of symmetric matrices. The 'eigh' solver
+    computes the full spectrum, decomposing all the matrices with a single batched call,
+    while the 'eigsh' solver (Lanczos iterations) only computes the n_eig largest eigenvalues.
+    - Input:
+    C = symmetric matrix -- dim: (variables x variables) or (k x variables x variables)
+    n_eig = number of eigenvectors to retain -- dim: (scalar)
+    solver = 'auto', 'eigh' or 'eigsh' -- dim: (string)
+    - Output:
+    evecs = eigenvectors, ordered by decreasing eigenvalue -- dim: (k x variables x n_eig)
+    evals = first n_eig eigenvalues, in descending order -- dim: (k x n_eig)
+    '''
+    cols = C.shape[-1]
+    if solver.lower() == 'auto':
+        solver = select_eigen_solver(None, cols, n_eig)
+    #Lanczos needs less eigenvalues than the dimension of the matrix
+    if solver.lower() == 'eigsh' and n_eig >= cols -1:
+        solver = 'eigh'
+
+    if solver.lower() == 'eigh':
+        #eigh returns the eigenvalues in ascending order
+        evals, evecs = LA.eigh(C)
+        return evecs[..., ::-1][..., :n_eig], evals[..., ::-1][..., :n_eig]
+
+    elif solver.lower() == 'eigsh':
+        from scipy.sparse.linalg import eigsh
+
+        matrices = C.reshape(-1, cols, cols)
+        evecs = np.zeros((len(matrices), cols, n_eig), dtype=float)
+        evals = np.zeros((len(matrices), n_eig), dtype=float)
+        #fixed starting vector, so that the results are reproducible
+        v0 = np.random.RandomState(0).rand(cols)
+        for ii in range(0, len(matrices)):
+            if not np.any(matrices[ii]):
+                evecs[ii] = np.eye(cols, n_eig)
+                continue
+            evals_, evecs_ = eigsh(matrices[ii], k=n_eig, which='LA', v0=v0)
+            evals[ii] = evals_[::-1]
+            evecs[ii] = evecs_[:, ::-1]
+
+        return evecs.reshape(C.shape[:-1] + (n_eig,)), evals.reshape(C.shape[:-2] + (n_eig,))
+
+    else:
+        raise Exception("Unsupported eigensolver for a symmetric matrix. Please choose: AUTO, EIGH or EIGSH.")
+
+
+def update_sufficient_statistics(X, idx_old, idx_new, counts, sums, scatters, references=None):
+    '''
+    Update (in place) the sufficient statistics of the clusters (see get_sufficient_statistics)
+    after a new partitioning, considering only the observations which changed cluster: their
+    contribution is removed from the old cluster and added to the new one. The rounding errors
+    of the updates add up: the statistics should be computed again from time to time.
+    - Input:
+    X = data matrix -- dim: (observations x variables)
+    idx_old = previous class membership vector -- dim: (obs x 1)
+    idx_new = new class membership vector -- dim: (obs x 1)
+    counts = number of observations in each cluster -- dim: (k)
+    sums = sum of the observations in each cluster -- dim: (k x variables)
+    scatters = scatter matrix of each cluster -- dim: (k x variables x variables)
+    references = reference points the statistics are computed about (None = origin) -- dim: (k x variables)
+    - Output:
+    n_moved = number of observations which changed cluster -- dim: (scalar)
+    '''
+    k = len(counts)
+    moved = np.flatnonzero(idx_old != idx_new)
+
+    if len(moved) > 0:
+        X_moved = X[moved]
+        counts_old, sums_old, scatters_old = get_sufficient_statistics(X_moved, idx_old[moved], k, references)
+        counts_new, sums_new, scatters_new = get_sufficient_statistics(X_moved, idx_new[moved], k, references)
+
+        counts += counts_new - counts_old
+        sums += sums_new - sums_old
+        scatters += scatters_new - scatters_old
+
+    return len(moved)
+
+
 def uncenter(X_tilde, mu):
     '''
     Uncenter a standardized matrix.
@@ -579,13 +1112,18 @@ def unscale(X_tilde, sigma):
         exit()
 
 
-def varimax_rotation(X, b, normalize=True):
+def varimax_rotation(X, b, normalize=True, verbose=False, callback=None):
     '''
     Rotate the factors by means of the varimax rotation.
     - Input:
     X = training data matrix, SCALED/UNSCALED it makes no difference
     b = factors/modes to be rotated
     normalize = (optional), the factors/modes are normalized with their standard deviation
+    verbose = (optional), print the convergence residuals at each iteration
+    callback = (optional), function called at each iteration with a dictionary containing the
+               'iteration' number, the explained variance ('error'), its relative 'variation',
+               'labels_changed' (None) and the 'timings' of the iteration. If it returns True,
+               the rotation is stopped.
 
     - Output:
     rot_loadings = rotated modes or factors, returned after the algorithm convergenceß
@@ -618,6 +1156,7 @@ def varimax_rotation(X, b, normalize=True):
     variance_explained = np.sum(loadings**2)
 
     while not convergence:
+        start_time = time.perf_counter()
         for ii in range(0,eigens):
             for jj in range(ii+1, eigens):
                 x_j = loadings[:,ii]
@@ -650,14 +1189,17 @@ def varimax_rotation(X, b, normalize=True):
         #convergence criterion
         check = np.abs((variance_explained - var_old)/(variance_explained + 1E-16))
 
-        if check < convergence_tolerance or iter > iter_max:
+        stop = callback is not None and callback({"iteration": iter, "error": variance_explained, "variation": check, "labels_changed": None, "timings": {"rotation": time.perf_counter() - start_time}})
+
+        if check < convergence_tolerance or iter > iter_max or stop:
             iter += 1
             convergence = True
         else:
             iter += 1
 
-        print("Iteration number: {}".format(iter))
-        print("Convergence residuals: {}".format(check))
+        if verbose:
+            print("Iteration number: {}".format(iter))
+            print("Convergence residuals: {}".format(check))
 
 
     for ii in range(0, eigens):
@@ -36,15 +36,14 @@ X_tilde = center_scale(X, center(X, method=settings["centering_method"]), scale(
 
 num_of_k = np.linspace(settings["initial_k"], settings["final_k"], settings["final_k"]-settings["initial_k"]+1)
 DB_scores = [None]*len(num_of_k)
-idxs = [None]*len(num_of_k)
+
+#fit the first model, and warm start each following one splitting the worst cluster
+model = clustering.lpca(X, settings)
+model.clusters = settings["initial_k"]
+idxs, rec_errors = model.fit_path(settings["final_k"])
 
 for ii in range(0,len(num_of_k)):
-    model = clustering.lpca(X, settings)
-    model.clusters = int(num_of_k[ii])
-    index = model.fit() 
-    
-    idxs[ii] = index
-    DB_scores[ii] = evaluate_clustering_DB(X_tilde, index)
+    DB_scores[ii] = evaluate_clustering_DB(X_tilde, idxs[ii])
 
 print(DB_scores)
 print("According to the Davies-Bouldin index, the best number of clusters to use for the given dataset is: {}".format(num_of_k[np.argmin(DB_scores)]))
@@ -86,3 +86,17 @@ class testNMF(unittest.TestCase):
             passed = False 
 
         self.assertEqual(passed, True)
+
+    def test_callback(self):
+        records = []
+        def stop_after_two(record):
+            records.append(record)
+            return record["iteration"] >= 1
+
+        model = model_order_reduction.NMF(self.X)
+        model.algorithm = 'mur'
+        model.callback = stop_after_two
+        model.fit()
+
+        self.assertEqual(len(records), 2)
+        self.assertTrue("error" in records[-1] and "timings" in records[-1])
@@ -16,6 +16,10 @@ MODULE: test_PCA.py
 '''
 
 import unittest
+import io
+import contextlib
+import os
+import tempfile
 
 import numpy as np
 from numpy import linalg as LA
@@ -23,6 +27,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 import OpenMORe.model_order_reduction as model_order_reduction
+import OpenMORe.clustering as clustering
 from OpenMORe.utilities import *
 
 
@@ -54,6 +59,254 @@ class testPCA(unittest.TestCase):
         self.assertEqual(len(eigenvalues),self.nPCtest)
         self.assertIsInstance(explained, float)
 
+    def test_eigenSolvers(self):
+        #data with three dominant directions, so that the PCs are well separated
+        X = (np.random.rand(100, 3) * [10, 3, 1]) @ LA.qr(np.random.rand(20, 3))[0].T + 0.01 * np.random.rand(100, 20)
+        reference, evals_ref = PCA_fit(X, 3, 'eigh')
+
+        for solver in ['svd', 'eigsh', 'fastSVD', 'snapshot']:
+            PCs, eigenvalues = PCA_fit(X, 3, solver)
+            self.assertEqual(PCs.shape, (20, 3))
+            #all the solvers return the first n_eig eigenvalues
+            self.assertEqual(eigenvalues.shape, (3,))
+            self.assertTrue(np.allclose(eigenvalues, evals_ref, rtol=1E-2))
+            #the PCs are defined up to their sign
+            self.assertTrue(np.allclose(np.abs(np.sum(PCs * reference, axis=0)), 1, atol=1E-2))
+
+        self.assertEqual(select_eigen_solver(50, 100, 2), 'svd')
+        self.assertEqual(select_eigen_solver(1000, 20, 2), 'eigh')
+        self.assertEqual(select_eigen_solver(1000, 1000, 5), 'eigsh')
+
+    def test_snapshotPCA(self):
+        #less observations than variables, as for the POD of snapshot matrices
+        X = np.random.rand(12, 400)
+        self.assertEqual(select_eigen_solver(12, 400, 3), 'snapshot')
+
+        snapshotPCA = model_order_reduction.PCA(X)
+        snapshotPCA.eigens = 3
+        PCs, eigenvalues = snapshotPCA.fit()
+
+        fullPCA = model_order_reduction.PCA(X)
+        fullPCA.eigens = 3
+        fullPCA.eigen_solver = 'eigh'
+        PCs_full, eigenvalues_full = fullPCA.fit()
+
+        self.assertTrue(np.allclose(eigenvalues, eigenvalues_full))
+        self.assertTrue(np.allclose(np.abs(np.sum(PCs * PCs_full, axis=0)), 1))
+
+        #the centered matrix has rank 11: only 11 orthonormal PCs are retained, and they are
+        #enough for the reconstruction
+        snapshotPCA.eigens = 12
+        with self.assertWarns(UserWarning):
+            PCs, eigenvalues = snapshotPCA.fit()
+        self.assertEqual(PCs.shape, (400, 11))
+        self.assertEqual(eigenvalues.shape, (11,))
+        self.assertTrue(np.all(eigenvalues > 0))
+        self.assertTrue(np.allclose(PCs.T @ PCs, np.eye(11)))
+        X_tilde = snapshotPCA.X_tilde
+        self.assertTrue(np.allclose(X_tilde @ PCs @ PCs.T, X_tilde))
+
+    def test_setPCs(self):
+        X = (np.random.rand(100, 3) * [10, 3, 1]) @ np.random.rand(3, 8) + 0.01 * np.random.rand(100, 8)
+
+        for criterion in ['var', 'nrmse']:
+            globalPCA = model_order_reduction.PCA(X)
+            globalPCA.set_PCs_method = criterion
+            #nothing is printed, unless the verbose option is enabled
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                optimalPCs = globalPCA.set_PCs()
+            self.assertEqual(output.getvalue(), "")
+            globalPCA.verbose = True
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(globalPCA.set_PCs(), optimalPCs)
+            self.assertNotEqual(output.getvalue(), "")
+
+            #the same number of PCs is found fitting the model for each number of PCs
+            for ii in range(1, X.shape[1]):
+                globalPCA.eigens = ii
+                globalPCA.fit()
+                if criterion == 'var':
+                    satisfied = np.sum(globalPCA.evals) / globalPCA.total_variance >= 0.95
+                else:
+                    satisfied = np.mean(NRMSE(X, globalPCA.recover())) <= 0.1
+                if satisfied:
+                    break
+            self.assertEqual(optimalPCs, ii)
+
+    def test_partialFit(self):
+        globalPCA = model_order_reduction.PCA(self.X)
+        globalPCA.eigens = 2
+        PCs, eigenvalues = globalPCA.fit()
+
+        #the training matrix is never given to the model: the variables are read from the first chunk
+        chunkedPCA = model_order_reduction.PCA(None)
+        chunkedPCA.eigens = 2
+        for start in range(0, self.X.shape[0], 7):
+            chunkedPCA.partial_fit(self.X[start:start+7])
+        PCs_chunks, eigenvalues_chunks = chunkedPCA.finalize()
+
+        self.assertEqual(chunkedPCA.n_var, self.X.shape[1])
+        self.assertTrue(np.allclose(eigenvalues, eigenvalues_chunks))
+        self.assertTrue(np.allclose(np.abs(np.sum(PCs * PCs_chunks, axis=0)), 1))
+        self.assertTrue(np.allclose(chunkedPCA.mu, np.mean(self.X, axis=0)))
+
+        #the factors of the decomposition do not change until it is finalized again
+        mu = chunkedPCA.mu.copy()
+        chunkedPCA.partial_fit(self.X[:7] + 10)
+        self.assertTrue(np.array_equal(chunkedPCA.mu, mu))
+
+        #the model can also be built with the first chunk, which is then given to partial_fit
+        firstChunkPCA = model_order_reduction.PCA(self.X[:7])
+        firstChunkPCA.eigens = 2
+        for start in range(0, self.X.shape[0], 7):
+            firstChunkPCA.partial_fit(self.X[start:start+7])
+        self.assertTrue(np.allclose(firstChunkPCA.finalize()[1], eigenvalues))
+
+        with self.assertRaises(Exception):
+            chunkedPCA.partial_fit(self.X[:7, :2])
+
+    def test_transform(self):
+        globalPCA = model_order_reduction.PCA(self.X)
+        globalPCA.eigens = 2
+        PCs, eigenvalues = globalPCA.fit()
+
+        Y = np.random.rand(50, self.X.shape[1])
+        Y_tilde = center_scale(Y, center(self.X, 'mean'), scale(self.X, 'auto'))
+        scores = np.empty((50, 2), dtype=float)
+        Z = globalPCA.transform(Y, block_size=7, out=scores)
+        self.assertTrue(Z is scores)
+        self.assertTrue(np.allclose(Z, Y_tilde @ PCs))
+
+        Y_rec = globalPCA.inverse_transform(Z, block_size=7)
+        self.assertTrue(np.allclose(Y_rec, unscale(Y_tilde @ PCs @ PCs.T, scale(self.X, 'auto')) + center(self.X, 'mean')))
+        self.assertTrue(np.allclose(globalPCA.recover(), globalPCA.inverse_transform(globalPCA.transform(self.X))))
+
+    def test_outlierScores(self):
+        globalPCA = model_order_reduction.PCA(self.X)
+        globalPCA.eigens = 2
+        PCs, eigenvalues = globalPCA.fit()
+
+        T2, Q = globalPCA.outlier_scores(block_size=7)
+        scores = globalPCA.get_scores()
+        self.assertTrue(np.allclose(T2, np.sum(scores**2 / eigenvalues, axis=1)))
+        self.assertTrue(np.allclose(Q, np.sum((globalPCA.X_tilde - scores @ PCs.T)**2, axis=1)))
+
+        mask = globalPCA.outlier_mask(self.X)
+        self.assertEqual(mask.dtype, bool)
+        self.assertEqual(len(mask), self.X.shape[0])
+        #only the training observations beyond the limits (2% of each statistic) are outliers
+        self.assertTrue(np.array_equal(mask, np.logical_or(T2 > globalPCA.T2_limit, Q > globalPCA.Q_limit)))
+        self.assertTrue(0 < np.sum(mask) <= 0.04 * self.X.shape[0] + 1)
+        #a new observation far from the training data is an outlier
+        self.assertTrue(globalPCA.outlier_mask(100 * np.ones((1, self.X.shape[1])))[0])
+
+    def test_compressedLPCA(self):
+        idx = np.random.randint(0, 3, 200)
+        X = np.random.rand(200, 5)
+        localPCA = model_order_reduction.LPCA(X)
+        localPCA.path_to_idx = tempfile.mkdtemp()
+        localPCA.eigens = 2
+        np.savetxt(os.path.join(localPCA.path_to_idx, 'idx.txt'), idx)
+
+        X_rec = localPCA.recover()
+        compressed = localPCA.compress()
+        self.assertTrue(np.allclose(compressed.decode(block_size=30), X_rec))
+        #small batches are decoded row by row
+        rows = np.array([7, 0, 150])
+        self.assertTrue(np.allclose(compressed.decode_batch(compressed.model.idx[rows], compressed.scores[rows]), X_rec[rows]))
+
+        path = os.path.join(localPCA.path_to_idx, 'compressed.npz')
+        compressed.save(path)
+        loaded = model_order_reduction.lpca_compressed.load(path)
+        self.assertTrue(np.allclose(loaded.decode(rows), X_rec[rows]))
+
+    def test_lpcaRefit(self):
+        X = np.random.rand(200, 5)
+        idx1 = np.random.randint(0, 3, 200)
+        idx2 = np.random.randint(0, 4, 200)
+
+        localPCA = model_order_reduction.LPCA(X)
+        localPCA.eigens = 2
+        localPCA.idx = idx1
+        X_rec1 = localPCA.recover()
+        #new idx: the LPCs are computed again
+        localPCA.idx = idx2
+        X_rec2 = localPCA.recover()
+        self.assertEqual(localPCA.k, 4)
+        #new number of PCs
+        localPCA.eigens = 3
+        X_rec3 = localPCA.recover()
+        self.assertEqual(localPCA.LPCs[0].shape[1], 3)
+
+        for idx, eigens, X_rec in [(idx1, 2, X_rec1), (idx2, 2, X_rec2), (idx2, 3, X_rec3)]:
+            reference = model_order_reduction.LPCA(X)
+            reference.eigens = eigens
+            reference.idx = idx
+            self.assertTrue(np.allclose(reference.recover(), X_rec))
+
+    def test_lpcaInputs(self):
+        idx = np.random.randint(0, 3, 200)
+        X = np.random.rand(200, 5)
+        folder = tempfile.mkdtemp()
+        np.savetxt(os.path.join(folder, 'idx.txt'), idx)
+        np.save(os.path.join(folder, 'idx.npy'), idx)
+
+        localPCA = model_order_reduction.LPCA(X)
+        localPCA.eigens = 2
+        localPCA.path_to_idx = folder
+        X_rec = localPCA.recover()
+
+        #in-memory idx, memory-mapped .npy file
+        for idx_input in [idx, os.path.join(folder, 'idx.npy')]:
+            localPCA = model_order_reduction.LPCA(X)
+            localPCA.eigens = 2
+            localPCA.idx = idx_input
+            self.assertTrue(np.allclose(localPCA.recover(), X_rec))
+
+        #missing or unreadable files raise an error, instead of exiting
+        localPCA = model_order_reduction.LPCA(X)
+        with self.assertRaises(FileNotFoundError):
+            localPCA.get_idx(os.path.join(folder, 'missing.npy'))
+        with self.assertRaises(FileNotFoundError):
+            localPCA.get_idx(tempfile.mkdtemp())
+        with open(os.path.join(folder, 'corrupted.npy'), 'w') as f:
+            f.write('not a numpy file')
+        with self.assertRaises(ValueError):
+            localPCA.get_idx(os.path.join(folder, 'corrupted.npy'))
+        corrupted = tempfile.mkdtemp()
+        with open(os.path.join(corrupted, 'idx.txt'), 'w') as f:
+            f.write('0,1\n0,1,2\n')
+        with self.assertRaises(ValueError):
+            localPCA.get_idx(corrupted)
+
+    def test_lpcaFittedModel(self):
+        X = np.random.rand(200, 5)
+        VQPCA = clustering.lpca(X)
+        VQPCA.clusters = 3
+        VQPCA.eigens = 2
+        VQPCA.initialization = 'uniform'
+        VQPCA.writeFolder = False
+        idx = VQPCA.fit()
+
+        localPCA = model_order_reduction.LPCA(X)
+        localPCA.eigens = 2
+        localPCA.idx = np.random.randint(0, 4, 200)
+        localPCA.fit()
+        localPCA.idx = np.random.randint(0, 4, 200)
+        self.assertFalse(hasattr(localPCA, "LPCs"))
+        localPCA.fit()
+        #the LPCs of the previous fit are discarded, and the model of the lpca object is used
+        localPCA.model = VQPCA
+        self.assertFalse(hasattr(localPCA, "LPCs"))
+        self.assertTrue(localPCA.model is VQPCA.model)
+
+        LPCs, u_scores, Leigen, centroids = localPCA.fit()
+        self.assertTrue(np.array_equal(localPCA.idx, idx))
+        self.assertEqual(len(LPCs), VQPCA.model.k)
+        for ii in range(0, VQPCA.model.k):
+            self.assertTrue(np.allclose(LPCs[ii], VQPCA.model.local_modes(ii)))
+
     def test_kpca(self):
         kernelPCA =  model_order_reduction.KPCA(self.X)
         kernelPCA.eigens = self.nPCtest
@@ -16,6 +16,7 @@ MODULE: test_clustering.py
 '''
 
 import unittest
+import functools
 
 import numpy as np
 from numpy import linalg as LA
@@ -64,6 +65,115 @@ class testClustering(unittest.TestCase):
         
         self.assertEqual(passed, True)
     
+    def test_KMeans_seeding(self):
+        for seeding in ['random', 'kmeans++', 'kmeans||']:
+            model = clustering.KMeans(self.X)
+            model.clusters = self.nKtest
+            model.seeding = seeding
+            model.n_init = 2
+            idx = model.fit()
+
+            self.assertEqual(len(idx), self.X.shape[0])
+            self.assertEqual(len(model.restart_errors), 2)
+            self.assertEqual(model.sse, np.min(model.restart_errors))
+
+        #the k-means++ seeds are distinct observations
+        C_mat = clustering.KMeans.seed_plusplus(self.X, self.nKtest)
+        self.assertEqual(len(np.unique(C_mat, axis=0)), self.nKtest)
+
+        #on well separated blobs, the k-means++ seeds are better than the random ones
+        np.random.seed(3)
+        centers = 20 * np.random.rand(8, 2)
+        X_blobs = np.concatenate([center + 0.1 * np.random.randn(100, 2) for center in centers])
+        model = clustering.KMeans(X_blobs)
+        model.clusters = 8
+        sse = {}
+        for seeding in ['random', 'kmeans++']:
+            model.seeding = seeding
+            sse[seeding] = np.mean([np.sum(clustering.get_nearest_centroids(X_blobs, model.seed_centroids())[1]) for ii in range(20)])
+        self.assertLess(sse['kmeans++'], sse['random'])
+
+        #a callback is not called with several runs
+        model = clustering.KMeans(self.X)
+        model.clusters = self.nKtest
+        model.n_init = 2
+        model.callback = lambda info: False
+        with self.assertWarns(UserWarning):
+            model.fit()
+
+    def test_KMeans_minibatch(self):
+        model = clustering.KMeans(self.X)
+        model.clusters = self.nKtest
+        model.batch_size = 20
+        idx = model.fit()
+
+        self.assertEqual(len(idx), self.X.shape[0])
+        self.assertEqual(model.centroids.shape, (self.nKtest, self.X.shape[1]))
+
+        model = clustering.KMeans(self.X)
+        model.clusters = self.nKtest
+        model.batch_size = 20
+        C_mat = model.fit_centroids()
+        self.assertEqual(C_mat.shape, (self.nKtest, self.X.shape[1]))
+        self.assertIs(C_mat, model.centroids)
+
+        #on well separated blobs, the SSE of the mini-batch solution is close to the Lloyd's one
+        centers = 20 * np.random.rand(5, 2)
+        X_blobs = np.concatenate([center + np.random.randn(400, 2) for center in centers])
+        sse = []
+        for batch_size in [None, 100]:
+            model = clustering.KMeans(X_blobs)
+            model.clusters = 5
+            model.seeding = 'kmeans++'
+            model.n_init = 5
+            model.batch_size = batch_size
+            model.fit()
+            sse.append(model.sse)
+        self.assertLess(sse[1], 1.1 * sse[0])
+
+    def test_KMeans_hamerly(self):
+        for seed in range(0, 5):
+            X = np.vstack([center + np.random.randn(40, self.X.shape[1]) for center in 10 * np.random.rand(5, self.X.shape[1])])
+            results = []
+            for algorithm in ['lloyd', 'hamerly']:
+                np.random.seed(seed)
+                iterations = []
+                model = clustering.KMeans(X)
+                model.clusters = 8
+                model.algorithm = algorithm
+                model.initMode = True
+                model.callback = lambda info: iterations.append(info["iteration"])
+                results.append((model.fit(), model.centroids, model.iterations, model.sse, iterations))
+
+            self.assertTrue(np.array_equal(results[0][0], results[1][0]))
+            self.assertTrue(np.array_equal(results[0][1], results[1][1]))
+            self.assertEqual(results[0][2], results[1][2])
+            self.assertEqual(results[0][3], results[1][3])
+            self.assertEqual(results[0][4], results[1][4])
+
+    def test_KMeans_reseedEmpty(self):
+        model = clustering.KMeans(self.X)
+        model.clusters = self.nKtest
+        idx = np.zeros((self.X.shape[0],), dtype=int)
+        idx[:10] = 1
+        minDist_ = np.random.rand(self.X.shape[0])
+        C_mat = np.zeros((self.nKtest, self.X.shape[1]))
+
+        self.assertEqual(model.reseed_empty(idx, minDist_, C_mat), self.nKtest -2)
+        self.assertEqual(len(np.unique(idx)), self.nKtest)
+        moved = np.flatnonzero(idx == self.nKtest -1)[0]
+        self.assertTrue(np.array_equal(C_mat[-1], self.X[moved]))
+        self.assertEqual(minDist_[moved], 0)
+
+        #the number of clusters does not change during the iterations
+        model.fit()
+        self.assertEqual(model.clusters, self.nKtest)
+
+        #the empty clusters of a given partition can still be removed
+        idx = np.random.randint(0, self.nKtest, size=self.X.shape[0])
+        idx[idx == 1] = 0
+        self.assertEqual(np.max(clustering.KMeans.remove_empty(self.X, idx)) +1, self.nKtest -1)
+
     def test_Spectral(self):
         model = clustering.spectralClustering(self.X)
         model.clusters = self.nKtest
@@ -76,3 +186,405 @@ class testClustering(unittest.TestCase):
             passed = False 
         
         self.assertEqual(passed, True)
+
+    def test_reconstructionErrors(self):
+        centroids = [np.mean(self.X, axis=0), np.zeros(self.X.shape[1])]
+        modes = [PCA_fit(self.X, self.nPCtest)[0], np.eye(self.X.shape[1])[:,:self.nPCtest]]
+
+        sq_rec_err = get_reconstruction_errors(self.X, centroids, modes, block_size=7)
+
+        for ii in range(0, len(centroids)):
+            rec_err_os = (self.X - centroids[ii]) - (self.X - centroids[ii]) @ modes[ii] @ modes[ii].T
+            self.assertTrue(np.allclose(sq_rec_err[:,ii], np.sum(rec_err_os**2, axis=1)))
+
+    def test_nearestCentroids(self):
+        centroids = self.X[:self.nKtest] + 0.1
+        idx, min_dist = get_nearest_centroids(self.X, centroids, block_size=7)
+
+        dist = np.sum((self.X[:,np.newaxis,:] - centroids[np.newaxis,:,:])**2, axis=2)
+        self.assertTrue(np.array_equal(idx, np.argmin(dist, axis=1)))
+        self.assertTrue(np.allclose(min_dist, np.min(dist, axis=1)))
+
+    def test_VQPCA_parallel(self):
+        np.random.seed(0)
+        serial = clustering.lpca(self.X)
+        serial.eigens = self.nPCtest
+        serial.clusters = self.nKtest
+        serial.writeFolder = False
+        idx_serial = serial.fit()
+
+        parallel = clustering.lpca(self.X)
+        parallel.eigens = self.nPCtest
+        parallel.clusters = self.nKtest
+        parallel.writeFolder = False
+        parallel.n_jobs = self.nKtest
+        idx_parallel = parallel.fit()
+
+        self.assertTrue(np.array_equal(idx_serial, idx_parallel))
+
+        #the approximated medoids of large clusters do not depend on the order of the tasks
+        model = clustering.lpca(self.X)
+        model.eigens = self.nPCtest
+        model.centroid_method = 'medoid'
+        model.X_tilde = np.random.rand(36000, self.X.shape[1])
+        membership = get_membership(np.arange(36000) % self.nKtest, self.nKtest)
+        centroids = []
+        for n_jobs, order in [(1, range(0, self.nKtest)), (1, range(self.nKtest -1, -1, -1)), (self.nKtest, range(0, self.nKtest))]:
+            sq_rec_err = np.empty((36000, self.nKtest))
+            local_models = parallel_map(functools.partial(model.fit_local_cluster, membership=membership, sq_rec_err=sq_rec_err, seed=0), order, n_jobs)
+            centroids.append({ii: local_model[0] for ii, local_model in zip(order, local_models)})
+        for ii in range(0, self.nKtest):
+            self.assertTrue(np.array_equal(centroids[0][ii], centroids[1][ii]))
+            self.assertTrue(np.array_equal(centroids[0][ii], centroids[2][ii]))
+
+    def test_miniBatchVQPCA(self):
+        import os
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), "X.npy")
+        np.save(path, self.X)
+
+        model = clustering.minibatch_lpca(path)
+        model.eigens = self.nPCtest
+        model.clusters = self.nKtest
+        model.batch_size = 20
+        model.writeFolder = False
+        idx = model.fit()
+
+        self.assertEqual(len(idx), self.X.shape[0])
+        self.assertTrue(np.allclose(model.mu, np.mean(self.X, axis=0)))
+        self.assertTrue(np.allclose(model.sigma, np.std(self.X, axis=0)))
+        #the error is the one of all the observations, with the final local models
+        self.assertGreater(model.iterations, 0)
+        X_tilde = center_scale(self.X, model.mu, model.sigma)
+        rec_errors = get_reconstruction_errors(X_tilde, list(model.model.centroids), [model.model.local_modes(ii) for ii in range(0, model.model.k)])
+        self.assertAlmostEqual(model.reconstruction_error, np.mean(np.min(rec_errors, axis=1)))
+
+        #the settings which are not available are reset, and the path is not available
+        model.correction = "c_range"
+        model.n_init = 2
+        with self.assertWarns(UserWarning):
+            model.fit()
+        self.assertEqual(model.correction, "off")
+        self.assertEqual(model.n_init, 1)
+        with self.assertRaises(Exception):
+            model.fit_path(self.nKtest +1)
+
+        #four groups of observations along different lines: the reconstruction error of the
+        #mini-batch solution is close to the one of the full lpca
+        t = np.random.rand(800, 1)
+        X = np.vstack([5 * np.eye(5)[ii] + t[200*ii:200*(ii+1)] * np.random.rand(5) + 0.01 * np.random.rand(200, 5) for ii in range(0, 4)])
+        rec_errors = []
+        for algorithm in [clustering.lpca, clustering.minibatch_lpca]:
+            model = algorithm(X)
+            model.eigens = 1
+            model.clusters = 4
+            model.initialization = "kmeans"
+            model.writeFolder = False
+            if algorithm is clustering.minibatch_lpca:
+                model.batch_size = 100
+            idx = model.fit()
+            rec_errors.append(np.mean((X - model.model.recover(X, idx))**2))
+        self.assertLess(rec_errors[1], 1.5 * rec_errors[0])
+
+    def test_shardedLPCA(self):
+        model = clustering.sharded_lpca(self.X)
+        model.eigens = self.nPCtest
+        model.clusters = self.nKtest
+        model.n_jobs = 2
+        model.writeFolder = False
+        idx = model.fit()
+
+        self.assertEqual(len(idx), self.X.shape[0])
+        self.assertEqual(model.model.k, np.max(idx) +1)
+        self.assertTrue(np.allclose(model.mu, np.mean(self.X, axis=0)))
+        self.assertTrue(np.allclose(model.sigma, np.std(self.X, axis=0)))
+
+    def test_updateStatistics(self):
+        idx_old = np.random.randint(0, self.nKtest, size=self.X.shape[0])
+        idx_new = idx_old.copy()
+        idx_new[:10] = (idx_new[:10] +1) % self.nKtest
+
+        counts, sums, scatters = get_sufficient_statistics(self.X, idx_old, self.nKtest)
+        n_moved = update_sufficient_statistics(self.X, idx_old, idx_new, counts, sums, scatters)
+        counts_, sums_, scatters_ = get_sufficient_statistics(self.X, idx_new, self.nKtest)
+
+        self.assertEqual(n_moved, 10)
+        self.assertTrue(np.allclose(counts, counts_))
+        self.assertTrue(np.allclose(sums, sums_))
+        self.assertTrue(np.allclose(scatters, scatters_))
+
+        #observations far from the origin: the statistics computed about the clusters' means,
+        #and updated many times, give the same covariances computed from the observations
+        X = self.X @ np.diag([1, 2, 3, 4, 5]) + 1E6
+        idx = np.random.randint(0, self.nKtest, size=X.shape[0])
+        references = get_cluster_statistics(X, idx, self.nKtest, covariances=False)[1]
+        counts, sums, scatters = get_sufficient_statistics(X, idx, self.nKtest, references)
+        for ii in range(0, 100):
+            idx_new = idx.copy()
+            idx_new[np.random.randint(0, X.shape[0], size=5)] = np.random.randint(0, self.nKtest, size=5)
+            update_sufficient_statistics(X, idx, idx_new, counts, sums, scatters, references)
+            idx = idx_new
+        centroids, modes, evals = PCA_from_statistics(counts, sums, scatters, 2, 'eigh', references)
+        for ii in range(0, self.nKtest):
+            cluster_ = get_cluster(X, idx, ii)
+            self.assertTrue(np.allclose(centroids[ii], np.mean(cluster_, axis=0), rtol=0, atol=1E-8))
+            self.assertTrue(np.allclose(evals[ii], np.linalg.eigvalsh(np.cov(cluster_, rowvar=False))[::-1][:2]))
+
+        #the same in lpca, without centering the matrix
+        model = clustering.lpca(X)
+        model.eigens = self.nPCtest
+        model.clusters = self.nKtest
+        model.to_center = False
+        model.to_scale = False
+        model.writeFolder = False
+        idx = model.fit()
+        for ii in range(0, model.model.k):
+            cluster_ = get_cluster(X, idx, ii)
+            self.assertTrue(np.allclose(model.model.eigenvalues[ii], np.linalg.eigvalsh(np.cov(cluster_, rowvar=False))[::-1]))
+
+    def test_VQPCA_restarts(self):
+        model = clustering.lpca(self.X)
+        model.eigens = self.nPCtest
+        model.clusters = self.nKtest
+        model.initialization = 'observations'
+        model.writeFolder = False
+        model.n_init = 3
+        model.n_jobs = 2
+        idx = model.fit()
+
+        self.assertEqual(len(model.restart_errors), 3)
+        self.assertEqual(model.reconstruction_error, np.min(model.restart_errors))
+        self.assertEqual(len(idx), self.X.shape[0])
+        self.assertGreater(model.iterations, 0)
+
+        #deterministic initialization: the algorithm is run only once
+        model.initialization = 'uniform'
+        with self.assertWarns(UserWarning):
+            idx = model.fit()
+        self.assertEqual(len(model.restart_errors), 1)
+
+        #the callback is not called by the restarts
+        model.initialization = 'observations'
+        model.callback = lambda info: False
+        with self.assertWarns(UserWarning):
+            idx = model.fit()
+
+    def test_VQPCA_path(self):
+        model = clustering.lpca(self.X)
+        model.eigens = self.nPCtest
+        model.clusters = 2
+        model.writeFolder = False
+        idx_path, rec_errors = model.fit_path(4)
+
+        self.assertEqual(len(idx_path), 3)
+        self.assertEqual(len(rec_errors), 3)
+        self.assertEqual(len(model.k_path), 3)
+        for k, idx in zip(model.k_path, idx_path):
+            self.assertEqual(len(idx), self.X.shape[0])
+            self.assertEqual(np.max(idx) +1, k)
+            self.assertLessEqual(k, 4)
+
+        #four groups of observations along different lines: the final number of clusters
+        #is reached, and the reconstruction error decreases along the path
+        t = np.random.rand(200, 1)
+        X = np.vstack([5 * np.eye(5)[ii] + t[50*ii:50*(ii+1)] * np.random.rand(5) + 0.01 * np.random.rand(50, 5) for ii in range(0, 4)])
+        model = clustering.lpca(X)
+        model.eigens = 1
+        model.clusters = 2
+        model.writeFolder = False
+        idx_path, rec_errors = model.fit_path(4)
+
+        self.assertEqual(np.max(idx_path[-1]) +1, 4)
+        self.assertTrue(np.all(np.diff(rec_errors) <= 0))
+        #the local errors are the ones of the final local models
+        self.assertEqual(len(model.local_errors), X.shape[0])
+        self.assertTrue(np.all(np.isfinite(model.local_errors)))
+
+    def test_clusterStatistics(self):
+        idx = np.random.randint(0, self.nKtest, size=self.X.shape[0])
+        idx[idx == 1] = 2
+        counts, centroids, minima, maxima, covariances = get_cluster_statistics(self.X, idx, self.nKtest)
+
+        self.assertEqual(counts[1], 0)
+        for ii in [0, 2]:
+            cluster_ = get_cluster(self.X, idx, ii)
+            self.assertEqual(counts[ii], cluster_.shape[0])
+            self.assertTrue(np.allclose(centroids[ii], np.mean(cluster_, axis=0)))
+            self.assertTrue(np.allclose(minima[ii], np.min(cluster_, axis=0)))
+            self.assertTrue(np.allclose(maxima[ii], np.max(cluster_, axis=0)))
+            self.assertTrue(np.allclose(covariances[ii], np.cov(cluster_, rowvar=False)))
+
+        #the covariances can be skipped
+        statistics = get_cluster_statistics(self.X, idx, self.nKtest, covariances=False)
+        self.assertIsNone(statistics[-1])
+        self.assertTrue(np.array_equal(statistics[1], centroids))
+
+    def test_mergeClusters(self):
+        idx = np.array([0, 0, 1, 2, 2, 3, 4, 4])
+        idx = clustering.lpca.merge_clusters(self.X[:8], idx)
+
+        self.assertTrue(np.array_equal(idx, [0, 0, 0, 1, 1, 1, 2, 2]))
+
+    def test_mergeAdjacentClusters(self):
+        def merge_loop(idx):
+            #reference: one cluster at the time, starting again from the first one
+            idx = idx.copy()
+            k = np.max(idx) +1
+            jj = 0
+            while jj < k and k > 1:
+                if np.count_nonzero(idx == jj) < 2:
+                    idx[idx >= max(jj, 1)] -= 1
+                    k = np.max(idx) +1
+                    jj = 0
+                else:
+                    jj += 1
+            return idx
+
+        cases = [[0, 1, 2, 2, 2, 2, 2], [0, 0, 1, 2, 3, 3], [0, 1, 2, 3, 3, 4], [0, 0, 0, 1, 2, 3, 4, 5, 5]]
+        cases += [np.random.randint(0, 6, 10) for ii in range(0, 20)]
+        for idx in cases:
+            idx = np.asarray(idx)
+            self.assertTrue(np.array_equal(clustering.lpca.merge_clusters(self.X[:len(idx)], idx), merge_loop(idx)))
+
+    def test_VQPCA_corrections(self):
+        for correction in ["c_range", "uncorrelation", "local_variance", "phc_multi", "local_skewness"]:
+            model = clustering.lpca(self.X)
+            model.eigens = self.nPCtest
+            model.clusters = self.nKtest
+            model.writeFolder = False
+            model.correction = correction
+            self.assertEqual(model.correction, correction)
+            idx = model.fit()
+            self.assertEqual(len(idx), self.X.shape[0])
+
+        #the factors are the same computed cluster by cluster, on a fixed partition
+        from scipy.stats import skew
+        model = clustering.lpca(self.X)
+        model.eigens = self.nPCtest
+        model.X_tilde = model.preprocess_training(self.X, model._center, model._scale, model._centering, model._scaling)
+        model._correction_cache = {}
+        idx = np.arange(self.X.shape[0]) % self.nKtest
+        centroids, modes = [None] *self.nKtest, [None] *self.nKtest
+        reference = {correction: np.zeros(self.nKtest) for correction in ["uncorrelation", "local_variance", "phc_multi", "local_skewness"]}
+        reference["c_range"] = np.zeros((self.X.shape[0], self.nKtest))
+        for ii in range(0, self.nKtest):
+            cluster = get_cluster(model.X_tilde, idx, ii)
+            cluster_raw = get_cluster(self.X, idx, ii)
+            centroids[ii] = get_centroids(cluster)
+            modes[ii] = PCA_fit(cluster - centroids[ii], self.nPCtest)[0]
+
+            centroids_raw = get_centroids(cluster_raw)
+            inside = (self.X >= centroids_raw - centroids_raw/2) & (self.X <= centroids_raw + centroids_raw/2)
+            reference["c_range"][:,ii] = np.sum(~inside, axis=1)
+            scores_variance = np.var((model.X_tilde - centroids[ii]) @ modes[ii], axis=0)
+            reference["uncorrelation"][ii] = 1 - np.min(scores_variance)/np.max(scores_variance)
+            reference["local_variance"][ii] = np.mean(np.var(cluster_raw))
+            reference["phc_multi"][ii] = np.mean((np.max(cluster_raw, axis=0) - np.min(cluster_raw, axis=0))/(centroids_raw + 1E-16))
+            reference["local_skewness"][ii] = np.mean(skew(cluster, axis=0))
+        reference["phc_multi"] /= np.max(reference["phc_multi"])
+
+        statistics = get_cluster_statistics(self.X, idx, self.nKtest, covariances=False)[:4]
+        for correction in reference:
+            factors = clustering.lpca_corrections[correction](model, idx, centroids, modes, statistics)
+            self.assertTrue(np.allclose(factors, reference[correction]))
+
+    def test_registerCorrection(self):
+        @clustering.register_correction("unit_test")
+        def unit_correction(model, idx, centroids, modes, statistics):
+            return np.ones(len(centroids))
+
+        model = clustering.lpca(self.X)
+        model.correction = "unit_test"
+        self.assertEqual(model.correction, "unit_test")
+        del clustering.lpca_corrections["unit_test"]
+
+    def test_VQPCA_robustCentroids(self):
+        for centroid_method in ["medianoid", "medoid"]:
+            model = clustering.lpca(self.X)
+            model.eigens = self.nPCtest
+            model.clusters = self.nKtest
+            model.writeFolder = False
+            model.centroid_method = centroid_method
+            idx = model.fit()
+            self.assertEqual(len(idx), self.X.shape[0])
+
+    def test_approximatedCentroids(self):
+        X = np.random.rand(5000, 3)
+        from scipy.spatial.distance import cdist
+
+        medianoid = get_medianoids(X, n_bins=64)
+        self.assertTrue(np.all(np.abs(medianoid - np.median(X, axis=0)) < 1E-3))
+        self.assertTrue(np.array_equal(get_medoids(X[:500], block_size=7), X[np.argmin(np.sum(cdist(X[:500], X[:500]), axis=1))]))
+        medoid = get_medoids(X, n_candidates=100, n_references=1000)
+        self.assertTrue(np.any(np.all(X == medoid, axis=1)))
+
+    def test_callback(self):
+        import io
+        import contextlib
+
+        records = []
+        def stop_at_second(record):
+            records.append(record)
+            return record["iteration"] == 2
+
+        for model in [clustering.lpca(self.X), clustering.KMeans(self.X)]:
+            records.clear()
+            model.writeFolder = False
+            model.callback = stop_at_second
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                model.fit()
+
+            self.assertEqual(len(records), 2)
+            self.assertEqual(set(records[-1].keys()), {"iteration", "error", "variation", "labels_changed", "timings"})
+            self.assertEqual(output.getvalue(), "")
+
+    def test_VQPCA_model(self):
+        import os
+        import tempfile
+        import OpenMORe.classification as classification
+        import OpenMORe.model_order_reduction as model_order_reduction
+
+        model = clustering.lpca(self.X)
+        model.eigens = self.nPCtest
+        model.clusters = self.nKtest
+        model.writeFolder = False
+        idx = model.fit()
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "lpca_model.npz")
+            model.model.save(path)
+            loaded = clustering.lpca_model.load(path)
+
+            self.assertTrue(isinstance(loaded.modes, np.memmap))
+            self.assertTrue(np.array_equal(loaded.idx, idx))
+            self.assertTrue(np.array_equal(loaded.classify(self.X), model.model.classify(self.X)))
+
+            classifier = classification.VQPCA(self.X, idx, self.X)
+            classifier.model = path
+            self.assertEqual(len(classifier.fit()), self.X.shape[0])
+
+            reconstruction = model_order_reduction.LPCA(self.X)
+            reconstruction.model = loaded
+            X_rec = reconstruction.recover()
+            self.assertEqual(X_rec.shape, self.X.shape)
+            del loaded, classifier, reconstruction
+
+            #arrays saved with the version 3.0 of the .npy format
+            import zipfile
+            path = os.path.join(folder, "lpca_model_v3.npz")
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+                for name, array in model.model.arrays().items():
+                    with archive.open(name + ".npy", "w") as file_:
+                        np.lib.format.write_array(file_, np.asarray(array), version=(3, 0))
+            loaded = clustering.lpca_model.load(path)
+            self.assertTrue(np.array_equal(loaded.modes, model.model.modes))
+            del loaded
+
+        #the model reuses the statistics of the last iteration: it is the same built from scratch
+        reference = model.build_model(idx)
+        self.assertEqual(model.model.k, np.max(idx) +1)
+        self.assertTrue(np.allclose(model.model.centroids, reference.centroids))
+        self.assertTrue(np.allclose(model.model.eigenvalues, reference.eigenvalues))
+        self.assertTrue(np.allclose(model.model.sigma, reference.sigma))